@@ -1,20 +1,53 @@
 import argparse
-from dotenv import load_dotenv
-from rag_url.agent import RagAgent
-from rag_url.embed import ChunkEmbedder
-from rag_url.chunk import MarkdownChunker
-from rag_url.scrape import BaseUrlScraper
+from pathlib import Path
+from rag_url.metrics import metrics
+from rag_url.options import INDEX_TYPES, METRICS, VECTOR_TYPE_NAMES
+
+# the stages import their dependencies (genai, lancedb, pydantic-ai, ...) when
+# they run, parsing the command line and --help stay fast.
 
 # example
 # python main.py scrape ./data/pydantic_ai https://ai.pydantic.dev/ --exclude /api /img /llms.txt /llms-full.txt
 # python main.py chunk ./data/pydantic_ai
 # python main.py embed ./data/_lancedb "./data/pydantic_ai/*.json" --collection pydantic_ai
+# python main.py build ./data/pydantic_ai https://ai.pydantic.dev/ ./data/_lancedb --collection pydantic_ai
+# python main.py agent ./data/_lancedb --collection pydantic_ai fastapi
+# python main.py serve ./data/_lancedb --port 8000
+# python main.py bench search --files 200 --queries 200 --k 5
+# python main.py bench startup --budget 150
+
+
+def positive_int(value: str) -> int:
+    number = int(value)
 
-load_dotenv()
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, not {number}")
+
+    return number
 
 
 def main():
     parser = argparse.ArgumentParser(prog="rag url")
+    parser.add_argument(
+        "--metrics",
+        type=str,
+        default=None,
+        help="Export the metrics to this file, Prometheus text if it ends in .prom",
+    )
+    parser.add_argument(
+        "--profile",
+        type=str,
+        default=None,
+        metavar="STAGE",
+        help="Run a stage under cProfile",
+    )
+    parser.add_argument(
+        "--trace-memory",
+        type=str,
+        default=None,
+        metavar="STAGE",
+        help="Run a stage under tracemalloc",
+    )
     subparsers = parser.add_subparsers(dest="command", required=True)
 
     # Scrape command
@@ -24,11 +57,41 @@ def main():
     )
     scrape_parser.add_argument("url", type=str, help="The base url to scrape from")
     scrape_parser.add_argument(
-        "--delay", type=float, default=0.1, help="Delay between requests (in seconds)"
+        "--rate",
+        type=float,
+        default=10.0,
+        help="Max requests per second to a host (0 for no limit)",
+    )
+    scrape_parser.add_argument(
+        "--burst", type=int, default=1, help="Max requests sent at once to a host"
+    )
+    scrape_parser.add_argument(
+        "--concurrency", type=int, default=8, help="Number of in-flight requests"
+    )
+    scrape_parser.add_argument(
+        "--parse-workers",
+        type=int,
+        default=None,
+        help="Number of processes converting pages (defaults to the cpu count)",
     )
     scrape_parser.add_argument(
         "--exclude", nargs="*", default=[], help="List of paths to exclude"
     )
+    scrape_parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Empty the workdir and download every page again",
+    )
+    scrape_parser.add_argument(
+        "--no-seed",
+        action="store_true",
+        help="Do not seed the crawl from robots.txt, sitemap.xml and llms.txt",
+    )
+    scrape_parser.add_argument(
+        "--timings",
+        action="store_true",
+        help="Print the time spent fetching, parsing and converting each page",
+    )
 
     # Chunk command
     chunk_parser = subparsers.add_parser("chunk", help="Chunk the scraped pages")
@@ -36,14 +99,60 @@ def main():
         "workdir", type=str, help="The directory with markdown files to chunk"
     )
     chunk_parser.add_argument(
-        "--delay", type=float, default=1.0, help="Delay between requests (in seconds)"
+        "--concurrency", type=int, default=4, help="Number of in-flight llm calls"
+    )
+    chunk_parser.add_argument(
+        "--retries", type=int, default=3, help="Number of retries of a failed file"
+    )
+    chunk_parser.add_argument(
+        "--max-tokens",
+        type=int,
+        default=4000,
+        help="Pages above this size are split before being sent to the llm",
+    )
+    chunk_parser.add_argument(
+        "--local",
+        action="store_true",
+        help="Chunk well structured pages on their headings, without the llm",
+    )
+    chunk_parser.add_argument(
+        "--no-cache", action="store_true", help="Do not use the chunk cache"
+    )
+    chunk_parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=256,
+        help="Max size of the chunk cache (in MB)",
+    )
+    chunk_parser.add_argument(
+        "--store",
+        action="store_true",
+        help="Write the chunks to a single chunks.sqlite file instead of a json file per page",
+    )
+
+    # Convert command
+    convert_parser = subparsers.add_parser(
+        "convert", help="Copy the json chunk files of a workdir into its chunks.sqlite"
+    )
+    convert_parser.add_argument(
+        "workdir", type=str, help="The directory containing the json chunk files"
     )
 
     # Embed command
     embed_parser = subparsers.add_parser("embed", help="embed json chunk files")
     embed_parser.add_argument("dbfile", type=str, help="The persisent db file")
     embed_parser.add_argument(
-        "pattern", type=str, help="The glob pattern to collect json chunk files"
+        "pattern",
+        type=str,
+        nargs="?",
+        default=None,
+        help="The glob pattern to collect json chunk files",
+    )
+    embed_parser.add_argument(
+        "--store",
+        type=str,
+        default=None,
+        help="Read the chunks from this chunks.sqlite file instead of json files",
     )
     embed_parser.add_argument(
         "--collection",
@@ -51,30 +160,511 @@ def main():
         required=True,
         help="Collection storing the embeddings in the db",
     )
+    embed_parser.add_argument(
+        "--batch-size", type=int, default=100, help="Number of chunks per request"
+    )
+    embed_parser.add_argument(
+        "--concurrency", type=int, default=4, help="Number of in-flight requests"
+    )
+    embed_parser.add_argument(
+        "--retries", type=int, default=3, help="Number of retries of a failed batch"
+    )
+    embed_parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Embed every chunk and rebuild the collection",
+    )
+    embed_parser.add_argument(
+        "--no-cache", action="store_true", help="Do not use the embedding cache"
+    )
+    embed_parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=256,
+        help="Max size of the embedding cache (in MB)",
+    )
+    embed_parser.add_argument(
+        "--index",
+        choices=list(INDEX_TYPES),
+        default=None,
+        help="Build a vector index of this type once the collection is large enough",
+    )
+    embed_parser.add_argument(
+        "--index-threshold",
+        type=int,
+        default=100_000,
+        help="Number of chunks from which the index is built",
+    )
+    embed_parser.add_argument(
+        "--metric", choices=METRICS, default="cosine", help="Distance of the index"
+    )
+    embed_parser.add_argument(
+        "--partitions", type=int, default=None, help="Number of IVF partitions"
+    )
+    embed_parser.add_argument(
+        "--sub-vectors", type=int, default=None, help="Number of PQ sub-vectors"
+    )
+    embed_parser.add_argument(
+        "--fts",
+        action="store_true",
+        help="Also build the full text index of the chunks, for --hybrid",
+    )
+    embed_parser.add_argument(
+        "--no-dedup",
+        action="store_true",
+        help="Store duplicated chunks once per page",
+    )
+    embed_parser.add_argument(
+        "--dedup-distance",
+        type=int,
+        default=3,
+        help="Max simhash bits between near duplicates, 0 for exact ones only",
+    )
+    embed_parser.add_argument(
+        "--dimensions",
+        type=int,
+        default=None,
+        help="Size of the vectors asked to the model (default: the model's)",
+    )
+    embed_parser.add_argument(
+        "--vector-type",
+        type=str,
+        choices=VECTOR_TYPE_NAMES,
+        default="float32",
+        help="Precision of the stored vectors",
+    )
+    embed_parser.add_argument(
+        "--no-full-vectors",
+        action="store_true",
+        help="Do not keep float32 vectors to re-rank compact ones",
+    )
+
+    # Options shared by the commands querying the collections
+    query_options = argparse.ArgumentParser(add_help=False)
+    query_options.add_argument(
+        "--no-cache", action="store_true", help="Do not use the embedding cache"
+    )
+    query_options.add_argument(
+        "--cache-size",
+        type=int,
+        default=256,
+        help="Max size of the embedding cache (in MB)",
+    )
+    query_options.add_argument(
+        "--nprobes",
+        type=int,
+        default=None,
+        help="Number of index partitions searched",
+    )
+    query_options.add_argument(
+        "--refine-factor",
+        type=int,
+        default=None,
+        help="Re-rank this many times the results on the full vectors",
+    )
+    query_options.add_argument(
+        "--top-k", type=int, default=5, help="Number of chunks given to the model"
+    )
+    query_options.add_argument(
+        "--hybrid",
+        action="store_true",
+        help="Also search the full text index, fusing the rankings",
+    )
+    query_options.add_argument(
+        "--no-answer-cache",
+        action="store_true",
+        help="Generate every answer, even for a question asked before",
+    )
+    query_options.add_argument(
+        "--answer-threshold",
+        type=float,
+        default=0.95,
+        help="Similarity from which a cached answer is reused",
+    )
+    query_options.add_argument(
+        "--answer-ttl",
+        type=float,
+        default=3600.0,
+        help="Seconds an answer stays in the cache",
+    )
+    query_options.add_argument(
+        "--context-assembly",
+        action="store_true",
+        help="Assemble the context from more chunks, up to a token budget",
+    )
+    query_options.add_argument(
+        "--context-tokens",
+        type=int,
+        default=1250,
+        help="Token budget of the context given to the model per search",
+    )
+    query_options.add_argument(
+        "--overfetch",
+        type=int,
+        default=4,
+        help="Fetch this many times more chunks to assemble the context from",
+    )
+    query_options.add_argument(
+        "--mmr-lambda",
+        type=float,
+        default=0.7,
+        help="Relevance against diversity of the context, 1 for relevance only",
+    )
 
     # Agent command
-    agent_parser = subparsers.add_parser("agent", help="Run the RAG agent")
+    agent_parser = subparsers.add_parser(
+        "agent", help="Run the RAG agent", parents=[query_options]
+    )
     agent_parser.add_argument("dbfile", type=str, help="The persistent db file")
     agent_parser.add_argument(
+        "--collection",
+        type=str,
+        nargs="+",
+        default=None,
+        help="Collections to search (default: all the collections of the db)",
+    )
+    agent_parser.add_argument(
+        "--no-stream",
+        action="store_true",
+        help="Print each answer once it is complete",
+    )
+    agent_parser.add_argument(
+        "--no-router",
+        action="store_true",
+        help="Search every collection for each query",
+    )
+    agent_parser.add_argument(
+        "--route-top",
+        type=positive_int,
+        default=4,
+        help="Number of collections searched, the closest to the query",
+    )
+
+    # Serve command
+    serve_parser = subparsers.add_parser(
+        "serve", help="Serve the collections over http", parents=[query_options]
+    )
+    serve_parser.add_argument("dbfile", type=str, help="The persistent db file")
+    serve_parser.add_argument(
+        "--collection",
+        type=str,
+        nargs="+",
+        default=None,
+        help="Collections to serve (default: all the collections of the db)",
+    )
+    serve_parser.add_argument("--host", type=str, default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8000)
+    serve_parser.add_argument(
+        "--max-concurrency",
+        type=int,
+        default=16,
+        help="Number of requests served at a time",
+    )
+    serve_parser.add_argument(
+        "--queue-timeout",
+        type=float,
+        default=10.0,
+        help="Seconds a request waits for a slot before a 503",
+    )
+
+    # Build command
+    build_parser = subparsers.add_parser(
+        "build", help="Scrape, chunk and embed a base url in one pipelined run"
+    )
+    build_parser.add_argument(
+        "workdir", type=str, help="The directory where to store the pages"
+    )
+    build_parser.add_argument("url", type=str, help="The base url to scrape from")
+    build_parser.add_argument("dbfile", type=str, help="The persistent db file")
+    build_parser.add_argument(
         "--collection",
         type=str,
         required=True,
         help="Collection storing the embeddings in the db",
     )
+    build_parser.add_argument(
+        "--exclude", type=str, nargs="*", default=[], help="Paths to exclude"
+    )
+    build_parser.add_argument(
+        "--rate",
+        type=float,
+        default=10.0,
+        help="Max requests per second to a host (0 for no limit)",
+    )
+    build_parser.add_argument(
+        "--scrape-concurrency",
+        type=int,
+        default=8,
+        help="Number of in-flight requests",
+    )
+    build_parser.add_argument(
+        "--chunk-concurrency",
+        type=int,
+        default=4,
+        help="Number of in-flight llm calls",
+    )
+    build_parser.add_argument(
+        "--local",
+        action="store_true",
+        help="Chunk well structured pages on their headings, without the llm",
+    )
+    build_parser.add_argument(
+        "--batch-size", type=int, default=100, help="Number of chunks per api call"
+    )
+    build_parser.add_argument(
+        "--embed-concurrency",
+        type=int,
+        default=4,
+        help="Number of in-flight embedding calls",
+    )
+    build_parser.add_argument(
+        "--retries",
+        type=int,
+        default=3,
+        help="Number of times a failed page or batch is retried",
+    )
+    build_parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=256,
+        help="Maximum size of the chunk and embedding caches in MB",
+    )
+    build_parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=64,
+        help="Pages waiting between two stages",
+    )
+    build_parser.add_argument(
+        "--store",
+        action="store_true",
+        help="Write the chunks to a single chunks.sqlite file instead of a json file per page",
+    )
+    build_parser.add_argument(
+        "--no-files",
+        action="store_true",
+        help="Do not write the markdown and json files of the pages",
+    )
+    build_parser.add_argument(
+        "--fts",
+        action="store_true",
+        help="Also build the full text index of the chunks, for --hybrid",
+    )
+    build_parser.add_argument(
+        "--full", action="store_true", help="Rebuild everything from scratch"
+    )
+
+    # Bench command, its options are the ones of python -m rag_url.bench
+    bench_parser = subparsers.add_parser(
+        "bench",
+        help="Benchmark the stages against local stand-ins",
+        add_help=False,
+    )
+    bench_parser.add_argument(
+        "bench_args",
+        nargs=argparse.REMAINDER,
+        help="scrape, chunk, embed, index, compact, search, build or startup, and their options",
+    )
 
     # parse and execute the command.
     args = parser.parse_args()
 
-    if args.command == "scrape":
-        BaseUrlScraper(args.workdir, args.url, args.delay, args.exclude).run()
-    elif args.command == "chunk":
-        MarkdownChunker(args.workdir, args.delay).run()
-    elif args.command == "embed":
-        ChunkEmbedder(args.dbfile, args.pattern, args.collection).run()
-    elif args.command == "agent":
-        RagAgent(args.dbfile, args.collection).run()
-    else:
-        raise Exception("Unexpected input")
+    # the api keys are only read by the stages.
+    from dotenv import load_dotenv
+
+    load_dotenv()
+
+    metrics.configure(args.metrics, args.profile, args.trace_memory)
+
+    with metrics.stage(args.command):
+        if args.command == "scrape":
+            from rag_url.scrape import BaseUrlScraper
+
+            BaseUrlScraper(
+                args.workdir,
+                args.url,
+                rate=args.rate,
+                excluded_paths=args.exclude,
+                concurrency=args.concurrency,
+                burst=args.burst,
+                parse_workers=args.parse_workers,
+                full=args.full,
+                timings=args.timings,
+                seed=not args.no_seed,
+            ).run()
+        elif args.command == "chunk":
+            from rag_url.cache import ChunkCache
+            from rag_url.chunk import MarkdownChunker
+            from rag_url.store import STORE_FILENAME, ChunkStore
+
+            cache = None if args.no_cache else ChunkCache(max_bytes=args.cache_size << 20)
+            store = ChunkStore(Path(args.workdir) / STORE_FILENAME) if args.store else None
+            MarkdownChunker(
+                args.workdir,
+                concurrency=args.concurrency,
+                retries=args.retries,
+                cache=cache,
+                max_tokens=args.max_tokens,
+                local=args.local,
+                store=store,
+            ).run()
+        elif args.command == "convert":
+            from rag_url.store import STORE_FILENAME, ChunkStore, import_json
+
+            store = ChunkStore(Path(args.workdir) / STORE_FILENAME)
+            copied = import_json(store, args.workdir)
+            print(f"[INFO] {copied} pages copied into {store.path}")
+        elif args.command == "embed":
+            from rag_url.cache import EmbeddingCache
+            from rag_url.embed import ChunkEmbedder
+            from rag_url.store import ChunkStore
+
+            if (args.pattern is None) == (args.store is None):
+                raise Exception("Give either a pattern or --store to embed")
+
+            cache = (
+                None if args.no_cache else EmbeddingCache(max_bytes=args.cache_size << 20)
+            )
+            ChunkEmbedder(
+                args.dbfile,
+                args.pattern,
+                args.collection,
+                batch_size=args.batch_size,
+                concurrency=args.concurrency,
+                retries=args.retries,
+                full=args.full,
+                cache=cache,
+                index_type=args.index,
+                index_threshold=args.index_threshold,
+                metric=args.metric,
+                num_partitions=args.partitions,
+                num_sub_vectors=args.sub_vectors,
+                fts=args.fts,
+                dedup=not args.no_dedup,
+                dedup_distance=args.dedup_distance,
+                dimensions=args.dimensions,
+                vector_type=args.vector_type,
+                full_vectors=not args.no_full_vectors,
+                store=ChunkStore(args.store) if args.store else None,
+            ).run()
+        elif args.command == "agent":
+            from rag_url.agent import RagAgent
+            from rag_url.cache import AnswerCache, EmbeddingCache
+            from rag_url.context import ContextAssembler
+            from rag_url.router import CollectionRouter
+
+            cache = (
+                None if args.no_cache else EmbeddingCache(max_bytes=args.cache_size << 20)
+            )
+            answers = (
+                None
+                if args.no_answer_cache
+                else AnswerCache(threshold=args.answer_threshold, ttl=args.answer_ttl)
+            )
+            context = (
+                ContextAssembler(
+                    max_tokens=args.context_tokens,
+                    overfetch=args.overfetch,
+                    mmr_lambda=args.mmr_lambda,
+                )
+                if args.context_assembly
+                else None
+            )
+            RagAgent(
+                args.dbfile,
+                args.collection,
+                cache=cache,
+                nprobes=args.nprobes,
+                refine_factor=args.refine_factor,
+                top_k=args.top_k,
+                stream=not args.no_stream,
+                answers=answers,
+                context=context,
+                router=None if args.no_router else CollectionRouter(args.route_top),
+                hybrid=args.hybrid,
+            ).run()
+        elif args.command == "serve":
+            from rag_url.cache import AnswerCache, EmbeddingCache
+            from rag_url.context import ContextAssembler
+            from rag_url.server import KnowledgeServer
+
+            cache = (
+                None if args.no_cache else EmbeddingCache(max_bytes=args.cache_size << 20)
+            )
+            answers = (
+                None
+                if args.no_answer_cache
+                else AnswerCache(threshold=args.answer_threshold, ttl=args.answer_ttl)
+            )
+            context = (
+                ContextAssembler(
+                    max_tokens=args.context_tokens,
+                    overfetch=args.overfetch,
+                    mmr_lambda=args.mmr_lambda,
+                )
+                if args.context_assembly
+                else None
+            )
+            KnowledgeServer(
+                args.dbfile,
+                args.collection,
+                max_concurrency=args.max_concurrency,
+                queue_timeout=args.queue_timeout,
+                cache=cache,
+                nprobes=args.nprobes,
+                refine_factor=args.refine_factor,
+                top_k=args.top_k,
+                answers=answers,
+                context=context,
+                hybrid=args.hybrid,
+            ).run(args.host, args.port)
+        elif args.command == "build":
+            from rag_url.cache import ChunkCache, EmbeddingCache
+            from rag_url.chunk import MarkdownChunker
+            from rag_url.embed import ChunkEmbedder
+            from rag_url.pipeline import BuildPipeline
+            from rag_url.scrape import BaseUrlScraper
+            from rag_url.store import STORE_FILENAME, ChunkStore
+
+            store = ChunkStore(Path(args.workdir) / STORE_FILENAME) if args.store else None
+
+            BuildPipeline(
+                BaseUrlScraper(
+                    args.workdir,
+                    args.url,
+                    rate=args.rate,
+                    excluded_paths=args.exclude,
+                    concurrency=args.scrape_concurrency,
+                    full=args.full,
+                ),
+                MarkdownChunker(
+                    args.workdir,
+                    concurrency=args.chunk_concurrency,
+                    retries=args.retries,
+                    cache=ChunkCache(max_bytes=args.cache_size << 20),
+                    local=args.local,
+                    store=store,
+                ),
+                ChunkEmbedder(
+                    args.dbfile,
+                    None,
+                    args.collection,
+                    batch_size=args.batch_size,
+                    concurrency=args.embed_concurrency,
+                    retries=args.retries,
+                    full=args.full,
+                    cache=EmbeddingCache(max_bytes=args.cache_size << 20),
+                    fts=args.fts,
+                ),
+                queue_size=args.queue_size,
+                write=not args.no_files,
+            ).run()
+        elif args.command == "bench":
+            from rag_url.bench import main as bench_main
+
+            bench_main(args.bench_args)
+        else:
+            raise Exception("Unexpected input")
 
 
 if __name__ == "__main__":
@@ -1,63 +1,337 @@
 import os
+import asyncio
 import lancedb
-from google import genai
+import threading
+from datetime import timedelta
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Optional
 from pydantic_ai import Agent
+from rag_url.cache import AnswerCache, EmbeddingCache
+from rag_url.context import ContextAssembler, format_context, to_passages
+from rag_url.gemini import (
+    embed_config,
+    embed_model_key,
+    embedding_values,
+    make_client,
+)
+from rag_url.index import (
+    has_fts_index,
+    hybrid_search,
+    merge_by_score,
+    nearest,
+    similarities,
+    vector_dimensions,
+    vector_index,
+)
+from rag_url.metrics import metrics
 from rag_url.prompts import AGENT_SYSTEM_PROMPT
+from rag_url.router import CollectionRouter
+
+# Query embeddings kept in memory without an embedding cache, a question is
+# embedded once for the answer cache and the search that follows.
+RECENT_EMBEDDINGS = 64
 
 
 class RagAgent:
-    def __init__(self, dbfile: str, collection: str):
-        self.db = lancedb.connect(dbfile)
-        self.collection = collection
-        self.agent = Agent(
-            model="gemini-2.0-flash", system_prompt=AGENT_SYSTEM_PROMPT()
-        )
+    def __init__(
+        self,
+        dbfile: str,
+        collection: str | list[str] | None = None,
+        cache: Optional[EmbeddingCache] = None,
+        client: Any = None,
+        nprobes: Optional[int] = None,
+        refine_factor: Optional[int] = None,
+        top_k: int = 5,
+        model: Any = "gemini-2.0-flash",
+        stream: bool = True,
+        answers: Optional[AnswerCache] = None,
+        context: Optional[ContextAssembler] = None,
+        router: Optional[CollectionRouter] = None,
+        hybrid: bool = False,
+    ):
+        """Chat agent answering from the collection, reusing the query
+        embeddings found in `cache`.
+
+        Given a list of collections, or None for all the collections of the
+        db, they are searched concurrently and their results merged by
+        their similarity to the query. With `router`, only the collections
+        whose content is close to the query are searched.
+
+        `nprobes` and `refine_factor` tune the search when the collection
+        has a vector index, and `top_k` chunks are given to the model.
+        With `stream`, the answers are printed as they are generated. The
+        answers to questions close to one in `answers` are not generated
+        again. With `context`, the chunks given to the model are assembled
+        from more candidates, up to its token budget, otherwise the `top_k`
+        ones are given as they are found. With `hybrid`, the
+        collections having a full text index are also searched lexically.
+        """
+        # the tables are opened once, and see the new versions of the
+        # collection as soon as they are written.
+        self.db = lancedb.connect(dbfile, read_consistency_interval=timedelta(0))
+        self.tables: dict[str, Any] = {}
+        self.tables_lock = threading.Lock()
+
+        if isinstance(collection, str):
+            collection = [collection]
+
+        self.collections = collection or [
+            name for name in self.db.table_names() if not name.endswith("__staging")
+        ]
+
+        if not self.collections:
+            raise Exception(f"No collection to search in {dbfile}")
+
+        # the scope of the cached answers.
+        self.collection = ",".join(self.collections)
+        self.embed_model = os.getenv("GEMINI_EMBED_MODEL_NAME", "text-embedding-004")
+        self.cache = cache
+        self.recent: OrderedDict[tuple[str, str], Any] = OrderedDict()
+        self.recent_lock = threading.Lock()
+        self.client = client
+        self.client_lock = threading.Lock()
+        self.nprobes = nprobes
+        self.refine_factor = refine_factor
+        self.top_k = top_k
+        self.stream = stream
+        self.answers = answers
+        self.context = context
+        self.router = router
+        self.hybrid = hybrid
+        self.agent = Agent(model=model, system_prompt=AGENT_SYSTEM_PROMPT())
         self.register_tools()
 
+    def _table(self, name: str) -> Any:
+        with self.tables_lock:
+            if name not in self.tables:
+                self.tables[name] = self.db.open_table(name)
+            return self.tables[name]
+
     def register_tools(self):
         @self.agent.tool_plain
-        def query_knowledge_base(query: str) -> str:
+        async def query_knowledge_base(query: str) -> str:
             """Query the knowledge base to find relevant information."""
-            return self.query_knowledge_base(query)
+            # off the event loop, the searches of one turn run concurrently.
+            return await asyncio.to_thread(self.query_knowledge_base, query)
 
-    def _embed_content(self, text: str):
-        GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-        GEMINI_EMBED_MODEL_NAME = os.getenv(
-            "GEMINI_EMBED_MODEL_NAME", "text-embedding-004"
-        )
+    def _embed_content(self, text: str, dimensions: Optional[int] = None):
+        # queries are embedded with the dimensions of the collection vectors.
+        model_key = embed_model_key(self.embed_model, dimensions)
 
-        if not GEMINI_API_KEY:
-            raise Exception("GEMINI_API_KEY env var must be defined")
+        if self.cache is not None:
+            vector = self.cache.get(model_key, text)
+        else:
+            with self.recent_lock:
+                vector = self.recent.get((model_key, text))
 
-        client = genai.Client(api_key=GEMINI_API_KEY)
+        if vector is not None:
+            metrics.count("query_cache_hits")
+            return vector
 
-        response = client.models.embed_content(
-            model=GEMINI_EMBED_MODEL_NAME,
+        with self.client_lock:
+            if self.client is None:
+                self.client = make_client()
+
+        response = self.client.models.embed_content(
+            model=self.embed_model,
             contents=text,
+            config=embed_config(dimensions),
         )
 
         if not response.embeddings:
             raise Exception("Unable to embed content")
 
-        return response.embeddings[0].values
+        vector = embedding_values(response.embeddings[0], dimensions)
+
+        if self.cache is not None:
+            self.cache.put(model_key, text, vector)
+        else:
+            with self.recent_lock:
+                self.recent[(model_key, text)] = vector
+                while len(self.recent) > RECENT_EMBEDDINGS:
+                    self.recent.popitem(last=False)
+
+        return vector
+
+    def search(
+        self, query: str, limit: Optional[int] = None, depth: Optional[int] = None
+    ) -> list[dict]:
+        """The chunks closest to the query, `top_k` of them by default.
+
+        The hybrid search fuses rankings of `depth` chunks, twice `limit` by
+        default. The chunks found across collections come with their
+        `collection` and `score`.
+        """
+        with metrics.timer("search_seconds"):
+            return self._search(query, limit or self.top_k, depth)
+
+    def _search(self, query: str, limit: int, depth: Optional[int]) -> list[dict]:
+        embeddings: dict[int, Any] = {}
+        embeddings_lock = threading.Lock()
+
+        def embed(dimensions: int) -> Any:
+            # the query is embedded once for all the collections of a size,
+            # the searches of the other ones wait for it.
+            with embeddings_lock:
+                if dimensions not in embeddings:
+                    embeddings[dimensions] = self._embed_content(query, dimensions)
+                return embeddings[dimensions]
+
+        if len(self.collections) == 1:
+            name = self.collections[0]
+            rows, _ = self._search_collection(name, query, embed, limit, depth)
+            return rows
+
+        names = self.collections
+
+        if self.router is not None:
+            names = self.router.route(self.db, names, embed)
+            metrics.count("collections_skipped", len(self.collections) - len(names))
+
+        with ThreadPoolExecutor(max_workers=len(names)) as pool:
+            searches = {
+                name: pool.submit(
+                    self._search_collection, name, query, embed, limit, depth
+                )
+                for name in names
+            }
+            rankings = []
+
+            for name, search in searches.items():
+                rows, metric = search.result()
+                rows = [{**row, "collection": name} for row in rows]
+                rankings.append((rows, similarities(rows, metric)))
+
+        return merge_by_score(rankings, limit)
+
+    def _search_collection(
+        self,
+        name: str,
+        query: str,
+        embed: Callable[[int], Any],
+        limit: int,
+        depth: Optional[int],
+    ) -> tuple[list[dict], Optional[str]]:
+        """The chunks of the collection closest to the query, and the metric
+        of their distances.
+        """
+        tbl = self._table(name)
+        embedding = embed(vector_dimensions(tbl))
+
+        # query with the metric the index was built for, if any.
+        stats = vector_index(tbl)
+        metric = stats.distance_type if stats else None
+
+        # exact api names are found by the full text index, when there is one.
+        if self.hybrid and has_fts_index(tbl):
+            rows = hybrid_search(
+                tbl,
+                embedding,
+                query,
+                limit,
+                metric=metric,
+                nprobes=self.nprobes,
+                refine_factor=self.refine_factor,
+                depth=depth,
+            )
+        else:
+            rows = nearest(
+                tbl,
+                embedding,
+                limit,
+                metric=metric,
+                nprobes=self.nprobes,
+                refine_factor=self.refine_factor,
+            )
+
+        return rows, metric
 
     def query_knowledge_base(self, query: str) -> str:
         print(f"[TOOL] Searching knowledge base for: {query}")
-        embedding = self._embed_content(query)
 
-        tbl = self.db.open_table(self.collection)
+        if self.context is None:
+            return format_context(to_passages(self.search(query)))
+
+        # the candidates come in the order the top_k chunks would.
+        results = self.search(
+            query, self.context.candidates(self.top_k), depth=2 * self.top_k
+        )
+
+        return format_context(self.context.assemble(results, self.top_k))
+
+    def _cached_answer(
+        self, question: str
+    ) -> tuple[tuple[int, ...], Any, Optional[str]]:
+        """The versions of the collections, the question embedding and the
+        cached answer, if any. A question asked again as it is is not
+        embedded.
+        """
+        # answers are only valid for the versions of the tables they come
+        # from, a recreated table starts its versions over.
+        tables = [self._table(name) for name in self.collections]
+        version = tuple(tbl.version for tbl in tables)
+        cached = self.answers.find(self.collection, version, question)
+
+        if cached is not None:
+            return version, None, cached
+
+        # kept for the search of the question, when the answer is generated.
+        vector = self._embed_content(question, vector_dimensions(tables[0]))
+
+        return version, vector, self.answers.get(self.collection, version, vector)
+
+    async def stream_answer(self, question: str) -> AsyncIterator[str]:
+        """The answer to the question, piece by piece as it is generated."""
+        if self.answers is not None:
+            version, vector, cached = await asyncio.to_thread(
+                self._cached_answer, question
+            )
+
+            if cached is not None:
+                metrics.count("answer_cache_hits")
+                yield cached
+                return
+
+        parts = []
 
-        results = tbl.search(embedding).limit(5).to_list()
+        async with self.agent.run_stream(question) as result:
+            async for delta in result.stream_text(delta=True):
+                parts.append(delta)
+                yield delta
 
-        context = ""
-        for r in results:
-            context += f"Source URL: {r['url']}\n"
-            context += f"Content: {r['text']}\n"
-            if r["code"]:
-                context += f"Code Example:\n```\n{r['code']}\n```\n"
-            context += "---\n"
+        # only complete answers are cached.
+        if self.answers is not None:
+            answer = "".join(parts)
+            self.answers.put(self.collection, version, vector, answer, question)
 
-        return context
+    async def answer(self, question: str) -> str:
+        if self.answers is not None:
+            version, vector, cached = await asyncio.to_thread(
+                self._cached_answer, question
+            )
+
+            if cached is not None:
+                metrics.count("answer_cache_hits")
+                return cached
+
+        result = await self.agent.run(question)
+
+        if self.answers is not None:
+            self.answers.put(
+                self.collection, version, vector, result.output, question
+            )
+
+        return result.output
+
+    async def _answer(self, question: str) -> None:
+        if not self.stream:
+            print(await self.answer(question))
+            return
+
+        async for delta in self.stream_answer(question):
+            print(delta, end="", flush=True)
+        print()
 
     def run(self):
         """Run the chat loop"""
@@ -65,29 +339,29 @@ class RagAgent:
         print("Type '/quit' or '/exit' or '/q' to stop")
         print("-" * 40)
 
-        while True:
-            try:
-                user_input = input("\nYou: ").strip()
+        if self.router is not None and len(self.collections) > self.router.fanout:
+            self.router.warm(self.db, self.collections)
+            print(f"[INFO] Routing queries across {len(self.collections)} collections")
 
-                if user_input.lower() in ["/quit", "/exit", "/q"]:
-                    print("Goodbye!")
-                    break
+        # a single event loop for the whole chat, input stays blocking.
+        with asyncio.Runner() as runner:
+            while True:
+                try:
+                    user_input = input("\nYou: ").strip()
 
-                if not user_input:
-                    continue
+                    if user_input.lower() in ["/quit", "/exit", "/q"]:
+                        print("Goodbye!")
+                        break
+
+                    if not user_input:
+                        continue
 
-                print("\nAgent: ", end="")
-                result = self.agent.run_sync(user_input)
-
-                # Simple output - just print the response data
-                if hasattr(result, "data"):
-                    print(result.output)
-                else:
-                    print(result)
-
-            except KeyboardInterrupt:
-                print("\n\nGoodbye!")
-                break
-            except Exception as e:
-                print(f"\nError: {e}")
-                continue
+                    print("\nAgent: ", end="", flush=True)
+                    runner.run(self._answer(user_input))
+
+                except KeyboardInterrupt:
+                    print("\n\nGoodbye!")
+                    break
+                except Exception as e:
+                    print(f"\nError: {e}")
+                    continue
@@ -0,0 +1,1221 @@
+import re
+import asyncio
+import json
+import time
+import random
+import argparse
+import resource
+import subprocess
+import sys
+import tempfile
+import contextlib
+import lancedb
+import numpy as np
+import pyarrow as pa
+from pathlib import Path
+from typing import Any, Callable, Optional
+from pydantic_ai.messages import (
+    ModelMessage,
+    ModelResponse,
+    TextPart,
+    ToolCallPart,
+    ToolReturnPart,
+    UserPromptPart,
+)
+from pydantic_ai.models.function import AgentInfo, FunctionModel
+from pydantic_ai.models.test import TestModel
+from rag_url.fixtures import (
+    FakeGenaiClient,
+    SyntheticSite,
+    synthetic_markdown,
+    synthetic_vectors,
+)
+from rag_url.agent import RagAgent
+from rag_url.scrape import BaseUrlScraper
+from rag_url.chunk import MarkdownChunker
+from rag_url.embed import ChunkEmbedder
+from rag_url.cache import AnswerCache, ChunkCache, EmbeddingCache
+from rag_url.context import ContextAssembler
+from rag_url.pipeline import BuildPipeline
+from rag_url.router import CollectionRouter
+from rag_url.split import estimate_tokens
+from rag_url.store import STORE_FILENAME, ChunkStore
+from rag_url.index import VECTOR_TYPES, build_index, nearest, search
+
+# Benchmarks running the pipeline stages against the local stand-ins.
+# python -m rag_url.bench scrape --pages 500 --latency 0.05 --concurrency 1 8 32
+# python -m rag_url.bench chunk --files 100 --latency 0.5 --error-rate 0.05
+# python -m rag_url.bench embed --files 200 --latency 0.1 --batch-size 1 100
+# python -m rag_url.bench index --rows 200000 --nprobes 5 20 50 --refine-factor 5
+# python -m rag_url.bench compact --rows 100000 --dimensions 768 256 128
+# python -m rag_url.bench search --files 200 --queries 200 --k 5
+# python -m rag_url.bench build --pages 200 --latency 0.02 --llm-latency 0.2
+# python -m rag_url.bench startup --budget 150
+# python -m rag_url.bench store --files 20000
+# python -m rag_url.bench context --files 200 --budgets 500 1000 1250 2000
+# python -m rag_url.bench federated --collections 2 8 32 --fanout 4
+# python -m rag_url.bench answers --queries 100 --latency 0.05
+
+
+def _max_rss_mb() -> float:
+    # peak resident memory of the process so far, in kilobytes on linux.
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def _timed(function: Callable, latencies: list[float]) -> Callable:
+    """`function`, adding the seconds of each of its calls to `latencies`."""
+
+    def timed(*args: Any) -> Any:
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    return timed
+
+
+def _percentiles(latencies: list[float]) -> dict:
+    if not latencies:
+        return {"p50_ms": None, "p95_ms": None}
+
+    return {
+        "p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 2),
+        "p95_ms": round(float(np.percentile(latencies, 95)) * 1000, 2),
+    }
+
+
+def bench_scrape(
+    pages: int, latency: float, concurrencies: list[int], rate: float
+) -> list[dict]:
+    results = []
+    reference: set[str] | None = None
+
+    with SyntheticSite(pages=pages, latency=latency) as site:
+        for concurrency in concurrencies:
+            with tempfile.TemporaryDirectory() as workdir:
+                scraper = BaseUrlScraper(
+                    workdir, site.url, rate=rate, concurrency=concurrency
+                )
+
+                num_requests = site.requests
+                start = time.perf_counter()
+                scraper.run()
+                elapsed = time.perf_counter() - start
+                num_requests = site.requests - num_requests
+                latencies = scraper.timer.latencies
+
+                files = {p.name for p in Path(workdir).glob("*.md")}
+
+                # scrape again, every page should be revalidated as unchanged.
+                num_rescrape_requests = site.requests
+                start = time.perf_counter()
+                scraper.run()
+                rescrape_elapsed = time.perf_counter() - start
+                num_rescrape_requests = site.requests - num_rescrape_requests
+
+            # every configuration must produce the same set of files.
+            if reference is None:
+                reference = files
+
+            results.append(
+                {
+                    "concurrency": concurrency,
+                    "pages": len(files),
+                    "requests": num_requests,
+                    "seconds": round(elapsed, 3),
+                    "pages_per_second": round(len(files) / elapsed, 1),
+                    # time spent on each page, from its fetch to its write.
+                    **_percentiles(latencies),
+                    "rescrape_seconds": round(rescrape_elapsed, 3),
+                    "rescrape_requests": num_rescrape_requests,
+                    "same_output": files == reference,
+                    "max_rss_mb": _max_rss_mb(),
+                }
+            )
+
+    return results
+
+
+def bench_chunk(
+    files: int, latency: float, error_rate: float, concurrencies: list[int]
+) -> list[dict]:
+    results = []
+
+    for concurrency in concurrencies:
+        with tempfile.TemporaryDirectory() as workdir:
+            for i in range(files):
+                (Path(workdir) / f"page-{i}.md").write_text(
+                    synthetic_markdown(i), encoding="utf-8"
+                )
+
+            client = FakeGenaiClient(latency=latency, error_rate=error_rate)
+            cache = ChunkCache(Path(workdir) / "cache" / "chunks.sqlite")
+            chunker = MarkdownChunker(
+                workdir, concurrency=concurrency, retries=5, client=client, cache=cache
+            )
+            # keep the pauses in scale with the fake latency.
+            chunker.limiter.min_delay = chunker.limiter.delay = max(latency, 0.01)
+            # time spent on each file, retries and their pauses included.
+            latencies: list[float] = []
+            chunker.chunk_file = _timed(chunker.chunk_file, latencies)
+
+            start = time.perf_counter()
+            _, produced = chunker.run()
+            elapsed = time.perf_counter() - start
+            num_calls = client.calls
+            # the calls of the cached run are not counted.
+            latencies = latencies.copy()
+
+            # chunk again from scratch, every page should come from the cache.
+            for filepath in Path(workdir).glob("*.json"):
+                filepath.unlink()
+
+            start = time.perf_counter()
+            chunker.run()
+            rechunk_elapsed = time.perf_counter() - start
+            cache.close()
+
+        results.append(
+            {
+                "concurrency": concurrency,
+                "files": files,
+                "chunked": produced,
+                "seconds": round(elapsed, 3),
+                "files_per_second": round(files / elapsed, 1),
+                **_percentiles(latencies),
+                "llm_calls": num_calls,
+                "throttled": client.errors,
+                "rechunk_seconds": round(rechunk_elapsed, 3),
+                "rechunk_llm_calls": client.calls - num_calls,
+                "max_rss_mb": _max_rss_mb(),
+            }
+        )
+
+    return results
+
+
+def bench_embed(
+    files: int,
+    latency: float,
+    error_rate: float,
+    batch_sizes: list[int],
+    concurrency: int,
+) -> list[dict]:
+    results = []
+
+    with tempfile.TemporaryDirectory() as workdir:
+        for i in range(files):
+            (Path(workdir) / f"page-{i}.md").write_text(
+                synthetic_markdown(i), encoding="utf-8"
+            )
+
+        # the pages are well structured, chunk them without the llm.
+        MarkdownChunker(workdir, local=True).run()
+
+        for batch_size in batch_sizes:
+            client = FakeGenaiClient(latency=latency, error_rate=error_rate)
+
+            # the embedder globs relative to the working directory.
+            with contextlib.chdir(workdir):
+                embedder = ChunkEmbedder(
+                    f"lancedb-{batch_size}",
+                    "*.json",
+                    batch_size=batch_size,
+                    concurrency=concurrency,
+                    retries=5,
+                    client=client,
+                )
+                embedder.limiter.min_delay = max(latency, 0.01)
+                embedder.limiter.delay = embedder.limiter.min_delay
+                # time spent on each call to the api, a batch of chunks.
+                latencies: list[float] = []
+                embedder._embed_batch = _timed(embedder._embed_batch, latencies)
+
+                start = time.perf_counter()
+                embedder.run()
+                elapsed = time.perf_counter() - start
+
+                rows = embedder.db.open_table(embedder.collection).count_rows()
+                num_calls = client.calls
+
+                # embed again, every chunk is already in the collection.
+                start = time.perf_counter()
+                embedder.run()
+                reembed_elapsed = time.perf_counter() - start
+
+            results.append(
+                {
+                    "batch_size": batch_size,
+                    "concurrency": concurrency,
+                    "chunks": rows,
+                    "seconds": round(elapsed, 3),
+                    "chunks_per_second": round(rows / elapsed, 1),
+                    **_percentiles(latencies),
+                    "api_calls": num_calls,
+                    "throttled": client.errors,
+                    "reembed_seconds": round(reembed_elapsed, 3),
+                    "reembed_api_calls": client.calls - num_calls,
+                    "max_rss_mb": _max_rss_mb(),
+                }
+            )
+
+    return results
+
+
+def _search_quality(
+    table, queries: np.ndarray, truth: np.ndarray, **options
+) -> dict:
+    k = truth.shape[1]
+    latencies = []
+    found = 0
+
+    for query, expected in zip(queries, truth):
+        start = time.perf_counter()
+        rows = search(table, query, k, metric="cosine", **options).select(["id"])
+        ids = rows.to_arrow().column("id").to_pylist()
+        latencies.append(time.perf_counter() - start)
+        found += len(set(ids) & set(expected.tolist()))
+
+    return {
+        "recall": round(found / truth.size, 3),
+        "mean_ms": round(float(np.mean(latencies)) * 1000, 2),
+        "p95_ms": round(float(np.percentile(latencies, 95)) * 1000, 2),
+    }
+
+
+def bench_index(
+    rows: int,
+    dimensions: int,
+    num_queries: int,
+    k: int,
+    index_types: list[str],
+    nprobes: list[int],
+    refine_factor: int | None,
+) -> list[dict]:
+    vectors = synthetic_vectors(rows, dimensions)
+
+    # queries close to, but not at, points of the corpus.
+    rng = np.random.default_rng(1)
+    queries = vectors[rng.choice(rows, num_queries, replace=False)]
+    queries = queries + 0.1 * rng.standard_normal(queries.shape, dtype=np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    truth = np.argsort(-(queries @ vectors.T), axis=1)[:, :k]
+
+    results = []
+
+    with tempfile.TemporaryDirectory() as workdir:
+        data = pa.table(
+            {
+                "id": pa.array(np.arange(rows)),
+                "vector": pa.FixedSizeListArray.from_arrays(
+                    vectors.reshape(-1), dimensions
+                ),
+            }
+        )
+        table = lancedb.connect(workdir).create_table("bench", data=data)
+
+        quality = _search_quality(table, queries, truth)
+        results.append(
+            {
+                "index": "flat",
+                "build_seconds": 0,
+                **quality,
+                "max_rss_mb": _max_rss_mb(),
+            }
+        )
+
+        for index_type in index_types:
+            start = time.perf_counter()
+            build_index(table, index_type, "cosine")
+            elapsed = time.perf_counter() - start
+
+            for probes in nprobes:
+                quality = _search_quality(
+                    table,
+                    queries,
+                    truth,
+                    nprobes=probes,
+                    refine_factor=refine_factor,
+                )
+                results.append(
+                    {
+                        "index": index_type,
+                        "nprobes": probes,
+                        "refine_factor": refine_factor,
+                        "build_seconds": round(elapsed, 3),
+                        **quality,
+                        "max_rss_mb": _max_rss_mb(),
+                    }
+                )
+
+    return results
+
+
+def _directory_size(path: Path) -> int:
+    return sum(f.stat().st_size for f in path.rglob("*") if f.is_file())
+
+
+def bench_compact(
+    rows: int,
+    dimensions: list[int],
+    vector_types: list[str],
+    num_queries: int,
+    k: int,
+) -> list[dict]:
+    """Size and recall@k of the vectors stored truncated and at a lower
+    precision, with and without re-ranking on float32 copies, against the
+    exact neighbours of the full float32 vectors.
+    """
+    vectors = synthetic_vectors(rows, max(dimensions))
+
+    rng = np.random.default_rng(1)
+    queries = vectors[rng.choice(rows, num_queries, replace=False)]
+    queries = queries + 0.1 * rng.standard_normal(queries.shape, dtype=np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    truth = np.argsort(-(queries @ vectors.T), axis=1)[:, :k]
+
+    results = []
+
+    with tempfile.TemporaryDirectory() as workdir:
+        db = lancedb.connect(workdir)
+
+        for size in dimensions:
+            # like the model, keep the first dimensions and normalize again.
+            truncated = vectors[:, :size] / np.linalg.norm(
+                vectors[:, :size], axis=1, keepdims=True
+            )
+            truncated_queries = queries[:, :size]
+
+            for vector_type in vector_types:
+                for full in [False] if vector_type == "float32" else [False, True]:
+                    name = f"{size}-{vector_type}-{full}"
+                    compact = truncated.astype(VECTOR_TYPES[vector_type])
+                    columns = {
+                        "id": pa.array(np.arange(rows)),
+                        "vector": pa.FixedSizeListArray.from_arrays(
+                            compact.reshape(-1), size
+                        ),
+                    }
+                    if full:
+                        columns["full_vector"] = pa.FixedSizeListArray.from_arrays(
+                            truncated.reshape(-1), size
+                        )
+                    table = db.create_table(name, data=pa.table(columns))
+
+                    latencies = []
+                    found = 0
+
+                    for query, expected in zip(truncated_queries, truth):
+                        start = time.perf_counter()
+                        ids = [row["id"] for row in nearest(table, query, k, "cosine")]
+                        latencies.append(time.perf_counter() - start)
+                        found += len(set(ids) & set(expected.tolist()))
+
+                    # the column scanned by the searches.
+                    searched = table.search().select(["vector"]).limit(None)
+
+                    results.append(
+                        {
+                            "dimensions": size,
+                            "vector_type": vector_type,
+                            "full_vectors": full,
+                            "disk_mb": round(
+                                _directory_size(Path(workdir) / f"{name}.lance")
+                                / 2**20,
+                                2,
+                            ),
+                            "vector_mb": round(searched.to_arrow().nbytes / 2**20, 2),
+                            f"recall@{k}": round(found / truth.size, 3),
+                            "mean_ms": round(float(np.mean(latencies)) * 1000, 2),
+                            "max_rss_mb": _max_rss_mb(),
+                        }
+                    )
+
+    return results
+
+
+def _labelled_queries(
+    pattern: str, num_queries: int, words: int, noise: float, seed: int = 0
+) -> list[tuple[str, str]]:
+    """Queries made of words picked in a chunk, a share `noise` of them picked
+    in any chunk instead, with the text of that chunk.
+    """
+    chunks = []
+
+    for filepath in sorted(Path().glob(pattern)):
+        data = json.loads(filepath.read_text(encoding="utf-8"))
+        for item in data["chunks"]:
+            chunks.append("\n\n".join([f"#{item['title']}", item["content"]]))
+
+    rnd = random.Random(seed)
+    vocabulary = sorted({term for text in chunks for term in re.findall(r"\w+", text)})
+    queries = []
+
+    for text in rnd.sample(chunks, min(num_queries, len(chunks))):
+        terms = re.findall(r"\w+", text.split("\n\n", 1)[1])
+        noisy = round(words * noise)
+        picked = rnd.sample(terms, min(words - noisy, len(terms)))
+        picked += rnd.sample(vocabulary, noisy)
+        rnd.shuffle(picked)
+        queries.append((" ".join(picked), text))
+
+    return queries
+
+
+def bench_search(
+    files: int,
+    num_queries: int,
+    k: int,
+    words: int,
+    noise: float,
+    vocabulary: int,
+    latency: float,
+) -> list[dict]:
+    """Retrieval quality and latency of the agent search on synthetic pages,
+    with the vector search alone and with the hybrid one.
+    """
+    results = []
+
+    with tempfile.TemporaryDirectory() as workdir:
+        for i in range(files):
+            (Path(workdir) / f"page-{i}.md").write_text(
+                synthetic_markdown(i, vocabulary=vocabulary), encoding="utf-8"
+            )
+
+        MarkdownChunker(workdir, local=True).run()
+
+        with contextlib.chdir(workdir):
+            queries = _labelled_queries("*.json", num_queries, words, noise)
+
+            for fts in [False, True]:
+                dbfile = f"lancedb-{'hybrid' if fts else 'vector'}"
+                embedder = ChunkEmbedder(
+                    dbfile, "*.json", client=FakeGenaiClient(), fts=fts
+                )
+                embedder.run()
+
+                client = FakeGenaiClient(latency=latency)
+                agent = RagAgent(
+                    dbfile, "collection", client=client, model=TestModel(), hybrid=fts
+                )
+
+                latencies = []
+                found = 0
+                reciprocal_ranks = 0.0
+
+                for query, expected in queries:
+                    start = time.perf_counter()
+                    rows = agent.search(query, k)
+                    latencies.append(time.perf_counter() - start)
+
+                    texts = [row["text"] for row in rows]
+                    if expected in texts:
+                        found += 1
+                        reciprocal_ranks += 1 / (texts.index(expected) + 1)
+
+                results.append(
+                    {
+                        "search": "hybrid" if fts else "vector",
+                        "chunks": agent.db.open_table("collection").count_rows(),
+                        "queries": len(queries),
+                        f"recall@{k}": round(found / len(queries), 3),
+                        "mrr": round(reciprocal_ranks / len(queries), 3),
+                        "p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 2),
+                        "p95_ms": round(float(np.percentile(latencies, 95)) * 1000, 2),
+                        "queries_per_second": round(len(queries) / sum(latencies), 1),
+                        "max_rss_mb": _max_rss_mb(),
+                    }
+                )
+
+    return results
+
+
+def bench_context(
+    files: int,
+    num_queries: int,
+    k: int,
+    budgets: list[int],
+    words: int,
+    noise: float,
+    vocabulary: int,
+) -> list[dict]:
+    """Size of the context given to the model and share of the queries whose
+    chunk it holds, with the top `k` chunks as they are found then assembled
+    to each token budget.
+    """
+    results = []
+
+    with tempfile.TemporaryDirectory() as workdir:
+        for i in range(files):
+            (Path(workdir) / f"page-{i}.md").write_text(
+                synthetic_markdown(i, vocabulary=vocabulary), encoding="utf-8"
+            )
+
+        MarkdownChunker(workdir, local=True).run()
+
+        with contextlib.chdir(workdir):
+            queries = _labelled_queries("*.json", num_queries, words, noise)
+            ChunkEmbedder("lancedb", "*.json", client=FakeGenaiClient()).run()
+
+            agent = RagAgent(
+                "lancedb", "collection", client=FakeGenaiClient(), model=TestModel(), top_k=k
+            )
+
+            for budget in [None] + budgets:
+                agent.context = None if budget is None else ContextAssembler(budget)
+                latencies = []
+                tokens = []
+                found = 0
+
+                for query, expected in queries:
+                    start = time.perf_counter()
+                    with contextlib.redirect_stdout(None):
+                        context = agent.query_knowledge_base(query)
+                    latencies.append(time.perf_counter() - start)
+
+                    tokens.append(estimate_tokens(context))
+                    found += expected in context
+
+                results.append(
+                    {
+                        "context": "top_k" if budget is None else "assembled",
+                        "budget": budget or "-",
+                        "queries": len(queries),
+                        "hit_rate": round(found / len(queries), 3),
+                        "mean_tokens": round(float(np.mean(tokens)), 1),
+                        "max_tokens": max(tokens),
+                        "p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 2),
+                        "p95_ms": round(float(np.percentile(latencies, 95)) * 1000, 2),
+                        "max_rss_mb": _max_rss_mb(),
+                    }
+                )
+
+    return results
+
+
+def bench_federated(
+    collections: list[int],
+    files: int,
+    num_queries: int,
+    k: int,
+    fanout: int,
+    words: int,
+    noise: float,
+    vocabulary: int,
+    latency: float,
+) -> list[dict]:
+    """Latency and recall of the agent search across collections of sites
+    on different topics, searching all of them then the `fanout` ones the
+    router picks.
+    """
+    results = []
+    rnd = random.Random(0)
+
+    with tempfile.TemporaryDirectory() as root:
+        dbfile = str(Path(root) / "lancedb")
+        names: list[str] = []
+        labelled: list[tuple[str, str]] = []
+
+        for count in sorted(collections):
+            # the collections of the smaller runs are kept for the larger ones.
+            while len(names) < count:
+                site = len(names)
+                workdir = Path(root) / f"site-{site}"
+                workdir.mkdir()
+
+                for i in range(files):
+                    (workdir / f"page-{i}.md").write_text(
+                        synthetic_markdown(
+                            i, seed=site, vocabulary=vocabulary, terms=f"site{site}x"
+                        ),
+                        encoding="utf-8",
+                    )
+
+                MarkdownChunker(str(workdir), local=True).run()
+
+                with contextlib.chdir(workdir):
+                    ChunkEmbedder(
+                        dbfile, "*.json", f"site_{site}", client=FakeGenaiClient()
+                    ).run()
+                    labelled += _labelled_queries(
+                        "*.json", num_queries, words, noise, seed=site
+                    )
+
+                names.append(f"site_{site}")
+
+            queries = rnd.sample(labelled, min(num_queries, len(labelled)))
+
+            for router in [None, CollectionRouter(fanout)]:
+                client = FakeGenaiClient(latency=latency)
+                agent = RagAgent(
+                    dbfile, names, client=client, model=TestModel(), router=router
+                )
+
+                start = time.perf_counter()
+                if router is not None:
+                    router.warm(agent.db, names)
+                summarized = time.perf_counter() - start
+
+                latencies = []
+                found = 0
+
+                for query, expected in queries:
+                    start = time.perf_counter()
+                    rows = agent.search(query, k)
+                    latencies.append(time.perf_counter() - start)
+
+                    found += expected in [row["text"] for row in rows]
+
+                results.append(
+                    {
+                        "collections": count,
+                        "search": "all" if router is None else "routed",
+                        "searched": count if router is None else min(fanout, count),
+                        "queries": len(queries),
+                        f"recall@{k}": round(found / len(queries), 3),
+                        "p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 2),
+                        "p95_ms": round(float(np.percentile(latencies, 95)) * 1000, 2),
+                        "summary_seconds": round(summarized, 2),
+                        "max_rss_mb": _max_rss_mb(),
+                    }
+                )
+
+    return results
+
+
+def bench_answers(files: int, num_queries: int, latency: float) -> list[dict]:
+    """Latency and API calls of the agent answers with the answer cache, for
+    questions asked a first time, asked again as they are and reworded, with
+    and without the embedding cache.
+    """
+    results = []
+    generated = 0
+
+    def respond(messages: list[ModelMessage], info: AgentInfo) -> ModelResponse:
+        # searches the question as it is asked, then answers with the context.
+        nonlocal generated
+        parts = messages[-1].parts
+        returned = [part for part in parts if isinstance(part, ToolReturnPart)]
+
+        if returned:
+            return ModelResponse(parts=[TextPart(str(returned[0].content)[:200])])
+
+        generated += 1
+        question = next(part for part in parts if isinstance(part, UserPromptPart))
+
+        return ModelResponse(
+            parts=[ToolCallPart("query_knowledge_base", {"query": question.content})]
+        )
+
+    with tempfile.TemporaryDirectory() as workdir:
+        for i in range(files):
+            (Path(workdir) / f"page-{i}.md").write_text(
+                synthetic_markdown(i), encoding="utf-8"
+            )
+
+        MarkdownChunker(workdir, local=True).run()
+
+        with contextlib.chdir(workdir):
+            labelled = _labelled_queries("*.json", num_queries, 8, 0.5)
+            questions = [query for query, _ in labelled]
+            ChunkEmbedder("lancedb", "*.json", client=FakeGenaiClient()).run()
+
+            for cached in [False, True]:
+                client = FakeGenaiClient(latency=latency)
+                cache = (
+                    EmbeddingCache(Path(workdir) / "embeddings.sqlite")
+                    if cached
+                    else None
+                )
+                agent = RagAgent(
+                    "lancedb",
+                    "collection",
+                    cache=cache,
+                    client=client,
+                    model=FunctionModel(respond),
+                    answers=AnswerCache(),
+                )
+
+                phases = [
+                    ("first", questions),
+                    ("again", questions),
+                    ("reworded", [f"{question}?" for question in questions]),
+                ]
+
+                for phase, asked in phases:
+                    calls = client.calls
+                    generated = 0
+                    latencies = []
+
+                    for question in asked:
+                        start = time.perf_counter()
+                        with contextlib.redirect_stdout(None):
+                            asyncio.run(agent.answer(question))
+                        latencies.append(time.perf_counter() - start)
+
+                    results.append(
+                        {
+                            "embedding_cache": cached,
+                            "questions": phase,
+                            "queries": len(asked),
+                            "hit_rate": round(1 - generated / len(asked), 3),
+                            "api_calls": client.calls - calls,
+                            "p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 2),
+                            "p95_ms": round(float(np.percentile(latencies, 95)) * 1000, 2),
+                            "max_rss_mb": _max_rss_mb(),
+                        }
+                    )
+
+                if cache is not None:
+                    cache.close()
+
+    return results
+
+
+def bench_build(
+    pages: int, latency: float, llm_latency: float, embed_latency: float
+) -> list[dict]:
+    """Build a collection from the synthetic site, with the three commands one
+    after the other, then with the pipeline.
+    """
+    results = []
+
+    with SyntheticSite(pages=pages, latency=latency) as site:
+        for mode in ("sequential", "pipeline"):
+            with tempfile.TemporaryDirectory() as tmpdir:
+                workdir = Path(tmpdir) / "pages"
+                workdir.mkdir()
+                llm = FakeGenaiClient(latency=llm_latency)
+                api = FakeGenaiClient(latency=embed_latency)
+
+                scraper = BaseUrlScraper(str(workdir), site.url, rate=0)
+                chunker = MarkdownChunker(
+                    str(workdir),
+                    client=llm,
+                    cache=ChunkCache(Path(tmpdir) / "cache" / "chunks.sqlite"),
+                )
+                embedder = ChunkEmbedder(
+                    str(Path(tmpdir) / "lancedb"),
+                    str(workdir.relative_to(tmpdir) / "*.json"),
+                    client=api,
+                    cache=EmbeddingCache(Path(tmpdir) / "cache" / "embeddings.sqlite"),
+                )
+                for limiter in (chunker.limiter, embedder.limiter):
+                    limiter.min_delay = limiter.delay = 0.01
+
+                # the embedder globs relative to the working directory.
+                with contextlib.chdir(tmpdir):
+                    start = time.perf_counter()
+                    if mode == "sequential":
+                        scraper.run()
+                        chunker.run()
+                        embedder.run()
+                    else:
+                        BuildPipeline(scraper, chunker, embedder).run()
+                    elapsed = time.perf_counter() - start
+
+                    rows = embedder.db.open_table(embedder.collection).count_rows()
+
+                chunker.cache.close()
+                embedder.cache.close()
+
+            results.append(
+                {
+                    "mode": mode,
+                    "pages": pages,
+                    "chunks": rows,
+                    "seconds": round(elapsed, 3),
+                    "pages_per_second": round(pages / elapsed, 1),
+                    "llm_calls": llm.calls,
+                    "api_calls": api.calls,
+                    "max_rss_mb": _max_rss_mb(),
+                }
+            )
+
+    return results
+
+
+def bench_store(files: int) -> list[dict]:
+    """Chunk synthetic pages into json files then into a chunk store, and
+    read them back as the embedder does.
+    """
+    results = []
+
+    with tempfile.TemporaryDirectory() as workdir:
+        for i in range(files):
+            (Path(workdir) / f"page-{i}.md").write_text(
+                synthetic_markdown(i), encoding="utf-8"
+            )
+
+        for mode in ("json", "store"):
+            store = ChunkStore(Path(workdir) / STORE_FILENAME) if mode == "store" else None
+            chunker = MarkdownChunker(workdir, local=True, store=store)
+
+            # the pages are well structured, chunk them without the llm.
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(None):
+                chunker.run()
+            write_elapsed = time.perf_counter() - start
+
+            # the embedder globs relative to the working directory.
+            with contextlib.chdir(workdir):
+                embedder = ChunkEmbedder("lancedb", "*.json", store=store)
+
+                start = time.perf_counter()
+                chunks = sum(len(chunks) for _, _, chunks in embedder._read_pages())
+                read_elapsed = time.perf_counter() - start
+
+            if store is None:
+                paths = list(Path(workdir).glob("*.json"))
+            else:
+                store.close()
+                paths = list(Path(workdir).glob(f"{STORE_FILENAME}*"))
+
+            results.append(
+                {
+                    "format": mode,
+                    "pages": files,
+                    "chunks": chunks,
+                    "files": len(paths),
+                    "size_mb": round(sum(p.stat().st_size for p in paths) / 2**20, 1),
+                    # small files take a whole block each.
+                    "disk_mb": round(
+                        sum(p.stat().st_blocks * 512 for p in paths) / 2**20, 1
+                    ),
+                    "write_seconds": round(write_elapsed, 3),
+                    "read_seconds": round(read_elapsed, 3),
+                    "max_rss_mb": _max_rss_mb(),
+                }
+            )
+
+    return results
+
+
+# The command line, run by the startup benchmark.
+MAIN = Path(__file__).resolve().parent.parent / "main.py"
+
+
+def _import_times(stderr: str) -> dict[str, int]:
+    """Cumulative microseconds of the top level imports, from the output of
+    python -X importtime.
+    """
+    times = {}
+
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+
+        _, cumulative, name = line.split("|")
+        # nested imports are indented, and counted by their parent.
+        if name.startswith(" ") and not name.startswith("  ") and name.strip():
+            try:
+                times[name.strip()] = int(cumulative)
+            except ValueError:
+                continue
+
+    return times
+
+
+def bench_startup(commands: list[str], runs: int, budget: float) -> list[dict]:
+    """Time the imports of the command line until it prints its help, the best
+    of `runs` runs, against a budget in milliseconds.
+    """
+    results = []
+
+    for command in commands:
+        argv = [sys.executable, "-X", "importtime", str(MAIN), *command.split(), "--help"]
+        imports_ms, wall_ms, slowest = float("inf"), float("inf"), ""
+
+        for _ in range(runs):
+            start = time.perf_counter()
+            process = subprocess.run(argv, capture_output=True, text=True)
+            elapsed = time.perf_counter() - start
+
+            if process.returncode != 0:
+                raise Exception(f"'{command} --help' failed: {process.stderr}")
+
+            times = _import_times(process.stderr)
+            total = sum(times.values()) / 1000
+
+            if total < imports_ms:
+                imports_ms = total
+                slowest = max(times, key=times.get)
+            wall_ms = min(wall_ms, elapsed * 1000)
+
+        results.append(
+            {
+                "command": command or "-",
+                "imports_ms": round(imports_ms, 1),
+                "wall_ms": round(wall_ms, 1),
+                "slowest_import": slowest,
+                "budget_ms": budget,
+                "within_budget": imports_ms <= budget,
+            }
+        )
+
+    return results
+
+
+def main(argv: Optional[list[str]] = None):
+    parser = argparse.ArgumentParser(prog="rag url bench")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    scrape_parser = subparsers.add_parser("scrape", help="Benchmark the scraper")
+    scrape_parser.add_argument("--pages", type=int, default=200)
+    scrape_parser.add_argument(
+        "--latency", type=float, default=0.02, help="Server latency (in seconds)"
+    )
+    scrape_parser.add_argument(
+        "--concurrency", type=int, nargs="+", default=[1, 8, 32]
+    )
+    scrape_parser.add_argument(
+        "--rate", type=float, default=0, help="Requests per second (0 = no limit)"
+    )
+
+    chunk_parser = subparsers.add_parser("chunk", help="Benchmark the chunker")
+    chunk_parser.add_argument("--files", type=int, default=50)
+    chunk_parser.add_argument(
+        "--latency", type=float, default=0.2, help="LLM latency (in seconds)"
+    )
+    chunk_parser.add_argument(
+        "--error-rate", type=float, default=0.0, help="Share of calls throttled"
+    )
+    chunk_parser.add_argument(
+        "--concurrency", type=int, nargs="+", default=[1, 4, 16]
+    )
+
+    embed_parser = subparsers.add_parser("embed", help="Benchmark the embedder")
+    embed_parser.add_argument("--files", type=int, default=200)
+    embed_parser.add_argument(
+        "--latency", type=float, default=0.1, help="API latency (in seconds)"
+    )
+    embed_parser.add_argument(
+        "--error-rate", type=float, default=0.0, help="Share of calls throttled"
+    )
+    embed_parser.add_argument(
+        "--batch-size", type=int, nargs="+", default=[1, 20, 100]
+    )
+    embed_parser.add_argument("--concurrency", type=int, default=4)
+
+    index_parser = subparsers.add_parser(
+        "index", help="Benchmark indexed against flat vector search"
+    )
+    index_parser.add_argument("--rows", type=int, default=100_000)
+    index_parser.add_argument("--dimensions", type=int, default=768)
+    index_parser.add_argument("--queries", type=int, default=100)
+    index_parser.add_argument("--k", type=int, default=10)
+    index_parser.add_argument(
+        "--index", type=str, nargs="+", default=["ivf_pq", "hnsw"]
+    )
+    index_parser.add_argument("--nprobes", type=int, nargs="+", default=[5, 20, 50])
+    index_parser.add_argument("--refine-factor", type=int, default=None)
+
+    compact_parser = subparsers.add_parser(
+        "compact", help="Benchmark truncated and lower precision vectors"
+    )
+    compact_parser.add_argument("--rows", type=int, default=100_000)
+    compact_parser.add_argument(
+        "--dimensions", type=int, nargs="+", default=[768, 256, 128]
+    )
+    compact_parser.add_argument(
+        "--vector-type", type=str, nargs="+", default=list(VECTOR_TYPES)
+    )
+    compact_parser.add_argument("--queries", type=int, default=100)
+    compact_parser.add_argument("--k", type=int, default=5)
+
+    search_parser = subparsers.add_parser(
+        "search", help="Benchmark the agent search on labelled queries"
+    )
+    search_parser.add_argument("--files", type=int, default=200)
+    search_parser.add_argument("--queries", type=int, default=200)
+    search_parser.add_argument("--k", type=int, default=5)
+    search_parser.add_argument(
+        "--words", type=int, default=8, help="Words of the chunk in each query"
+    )
+    search_parser.add_argument(
+        "--noise", type=float, default=0.5, help="Share of the words off topic"
+    )
+    search_parser.add_argument(
+        "--vocabulary", type=int, default=2000, help="Made up terms in the pages"
+    )
+    search_parser.add_argument(
+        "--latency", type=float, default=0.0, help="API latency (in seconds)"
+    )
+
+    build_parser = subparsers.add_parser(
+        "build", help="Benchmark the pipelined build against the three commands"
+    )
+    build_parser.add_argument("--pages", type=int, default=100)
+    build_parser.add_argument(
+        "--latency", type=float, default=0.02, help="Site latency (in seconds)"
+    )
+    build_parser.add_argument(
+        "--llm-latency", type=float, default=0.2, help="LLM latency (in seconds)"
+    )
+    build_parser.add_argument(
+        "--embed-latency",
+        type=float,
+        default=0.1,
+        help="Embedding API latency (in seconds)",
+    )
+
+    startup_parser = subparsers.add_parser(
+        "startup", help="Check the import time of the command line against a budget"
+    )
+    startup_parser.add_argument(
+        "--commands",
+        type=str,
+        nargs="+",
+        default=["", "scrape", "chunk", "embed", "agent", "serve", "build"],
+    )
+    startup_parser.add_argument("--runs", type=int, default=5)
+    startup_parser.add_argument(
+        "--budget", type=float, default=150.0, help="Import time budget (in ms)"
+    )
+
+    store_parser = subparsers.add_parser(
+        "store", help="Benchmark the chunk store against the json files"
+    )
+    store_parser.add_argument("--files", type=int, default=5000)
+
+    context_parser = subparsers.add_parser(
+        "context", help="Benchmark the context assembly on labelled queries"
+    )
+    context_parser.add_argument("--files", type=int, default=200)
+    context_parser.add_argument("--queries", type=int, default=200)
+    context_parser.add_argument("--k", type=int, default=5)
+    context_parser.add_argument(
+        "--budgets", type=int, nargs="+", default=[500, 1000, 1250, 2000]
+    )
+    context_parser.add_argument(
+        "--words", type=int, default=8, help="Words of the chunk in each query"
+    )
+    context_parser.add_argument(
+        "--noise", type=float, default=0.5, help="Share of the words off topic"
+    )
+    context_parser.add_argument(
+        "--vocabulary", type=int, default=2000, help="Made up terms in the pages"
+    )
+
+    federated_parser = subparsers.add_parser(
+        "federated", help="Benchmark the search across collections, routed or not"
+    )
+    federated_parser.add_argument(
+        "--collections", type=int, nargs="+", default=[2, 8, 32]
+    )
+    federated_parser.add_argument(
+        "--files", type=int, default=20, help="Pages of each collection"
+    )
+    federated_parser.add_argument("--queries", type=int, default=100)
+    federated_parser.add_argument("--k", type=int, default=5)
+    federated_parser.add_argument(
+        "--fanout", type=int, default=4, help="Collections searched when routed"
+    )
+    federated_parser.add_argument(
+        "--words", type=int, default=8, help="Words of the chunk in each query"
+    )
+    federated_parser.add_argument(
+        "--noise", type=float, default=0.5, help="Share of the words off topic"
+    )
+    federated_parser.add_argument(
+        "--vocabulary", type=int, default=500, help="Made up terms in each site"
+    )
+    federated_parser.add_argument(
+        "--latency", type=float, default=0.0, help="API latency (in seconds)"
+    )
+
+    answers_parser = subparsers.add_parser(
+        "answers", help="Benchmark the answer cache hits and misses"
+    )
+    answers_parser.add_argument("--files", type=int, default=50)
+    answers_parser.add_argument("--queries", type=int, default=100)
+    answers_parser.add_argument(
+        "--latency", type=float, default=0.05, help="API latency (in seconds)"
+    )
+
+    args = parser.parse_args(argv)
+
+    if args.command == "scrape":
+        results = bench_scrape(args.pages, args.latency, args.concurrency, args.rate)
+    elif args.command == "chunk":
+        results = bench_chunk(
+            args.files, args.latency, args.error_rate, args.concurrency
+        )
+    elif args.command == "embed":
+        results = bench_embed(
+            args.files,
+            args.latency,
+            args.error_rate,
+            args.batch_size,
+            args.concurrency,
+        )
+    elif args.command == "index":
+        results = bench_index(
+            args.rows,
+            args.dimensions,
+            args.queries,
+            args.k,
+            args.index,
+            args.nprobes,
+            args.refine_factor,
+        )
+    elif args.command == "compact":
+        results = bench_compact(
+            args.rows, args.dimensions, args.vector_type, args.queries, args.k
+        )
+    elif args.command == "search":
+        results = bench_search(
+            args.files,
+            args.queries,
+            args.k,
+            args.words,
+            args.noise,
+            args.vocabulary,
+            args.latency,
+        )
+    elif args.command == "build":
+        results = bench_build(
+            args.pages, args.latency, args.llm_latency, args.embed_latency
+        )
+    elif args.command == "startup":
+        results = bench_startup(args.commands, args.runs, args.budget)
+    elif args.command == "store":
+        results = bench_store(args.files)
+    elif args.command == "context":
+        results = bench_context(
+            args.files,
+            args.queries,
+            args.k,
+            args.budgets,
+            args.words,
+            args.noise,
+            args.vocabulary,
+        )
+    elif args.command == "federated":
+        results = bench_federated(
+            args.collections,
+            args.files,
+            args.queries,
+            args.k,
+            args.fanout,
+            args.words,
+            args.noise,
+            args.vocabulary,
+            args.latency,
+        )
+    elif args.command == "answers":
+        results = bench_answers(args.files, args.queries, args.latency)
+    else:
+        raise Exception("Unexpected input")
+
+    for result in results:
+        print(" ".join(f"{k}={v}" for k, v in result.items()))
+
+    # fails the benchmark, and the scripts running it, on a startup regression.
+    if args.command == "startup" and not all(r["within_budget"] for r in results):
+        raise Exception(f"The command line imports take more than {args.budget}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,316 @@
+import os
+import json
+import time
+import zlib
+import sqlite3
+import hashlib
+import threading
+import numpy as np
+from array import array
+from pathlib import Path
+from collections import OrderedDict
+from typing import Any, Optional
+
+
+def default_cache_dir() -> Path:
+    return Path(os.getenv("RAG_URL_CACHE_DIR", Path.home() / ".cache" / "rag-url"))
+
+
+def content_key(*parts: str) -> str:
+    """Hash of the given strings, unambiguous about where each one ends."""
+    digest = hashlib.sha256()
+
+    for part in parts:
+        encoded = part.encode("utf-8")
+        digest.update(len(encoded).to_bytes(8, "big"))
+        digest.update(encoded)
+
+    return digest.hexdigest()
+
+
+class SqliteCache:
+    def __init__(self, path: str | Path, max_bytes: int):
+        """Key value store in a sqlite file, evicting the least recently used
+        values once their total size exceeds `max_bytes`.
+        """
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache"
+            " (key TEXT PRIMARY KEY, value BLOB, size INTEGER, used REAL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS cache_used ON cache (used)")
+        self.conn.commit()
+        self.size = self.conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM cache"
+        ).fetchone()[0]
+
+    def get_bytes(self, key: str) -> Optional[bytes]:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT value FROM cache WHERE key = ?", (key,)
+            ).fetchone()
+
+            if row is None:
+                return None
+
+            self.conn.execute(
+                "UPDATE cache SET used = ? WHERE key = ?", (time.time(), key)
+            )
+            self.conn.commit()
+
+            return row[0]
+
+    def put_bytes(self, key: str, value: bytes) -> None:
+        self.put_many_bytes({key: value})
+
+    def get_many_bytes(self, keys: list[str]) -> dict[str, bytes]:
+        """The values found for the given keys, in a single transaction."""
+        found: dict[str, bytes] = {}
+
+        with self.lock:
+            # stay below the sqlite limit on the number of query parameters.
+            for i in range(0, len(keys), 500):
+                batch = keys[i : i + 500]
+                marks = ", ".join("?" * len(batch))
+                rows = self.conn.execute(
+                    f"SELECT key, value FROM cache WHERE key IN ({marks})", batch
+                )
+                found.update(rows)
+
+            now = time.time()
+            self.conn.executemany(
+                "UPDATE cache SET used = ? WHERE key = ?",
+                [(now, key) for key in found],
+            )
+            self.conn.commit()
+
+        return found
+
+    def put_many_bytes(self, items: dict[str, bytes]) -> None:
+        with self.lock:
+            now = time.time()
+
+            for key, value in items.items():
+                previous = self.conn.execute(
+                    "SELECT size FROM cache WHERE key = ?", (key,)
+                ).fetchone()
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO cache (key, value, size, used)"
+                    " VALUES (?, ?, ?, ?)",
+                    (key, value, len(value), now),
+                )
+                self.size += len(value) - (previous[0] if previous else 0)
+
+            if self.size > self.max_bytes:
+                self._evict()
+
+            self.conn.commit()
+
+    def _evict(self) -> None:
+        # drop the least recently used values down to 90% of the budget.
+        target = self.max_bytes * 0.9
+        rows = self.conn.execute("SELECT key, size FROM cache ORDER BY used")
+        evicted = []
+
+        for key, size in rows:
+            if self.size <= target:
+                break
+            evicted.append((key,))
+            self.size -= size
+
+        self.conn.executemany("DELETE FROM cache WHERE key = ?", evicted)
+
+    def close(self) -> None:
+        with self.lock:
+            self.conn.close()
+
+
+class ChunkCache(SqliteCache):
+    def __init__(
+        self, path: str | Path | None = None, max_bytes: int = 256 * 1024 * 1024
+    ):
+        """Chunks produced by the llm, stored as compressed json."""
+        super().__init__(path or default_cache_dir() / "chunks.sqlite", max_bytes)
+
+    def get(self, key: str) -> Optional[list[Any]]:
+        value = self.get_bytes(key)
+
+        if value is None:
+            return None
+
+        return json.loads(zlib.decompress(value))
+
+    def put(self, key: str, chunks: list[Any]) -> None:
+        value = json.dumps(chunks, separators=(",", ":")).encode("utf-8")
+        self.put_bytes(key, zlib.compress(value))
+
+
+class EmbeddingCache(SqliteCache):
+    def __init__(
+        self,
+        path: str | Path | None = None,
+        max_bytes: int = 256 * 1024 * 1024,
+        memory_items: int = 1024,
+    ):
+        """Embedding vectors stored as float32 blobs, keyed by the model and the
+        hash of the text, with the `memory_items` most recently used ones
+        also kept in memory.
+        """
+        super().__init__(path or default_cache_dir() / "embeddings.sqlite", max_bytes)
+        self.memory: OrderedDict[str, array] = OrderedDict()
+        self.memory_items = memory_items
+        self.memory_lock = threading.Lock()
+
+    def _remember(self, key: str, vector: array) -> None:
+        with self.memory_lock:
+            self.memory[key] = vector
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.memory_items:
+                self.memory.popitem(last=False)
+
+    def _recall(self, key: str) -> Optional[array]:
+        with self.memory_lock:
+            vector = self.memory.get(key)
+            if vector is not None:
+                self.memory.move_to_end(key)
+
+            return vector
+
+    def get(self, model: str, text: str) -> Optional[list[float]]:
+        return self.get_many(model, [text])[0]
+
+    def put(self, model: str, text: str, vector: list[float]) -> None:
+        self.put_many(model, [text], [vector])
+
+    def get_many(self, model: str, texts: list[str]) -> list[Optional[list[float]]]:
+        keys = [content_key(model, text) for text in texts]
+        vectors = {key: self._recall(key) for key in keys}
+        missing = [key for key, vector in vectors.items() if vector is None]
+
+        for key, value in self.get_many_bytes(missing).items():
+            vector = array("f")
+            vector.frombytes(value)
+            vectors[key] = vector
+            self._remember(key, vector)
+
+        return [
+            vectors[key].tolist() if vectors[key] is not None else None
+            for key in keys
+        ]
+
+    def put_many(
+        self, model: str, texts: list[str], vectors: list[list[float]]
+    ) -> None:
+        items = {}
+
+        for text, values in zip(texts, vectors):
+            key = content_key(model, text)
+            vector = array("f", values)
+            items[key] = vector.tobytes()
+            self._remember(key, vector)
+
+        self.put_many_bytes(items)
+
+
+class AnswerCache:
+    def __init__(
+        self, threshold: float = 0.95, ttl: float = 3600.0, max_items: int = 1024
+    ):
+        """Answers of the agent, found again for any question whose embedding
+        has a cosine similarity of at least `threshold` with a cached one, or
+        by their question alone when it is asked again as it is.
+
+        Entries expire after `ttl` seconds, the least recently used ones are
+        evicted past `max_items`, and the entries of a collection are dropped
+        as soon as its version, the versions of its tables, changes.
+        """
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_items = max_items
+        self.vectors: Optional[np.ndarray] = None
+        # slot of the vector -> (collection, version, answer, created,
+        # question), in least recently used order.
+        self.entries: OrderedDict[
+            int, tuple[str, tuple[int, ...], str, float, str]
+        ] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _normalize(self, vector: Any) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+
+        return vector / norm if norm else vector
+
+    def _drop_stale(self, collection: str, version: tuple[int, ...]) -> None:
+        deadline = time.time() - self.ttl
+
+        for slot, (scope, stored, _, created, _) in list(self.entries.items()):
+            if created < deadline or (scope == collection and stored != version):
+                del self.entries[slot]
+
+    def find(
+        self, collection: str, version: tuple[int, ...], question: str
+    ) -> Optional[str]:
+        """The answer to the very same question, without embedding it."""
+        with self.lock:
+            self._drop_stale(collection, version)
+
+            for slot, entry in reversed(self.entries.items()):
+                if entry[0] == collection and entry[4] == question:
+                    self.entries.move_to_end(slot)
+                    return entry[2]
+
+            return None
+
+    def get(
+        self, collection: str, version: tuple[int, ...], vector: Any
+    ) -> Optional[str]:
+        with self.lock:
+            self._drop_stale(collection, version)
+
+            slots = [
+                slot for slot, entry in self.entries.items() if entry[0] == collection
+            ]
+            if not slots or self.vectors is None:
+                return None
+
+            # the vectors are normalized, the dot product is the cosine.
+            scores = self.vectors[slots] @ self._normalize(vector)
+            best = int(np.argmax(scores))
+
+            if scores[best] < self.threshold:
+                return None
+
+            self.entries.move_to_end(slots[best])
+
+            return self.entries[slots[best]][2]
+
+    def put(
+        self,
+        collection: str,
+        version: tuple[int, ...],
+        vector: Any,
+        answer: str,
+        question: str = "",
+    ) -> None:
+        vector = self._normalize(vector)
+
+        with self.lock:
+            if self.vectors is None or self.vectors.shape[1] != len(vector):
+                self.vectors = np.zeros((self.max_items, len(vector)), np.float32)
+                self.entries.clear()
+
+            # reuse a free slot, or the one of the least recently used entry.
+            if len(self.entries) < self.max_items:
+                used = set(self.entries)
+                slot = next(i for i in range(self.max_items) if i not in used)
+            else:
+                slot, _ = self.entries.popitem(last=False)
+
+            self.vectors[slot] = vector
+            self.entries[slot] = (collection, version, answer, time.time(), question)
@@ -1,13 +1,23 @@
 import os
-import time
 import json
 import re
+import threading
 import frontmatter
 from pathlib import Path
-from typing import TypedDict, Optional
-from google import genai
+from typing import Any, TypedDict, Optional
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from google.genai import types
-from rag_url.prompts import CHUNKING_SYSTEM_PROMP, CHUNKING_PROMPT_TEMPLATE
+from rag_url.gemini import is_retryable, make_client
+from rag_url.cache import ChunkCache, content_key
+from rag_url.metrics import metrics
+from rag_url.prompts import (
+    CHUNKING_PROMPT_VERSION,
+    CHUNKING_SYSTEM_PROMP,
+    CHUNKING_PROMPT_TEMPLATE,
+)
+from rag_url.ratelimit import AdaptiveLimiter
+from rag_url.split import MarkdownSplitter, Section, heading_title
+from rag_url.store import ChunkStore
 
 
 class Chunk(TypedDict):
@@ -17,31 +27,79 @@ class Chunk(TypedDict):
 
 
 class MarkdownChunker:
-    def __init__(self, workdir: str, delay: float = 1.0):
+    def __init__(
+        self,
+        workdir: str,
+        concurrency: int = 4,
+        retries: int = 3,
+        client: Any = None,
+        cache: ChunkCache | None = None,
+        max_tokens: int = 4000,
+        local: bool = False,
+        store: Optional[ChunkStore] = None,
+    ):
+        """Chunk the markdown files of workdir, `concurrency` llm calls at a time.
+
+        `client` defaults to a genai.Client configured from the environment,
+        the llm is only called for the pages missing from `cache`. Pages above
+        `max_tokens` are split before being sent, and with `local` the well
+        structured pages are chunked on their headings without the llm.
+
+        The chunks of each page go to a json file next to it, or to `store`.
+        """
         self.workpath = Path(workdir)
-        self.delay = delay
+        self.splitter = MarkdownSplitter(max_tokens)
+        self.local = local
+        self.model = os.getenv("GEMINI_MODEL_NAME", "gemini-2.0-flash")
+        self.cache = cache
+        self.store = store
+        self.concurrency = concurrency
+        self.retries = retries
+        self.client = client
+        self.client_lock = threading.Lock()
+        self.limiter = AdaptiveLimiter(concurrency)
         self.stop_sequence = "<STOP_RAG_CHUNKS>"
         self.chunk_separator = "<SEPARATOR_RAG_CHUNK>"
 
+    def _get_client(self) -> Any:
+        # a single client, and its connection pool, shared by all the workers.
+        with self.client_lock:
+            if self.client is None:
+                self.client = make_client()
+
+            return self.client
+
     def _to_chunks(self, content: str) -> list[Chunk]:
-        GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-        GEMINI_MODEL_NAME = os.getenv("GEMINI_MODEL_NAME", "gemini-2.0-flash")
+        client = self._get_client()
+
+        with self.limiter.slot(), metrics.timer("llm_call_seconds"):
+            metrics.count("llm_calls")
 
-        if not GEMINI_API_KEY:
-            raise Exception("GEMINI_API_KEY env var must be defined")
+            try:
+                response = client.models.generate_content(
+                    model=self.model,
+                    contents=CHUNKING_PROMPT_TEMPLATE(content),
+                    config=types.GenerateContentConfig(
+                        system_instruction=CHUNKING_SYSTEM_PROMP(
+                            self.chunk_separator, self.stop_sequence
+                        ),
+                        stop_sequences=[self.stop_sequence],
+                    ),
+                )
+            except Exception as e:
+                # slow everyone down when the api pushes back.
+                metrics.count("llm_errors")
+                if is_retryable(e):
+                    metrics.count("llm_throttled")
+                    self.limiter.throttle()
+                raise
 
-        client = genai.Client()
+            self.limiter.succeed()
 
-        response = client.models.generate_content(
-            model=GEMINI_MODEL_NAME,
-            contents=CHUNKING_PROMPT_TEMPLATE(content),
-            config=types.GenerateContentConfig(
-                system_instruction=CHUNKING_SYSTEM_PROMP(
-                    self.chunk_separator, self.stop_sequence
-                ),
-                stop_sequences=[self.stop_sequence],
-            ),
-        )
+        usage = getattr(response, "usage_metadata", None)
+        if usage is not None:
+            metrics.count("llm_prompt_tokens", usage.prompt_token_count or 0)
+            metrics.count("llm_output_tokens", usage.candidates_token_count or 0)
 
         if not response.text:
             raise Exception("No response produced")
@@ -97,50 +155,206 @@ class MarkdownChunker:
 
         return results
 
-    def chunk_file(self, infile: str) -> None:
-        # do nothing if target file exists.
-        outfilepath = self.workpath / f"{Path(infile).stem}.json"
+    def _cached_chunks(self, content: str) -> list[Chunk]:
+        key = content_key(content, self.model, CHUNKING_PROMPT_VERSION)
+        chunks = self.cache.get(key) if self.cache else None
+
+        if chunks is not None:
+            metrics.count("chunk_cache_hits")
+
+        # run the llm to get chunks.
+        if chunks is None:
+            chunks = self._to_chunks(content)
+
+            if self.cache:
+                self.cache.put(key, chunks)
+
+        return chunks
+
+    def _chunk_content(self, content: str) -> list[Chunk]:
+        # oversized pages are cut in parts chunked in parallel, each part is
+        # cached on its own so an edit only costs the parts it touched.
+        parts = self.splitter.split(content)
+
+        if len(parts) == 1:
+            return self._cached_chunks(content)
+
+        with ThreadPoolExecutor(max_workers=min(len(parts), self.concurrency)) as pool:
+            return [
+                chunk
+                for chunks in pool.map(self._cached_chunks, parts)
+                for chunk in chunks
+            ]
+
+    def _sections_to_chunks(self, sections: list[Section]) -> list[Chunk]:
+        chunks = []
+
+        for section in sections:
+            if not section["headings"] or not section["body"]:
+                continue
+
+            title = " > ".join(heading_title(h) for h in section["headings"])
+            blocks = self.splitter.blocks(section["body"])
+            code = None
+
+            # a trailing code block goes to the code field, like the llm does.
+            if len(blocks) > 1 and blocks[-1].startswith("```"):
+                code = blocks.pop()[3:].rstrip("`").strip()
+
+            content = "\n\n".join(blocks)
+            chunks.append(Chunk(title=title, content=content, code=code))
+
+        return chunks
 
-        if outfilepath.exists():
+    def _read_output(self, name: str) -> Optional[dict]:
+        if self.store is not None:
+            return self.store.get(name)
+
+        try:
+            filepath = self.workpath / f"{name}.json"
+            return json.loads(filepath.read_text(encoding="utf-8"))
+        except Exception:
+            return None
+
+    def _write_output(
+        self, name: str, url: str, key: str, chunks: list[Chunk], local: bool
+    ) -> None:
+        if self.store is not None:
+            # the prompt is not involved in local chunking.
+            version = None if local else CHUNKING_PROMPT_VERSION
+            self.store.put(name, url, key, chunks, version)
+            print(f"[INFO] {name} chunked in {self.store.path}")
             return
 
+        outfilepath = self.workpath / f"{name}.json"
+        wrapped = {"url": url, "hash": key, "chunks": chunks}
+
+        with open(outfilepath, "w", encoding="utf-8") as f:
+            f.write(json.dumps(wrapped, indent=2))
+
+        print(f"[INFO] {name} chunked in {outfilepath}")
+
+    def read_chunks(self, name: str) -> Optional[tuple[str, list[Chunk]]]:
+        """The url and chunks written for the page, if any."""
+        output = self._read_output(name)
+
+        if output is None:
+            return None
+
+        return output["url"], output["chunks"]
+
+    def chunk_markdown(
+        self, name: str, markdown: str, write: bool = True
+    ) -> tuple[str, list[Chunk]]:
+        """The url and chunks of a scraped page, written to `<name>.json` in
+        the workdir, or to the store, unless not `write`.
+        """
         # parse the source file.
-        parsed = frontmatter.load(infile)
+        parsed = frontmatter.loads(markdown)
 
         url = parsed.metadata.get("url")
         content = parsed.content
 
         # ensure theres an url metadata.
         if not url:
-            raise Exception(f"File {infile} has no url metadata")
+            raise Exception(f"Page {name} has no url metadata")
 
-        # run the llm to get chunks.
-        chunks = self._to_chunks(content)
+        sections = self.splitter.sections(content) if self.local else []
+        local = self.local and self.splitter.is_well_structured(sections)
 
-        # write to the outfile.
-        wrapped = {"url": str(url), "chunks": chunks}
+        # the chunks depend on the page content, the model and the prompt.
+        model = "local" if local else self.model
+        key = content_key(content, model, CHUNKING_PROMPT_VERSION)
 
-        with open(outfilepath, "w", encoding="utf-8") as f:
-            f.write(json.dumps(wrapped, indent=2))
+        # do nothing if target file was produced from the same content.
+        output = self._read_output(name)
+        if output is not None and output.get("hash") == key:
+            return str(url), output["chunks"]
 
-        print(f"[INFO] {infile} chunked in {outfilepath}")
+        if local:
+            chunks = self._sections_to_chunks(sections)
+        else:
+            chunks = self._chunk_content(content)
+
+        metrics.count("pages_chunked")
+
+        if write:
+            self._write_output(name, str(url), key, chunks, local)
+
+        return str(url), chunks
+
+    def chunk_file(self, infile: str) -> None:
+        markdown = Path(infile).read_text(encoding="utf-8")
+        self.chunk_markdown(Path(infile).stem, markdown)
+
+    def chunk_file_again(self, infile: str) -> None:
+        # a retry waits out the backoff of the api before calling it again.
+        self.limiter.pause()
+        self.chunk_file(infile)
+
+    def remove_orphans(self) -> None:
+        """Remove the chunks of the pages which no longer exist."""
+        if self.store is not None:
+            for name in self.store.names():
+                if not (self.workpath / f"{name}.md").exists():
+                    self.store.delete(name)
+                    print(f"[INFO] removed the chunks of {name}, its page no longer exists")
+            return
+
+        for outfilepath in self.workpath.glob("*.json"):
+            if not outfilepath.with_suffix(".md").exists():
+                outfilepath.unlink()
+                print(f"[INFO] removed {outfilepath}, its page no longer exists")
 
     def run(self) -> tuple[int, int]:
         # loop over all souce file and produce chunk files.
         source_files = list(self.workpath.glob("*.md"))
 
-        for infilepath in source_files:
-            try:
-                self.chunk_file(str(infilepath))
-
-            except Exception as e:
-                print(f"[ERROR] unable to chunk {infilepath}: {e}")
-
-            time.sleep(self.delay)
+        # remove the chunks of the pages which no longer exist.
+        self.remove_orphans()
+
+        # files failing on a retryable error are submitted again until they
+        # run out of attempts.
+        attempts: dict[str, int] = {}
+        pending: dict[Future, str] = {}
+
+        def submit(infile: str) -> None:
+            attempts[infile] = attempts.get(infile, 0) + 1
+            chunk = self.chunk_file_again if attempts[infile] > 1 else self.chunk_file
+            pending[pool.submit(chunk, infile)] = infile
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            for infilepath in source_files:
+                submit(str(infilepath))
+
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    infile = pending.pop(future)
+
+                    try:
+                        future.result()
+                    except Exception as e:
+                        if is_retryable(e) and attempts[infile] <= self.retries:
+                            metrics.count("chunk_retries")
+                            print(
+                                f"[INFO] retrying {infile}"
+                                f" (attempt {attempts[infile]} failed: {e})"
+                            )
+                            submit(infile)
+                        else:
+                            metrics.count("chunk_failures")
+                            print(f"[ERROR] unable to chunk {infile}: {e}")
+
+        if self.limiter.throttles:
+            print(f"[INFO] the api throttled {self.limiter.throttles} calls")
 
         # count the produced files (some LLM calls may have failed).
-        target_files = list(self.workpath.glob("*.json"))
+        if self.store is not None:
+            produced = len(self.store.names())
+        else:
+            produced = len(list(self.workpath.glob("*.json")))
 
         # return number of source files vs number of target file produced.
-        # Orchetstrator might loop until completed.
-        return (len(source_files), len(target_files))
+        return (len(source_files), produced)
@@ -0,0 +1,189 @@
+import math
+from typing import Optional, TypedDict
+from rag_url.dedup import WORD
+from rag_url.split import estimate_tokens
+
+# Passages sharing this much of their words with a selected one add nothing.
+REDUNDANT_SIMILARITY = 0.9
+
+
+class Passage(TypedDict):
+    url: str
+    urls: list[str]
+    text: str
+    code: Optional[str]
+    rank: int
+
+
+def _passage(run: list[tuple[int, dict]]) -> Passage:
+    members = [result for _, result in run]
+    codes = [result["code"] for result in members if result["code"]]
+    # a deduplicated chunk is found on all these pages.
+    urls = {url for result in members for url in result.get("urls") or [result["url"]]}
+
+    return Passage(
+        url=members[0]["url"],
+        urls=sorted(urls),
+        text="\n\n".join(result["text"] for result in members),
+        code="\n\n".join(codes) or None,
+        rank=min(rank for rank, _ in run),
+    )
+
+
+def to_passages(results: list[dict]) -> list[Passage]:
+    """The results as they are found, a passage each."""
+    return [_passage([(rank, result)]) for rank, result in enumerate(results)]
+
+
+def merge_adjacent(results: list[dict]) -> list[Passage]:
+    """The results as passages, the chunks following each other on the same
+    page merged into one, ranked as the best of them.
+    """
+    by_url: dict[str, list[tuple[int, dict]]] = {}
+    passages: list[Passage] = []
+
+    for rank, result in enumerate(results):
+        by_url.setdefault(result["url"], []).append((rank, result))
+
+    for hits in by_url.values():
+        hits.sort(key=lambda hit: hit[1].get("chunk_index") or 0)
+        runs: list[list[tuple[int, dict]]] = []
+
+        for rank, result in hits:
+            index = result.get("chunk_index")
+            previous = runs[-1][-1][1].get("chunk_index") if runs else None
+
+            # rows stored before the chunk index are passages of their own.
+            if index is not None and previous is not None and index == previous + 1:
+                runs[-1].append((rank, result))
+            else:
+                runs.append([(rank, result)])
+
+        passages.extend(_passage(run) for run in runs)
+
+    return sorted(passages, key=lambda passage: passage["rank"])
+
+
+def _words(passage: Passage) -> set[str]:
+    return set(WORD.findall(f"{passage['text']} {passage['code'] or ''}".lower()))
+
+
+def _similarity(a: set[str], b: set[str]) -> float:
+    if not a or not b:
+        return 0.0
+
+    return len(a & b) / math.sqrt(len(a) * len(b))
+
+
+def format_passage(passage: Passage) -> str:
+    parts = [
+        f"Source URL: {', '.join(passage['urls'])}\n",
+        f"Content: {passage['text']}\n",
+    ]
+
+    if passage["code"]:
+        parts.append(f"Code Example:\n```\n{passage['code']}\n```\n")
+    parts.append("---\n")
+
+    return "".join(parts)
+
+
+def format_context(passages: list[Passage]) -> str:
+    return "".join(format_passage(passage) for passage in passages)
+
+
+class ContextAssembler:
+    def __init__(
+        self,
+        max_tokens: int = 1250,
+        overfetch: int = 4,
+        mmr_lambda: float = 0.7,
+    ):
+        """Context given to the model for a search: `overfetch` times more
+        candidates than asked are fetched, the chunks following each other
+        on a page are merged, the passages are ordered by maximal marginal
+        relevance, the redundant ones dropped, and they are packed up to
+        `max_tokens`, or to the size of the top chunks they replace when
+        smaller.
+
+        `mmr_lambda` weighs the relevance of a passage against its overlap
+        with the ones already selected, 1 ignores the overlap.
+        """
+        self.max_tokens = max_tokens
+        self.overfetch = overfetch
+        self.mmr_lambda = mmr_lambda
+
+    def _diversify(self, passages: list[Passage], candidates: int) -> list[Passage]:
+        # the rank in the search is the relevance, whatever the search.
+        relevance = [1 - passage["rank"] / max(candidates, 1) for passage in passages]
+        words = [_words(passage) for passage in passages]
+        overlap = [0.0] * len(passages)
+        remaining = list(range(len(passages)))
+        selected: list[int] = []
+
+        while remaining:
+            best = max(
+                remaining,
+                key=lambda i: self.mmr_lambda * relevance[i]
+                - (1 - self.mmr_lambda) * overlap[i],
+            )
+            remaining.remove(best)
+
+            if overlap[best] >= REDUNDANT_SIMILARITY:
+                continue
+
+            selected.append(best)
+            for i in remaining:
+                overlap[i] = max(overlap[i], _similarity(words[i], words[best]))
+
+        return [passages[i] for i in selected]
+
+    def _pack(
+        self, passages: list[Passage], limit: int, budget: int
+    ) -> list[Passage]:
+        packed: list[Passage] = []
+
+        for passage in passages:
+            if len(packed) == limit:
+                break
+
+            tokens = estimate_tokens(format_passage(passage))
+
+            # smaller passages further down may still fit.
+            if tokens > budget:
+                if packed:
+                    continue
+
+                # the best passage alone is over the budget, it is cut.
+                cut = len(passage["text"]) - 4 * (tokens - budget)
+                passage = Passage(
+                    url=passage["url"],
+                    urls=passage["urls"],
+                    text=passage["text"][: max(cut, 0)],
+                    code=None,
+                    rank=passage["rank"],
+                )
+                tokens = estimate_tokens(format_passage(passage))
+
+            packed.append(passage)
+            budget -= tokens
+
+        return packed
+
+    def candidates(self, limit: int) -> int:
+        """Number of search results to fetch for `limit` passages."""
+        return self.overfetch * limit
+
+    def assemble(self, results: list[dict], limit: int) -> list[Passage]:
+        """At most `limit` passages from the search results, best first."""
+        # the context is never larger than the one of the top chunks,
+        # counted as they are packed.
+        top = to_passages(results[:limit])
+        budget = min(
+            self.max_tokens, sum(estimate_tokens(format_passage(p)) for p in top)
+        )
+
+        passages = merge_adjacent(results)
+        passages = self._diversify(passages, len(results))
+
+        return self._pack(passages, limit, budget)
@@ -0,0 +1,98 @@
+import re
+import hashlib
+import numpy as np
+
+WORD = re.compile(r"\w+")
+
+
+def normalize_text(text: str) -> str:
+    # case, punctuation and whitespace differences do not make a new chunk.
+    return " ".join(WORD.findall(text.lower()))
+
+
+def shingles(text: str, size: int = 3) -> list[str]:
+    words = WORD.findall(text.lower())
+
+    return [
+        " ".join(words[i : i + size]) for i in range(max(1, len(words) - size + 1))
+    ]
+
+
+def simhash(parts: list[str]) -> int:
+    """64 bits fingerprint, texts sharing most of their parts differ in few bits."""
+    hashes = np.array(
+        [
+            int.from_bytes(hashlib.blake2b(p.encode(), digest_size=8).digest(), "little")
+            for p in parts
+        ],
+        dtype=np.uint64,
+    )
+    bits = np.unpackbits(
+        hashes.view(np.uint8).reshape(-1, 8), axis=1, bitorder="little"
+    )
+
+    # each bit of the fingerprint is the majority vote of the parts.
+    votes = 2 * bits.sum(axis=0, dtype=np.int64) - len(parts)
+    fingerprint = np.packbits(votes > 0, bitorder="little")
+
+    return int.from_bytes(fingerprint.tobytes(), "little")
+
+
+class NearDuplicates:
+    def __init__(self, max_distance: int = 3, min_shingles: int = 20):
+        """Group texts which are equal once normalized, or whose simhash
+        differ by at most `max_distance` bits.
+
+        Texts with fewer than `min_shingles` word trigrams are only grouped
+        when equal, a few words apart is not a near duplicate for them.
+        """
+        self.max_distance = max_distance
+        self.min_shingles = min_shingles
+        self.exact: dict[str, str] = {}
+        # two fingerprints at most `max_distance` bits apart are equal on at
+        # least one of `max_distance + 1` bands.
+        self.bands = max_distance + 1
+        self.width = 64 // self.bands
+        self.buckets: list[dict[int, list[tuple[int, str]]]] = [
+            {} for _ in range(self.bands)
+        ]
+
+    def _band_values(self, fingerprint: int) -> list[int]:
+        values = []
+
+        for band in range(self.bands):
+            start = band * self.width
+            width = 64 - start if band == self.bands - 1 else self.width
+            values.append((fingerprint >> start) & ((1 << width) - 1))
+
+        return values
+
+    def group(self, key: str, text: str) -> str:
+        """The key of the first text added which this text duplicates, or its
+        own key when it is the first of its group.
+        """
+        digest = hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+        if digest in self.exact:
+            return self.exact[digest]
+
+        parts = shingles(text)
+
+        if self.max_distance <= 0 or len(parts) < self.min_shingles:
+            self.exact[digest] = key
+            return key
+
+        fingerprint = simhash(parts)
+        bands = self._band_values(fingerprint)
+
+        for bucket, value in zip(self.buckets, bands):
+            for other, group in bucket.get(value, []):
+                if (fingerprint ^ other).bit_count() <= self.max_distance:
+                    self.exact[digest] = group
+                    return group
+
+        self.exact[digest] = key
+        for bucket, value in zip(self.buckets, bands):
+            bucket.setdefault(value, []).append((fingerprint, key))
+
+        return key
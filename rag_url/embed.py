@@ -1,50 +1,247 @@
 import os
 import json
+import time
+import threading
 import lancedb
+import numpy as np
+import pyarrow as pa
 from pathlib import Path
-from google import genai
+from typing import Any, Collection, Iterable, Iterator, Optional
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from rag_url.cache import EmbeddingCache, content_key
+from rag_url.dedup import NearDuplicates
+from rag_url.metrics import metrics
+from rag_url.gemini import (
+    embed_config,
+    embed_model_key,
+    embedding_values,
+    is_retryable,
+    make_client,
+)
+from rag_url.index import (
+    VECTOR_TYPES,
+    build_fts_index,
+    build_index,
+    has_fts_index,
+    needs_index,
+)
+from rag_url.ratelimit import AdaptiveLimiter
+from rag_url.store import ChunkStore
+
+# Url and chunks of each page, iterated twice when grouping duplicates.
+Pages = Collection[tuple[str, list]]
 
 
 class ChunkEmbedder:
-    def __init__(self, dbfile: str, pattern: str, collection: str = "collection"):
+    def __init__(
+        self,
+        dbfile: str,
+        pattern: Optional[str],
+        collection: str = "collection",
+        batch_size: int = 100,
+        concurrency: int = 4,
+        retries: int = 3,
+        client: Any = None,
+        full: bool = False,
+        cache: Optional[EmbeddingCache] = None,
+        flush_rows: int = 1000,
+        index_type: Optional[str] = None,
+        index_threshold: int = 100_000,
+        metric: str = "cosine",
+        num_partitions: Optional[int] = None,
+        num_sub_vectors: Optional[int] = None,
+        fts: bool = False,
+        dedup: bool = True,
+        dedup_distance: int = 3,
+        dimensions: Optional[int] = None,
+        vector_type: str = "float32",
+        full_vectors: bool = True,
+        store: Optional[ChunkStore] = None,
+    ):
+        """Embed the chunks of the json files matching pattern, or of the
+        pages of `store`, `batch_size` chunks per request and `concurrency`
+        requests at a time.
+
+        Only the chunks missing from the collection are embedded, unless
+        `full` rebuilds it, and the vectors found in `cache` are reused.
+        The vectors are appended to a staging table every `flush_rows` rows,
+        an interrupted run resumes from there. `client` defaults to a
+        genai.Client configured from the environment.
+
+        With an `index_type`, a vector index is built once the collection
+        has `index_threshold` rows. With `fts`, the text and code columns
+        get a full text index.
+
+        With `dedup`, chunks equal once normalized or whose simhash differ by
+        at most `dedup_distance` bits are stored as a single row listing all
+        their urls.
+
+        `dimensions` asks the model for shorter vectors, and `vector_type`
+        stores them at a lower precision, in which case a float32 copy is
+        also stored to re-rank the results unless `full_vectors` is False.
+        """
         self.db = lancedb.connect(dbfile)
         self.pattern = pattern
+        self.store = store
         self.collection = collection
+        self.staging = f"{collection}__staging"
+        self.model = os.getenv("GEMINI_EMBED_MODEL_NAME", "text-embedding-004")
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.retries = retries
+        self.client = client
+        self.full = full
+        self.cache = cache
+        self.flush_rows = flush_rows
+        self.index_type = index_type
+        self.index_threshold = index_threshold
+        self.metric = metric
+        self.num_partitions = num_partitions
+        self.num_sub_vectors = num_sub_vectors
+        self.fts = fts
+        self.dedup = dedup
+        self.dedup_distance = dedup_distance
+        self.dimensions = dimensions
+        self.vector_type = vector_type
+        self.full_vectors = full_vectors and vector_type != "float32"
+        self.model_key = embed_model_key(self.model, dimensions)
+        self.failed = 0
+        self.client_lock = threading.Lock()
+        self.limiter = AdaptiveLimiter(concurrency)
 
-    def _embed_content(self, title: str, content: str, code: str, url: str):
-        GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-        GEMINI_EMBED_MODEL_NAME = os.getenv(
-            "GEMINI_EMBED_MODEL_NAME", "text-embedding-004"
-        )
+    def _get_client(self) -> Any:
+        # a single client, and its connection pool, shared by all the workers.
+        with self.client_lock:
+            if self.client is None:
+                self.client = make_client()
 
-        if not GEMINI_API_KEY:
-            raise Exception("GEMINI_API_KEY env var must be defined")
+            return self.client
 
-        text_to_embed = "\n\n".join([f"#{title}", content])
+    def _to_text(self, title: str, content: str) -> str:
+        return "\n\n".join([f"#{title}", content])
 
-        client = genai.Client(api_key=GEMINI_API_KEY)
+    def _chunk_id(
+        self, url: str, title: str, content: str, code: Optional[str], index: int
+    ) -> str:
+        # stable across runs, a chunk changing anywhere, code included, or
+        # moving on its page gets a new id, and its row the new index.
+        return content_key(url, title, content, code or "", str(index))
 
-        response = client.models.embed_content(
-            model=GEMINI_EMBED_MODEL_NAME,
-            contents=text_to_embed,
-        )
+    def _schema(self, dimensions: int) -> pa.Schema:
+        vector_type = pa.from_numpy_dtype(VECTOR_TYPES[self.vector_type])
+        fields = [
+            pa.field("id", pa.string()),
+            pa.field("text", pa.string()),
+            pa.field("vector", pa.list_(vector_type, dimensions)),
+            pa.field("code", pa.string()),
+            pa.field("url", pa.string()),
+            pa.field("urls", pa.list_(pa.string())),
+            pa.field("chunk_index", pa.int32()),
+        ]
 
-        if not response.embeddings:
-            raise Exception("Unable to embed content")
+        if self.full_vectors:
+            fields.append(pa.field("full_vector", pa.list_(pa.float32(), dimensions)))
+
+        return pa.schema(fields)
+
+    def _same_vectors(self, schema: pa.Schema) -> bool:
+        """Whether the table stores vectors the way this run would."""
+        vector = schema.field("vector").type
+
+        if vector.value_type != pa.from_numpy_dtype(VECTOR_TYPES[self.vector_type]):
+            return False
+        if self.dimensions is not None and vector.list_size != self.dimensions:
+            return False
+
+        return ("full_vector" in schema.names) == self.full_vectors
+
+    def _open_table(self) -> Optional[Any]:
+        """The collection to update, None when it has to be built from scratch."""
+        if self.full or self.collection not in self.db.table_names():
+            return None
+
+        table = self.db.open_table(self.collection)
 
-        embedding_vector = response.embeddings[0].values
+        # collections embedded before chunks had an id are rebuilt once.
+        if "id" not in table.schema.names:
+            print(f"[INFO] Collection '{self.collection}' has no chunk ids, rebuilding it")
+            return None
 
-        return {
-            "text": text_to_embed,
-            "vector": embedding_vector,
-            "code": code,
-            "url": url,
-        }
+        # as are the ones embedded before duplicates were grouped.
+        if "urls" not in table.schema.names:
+            print(f"[INFO] Collection '{self.collection}' has no urls column, rebuilding it")
+            return None
 
-    def run(self) -> None:
-        docs = []
+        # and before the position of the chunks on their page was stored.
+        if "chunk_index" not in table.schema.names:
+            print(f"[INFO] Collection '{self.collection}' has no chunk index, rebuilding it")
+            return None
+
+        if not self._same_vectors(table.schema):
+            print(f"[INFO] Collection '{self.collection}' has other vector settings, rebuilding it")
+            return None
+
+        return table
+
+    def _open_staging(self) -> Optional[Any]:
+        if self.staging not in self.db.table_names():
+            return None
+
+        staging = self.db.open_table(self.staging)
+
+        # rows staged with another schema can not be merged.
+        if "chunk_index" not in staging.schema.names or not self._same_vectors(
+            staging.schema
+        ):
+            self.db.drop_table(self.staging)
+            return None
+
+        return staging
+
+    def _existing_ids(self, table: Any) -> set[str]:
+        rows = table.search().select(["id"]).limit(None).to_arrow()
+
+        return set(rows.column("id").to_pylist())
+
+    def _embed_batch(self, texts: list[str]) -> list[list[float]]:
+        client = self._get_client()
+
+        with self.limiter.slot(), metrics.timer("embed_call_seconds"):
+            metrics.count("embed_calls")
+
+            try:
+                response = client.models.embed_content(
+                    model=self.model,
+                    contents=texts,
+                    config=embed_config(self.dimensions),
+                )
+            except Exception as e:
+                # slow everyone down when the api pushes back.
+                metrics.count("embed_errors")
+                if is_retryable(e):
+                    metrics.count("embed_throttled")
+                    self.limiter.throttle()
+                raise
 
-        for filepath in Path().glob(self.pattern):
+            self.limiter.succeed()
+
+        if not response.embeddings or len(response.embeddings) != len(texts):
+            raise Exception("Unable to embed content")
+
+        return [
+            embedding_values(embedding, self.dimensions)
+            for embedding in response.embeddings
+        ]
+
+    def _read_pages(self) -> Iterator[tuple[str, Any, Any]]:
+        """The url and chunks of the json files, or of the store, one page in
+        memory at a time.
+        """
+        if self.store is not None:
+            yield from self.store.pages()
+            return
+
+        for filepath in sorted(Path().glob(self.pattern)):
             if not filepath.is_file():
                 continue
 
@@ -54,9 +251,20 @@ class ChunkEmbedder:
                 print(f"[INFO] Error reading {filepath}: {e}")
                 continue
 
-            url = data.get("url")
-            chunks = data.get("chunks")
+            yield str(filepath), data.get("url"), data.get("chunks")
+
+    def _iter_chunks(
+        self, pages: Optional[Iterable[tuple[str, list]]] = None
+    ) -> Iterator[dict]:
+        """The chunks of the pages, given as (url, chunks) pairs or read from
+        the json files.
+        """
+        if pages is None:
+            sources = self._read_pages()
+        else:
+            sources = ((url, url, chunks) for url, chunks in pages)
 
+        for filepath, url, chunks in sources:
             if not isinstance(url, str):
                 print(f"[INFO] Skipping {filepath}: no valid 'url'")
                 continue
@@ -65,9 +273,9 @@ class ChunkEmbedder:
                 print(f"[INFO] Skipping {filepath}: no valid 'chunks'")
                 continue
 
-            num_docs = 0
+            seen = set()
 
-            for item in chunks:
+            for index, item in enumerate(chunks):
                 title = item.get("title")
                 content = item.get("content")
                 code = item.get("code")
@@ -76,21 +284,361 @@ class ChunkEmbedder:
                     print(f"[INFO] Skipping chunk in {filepath}: invalid title or content")
                     continue
 
-                try:
-                    num_docs += 1
-                    embedding_doc = self._embed_content(title, content, code, url)
-                    docs.append(embedding_doc)
-                except Exception as e:
-                    print(f"[ERROR] Error embedding content from {filepath}: {e}")
+                # a chunk repeated on the page is stored once.
+                if (title, content, code) in seen:
                     continue
+                seen.add((title, content, code))
+
+                yield {
+                    "id": self._chunk_id(url, title, content, code, index),
+                    "text": self._to_text(title, content),
+                    "code": code,
+                    "url": url,
+                    "chunk_index": index,
+                    "content": content,
+                }
+
+    def _dedup_text(self, doc: dict) -> str:
+        # titles differ between pages repeating the same section.
+        return "\n\n".join([doc["content"], doc["code"] or ""])
+
+    def _group_chunks(
+        self, pages: Optional[Pages]
+    ) -> dict[str, list[tuple[str, str]]]:
+        """The ids and urls of the chunks duplicating each first chunk of its
+        group, by the id of that first chunk.
+        """
+        duplicates = NearDuplicates(self.dedup_distance)
+        groups: dict[str, list[tuple[str, str]]] = {}
+        chunks = 0
+
+        for doc in self._iter_chunks(pages):
+            group = duplicates.group(doc["id"], self._dedup_text(doc))
+            groups.setdefault(group, []).append((doc["id"], doc["url"]))
+            chunks += 1
+
+        if len(groups) < chunks:
+            print(f"[INFO] {chunks} chunks deduplicated into {len(groups)} rows")
+
+        return groups
+
+    def _iter_docs(self, seen: set[str], pages: Optional[Pages]) -> Iterator[dict]:
+        """The rows to store, a single one for each group of duplicates with
+        the urls of all its chunks.
+
+        `seen` collects the ids of the rows read so far.
+        """
+        groups = self._group_chunks(pages) if self.dedup else None
+
+        for doc in self._iter_chunks(pages):
+            del doc["content"]
+
+            if groups is None:
+                doc["urls"] = [doc["url"]]
+            elif doc["id"] not in groups:
+                continue
+            else:
+                members = groups[doc["id"]]
+                doc["urls"] = sorted({url for _, url in members})
+
+                # the row changes with its group, a chunk joining or leaving
+                # it gets a new id.
+                if len(members) > 1:
+                    doc["id"] = content_key(*sorted(chunk_id for chunk_id, _ in members))
+
+            seen.add(doc["id"])
+
+            yield doc
+
+    def _batches(self, docs: Iterable[dict]) -> Iterator[list[dict]]:
+        batch = []
+
+        for doc in docs:
+            batch.append(doc)
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+
+        if batch:
+            yield batch
+
+    def _from_cache(self, docs: list[dict]) -> tuple[list[dict], list, list[dict]]:
+        """The docs with a cached vector, their vectors, and the docs left."""
+        if self.cache is None:
+            return [], [], docs
+
+        vectors = self.cache.get_many(self.model_key, [doc["text"] for doc in docs])
+        hits = [(doc, v) for doc, v in zip(docs, vectors) if v is not None]
+        missing = [doc for doc, v in zip(docs, vectors) if v is None]
+        metrics.count("embed_cache_hits", len(hits))
+
+        return [doc for doc, _ in hits], [v for _, v in hits], missing
+
+    def _embed(self, docs: Iterable[dict]) -> Iterator[tuple[list[dict], list]]:
+        """The docs with their vectors, batch after batch, with at most twice
+        `concurrency` batches read ahead.
+        """
+        batches = self._batches(docs)
+        pending: dict[Future, tuple[list[dict], int]] = {}
 
-            print(f"[INFO] Successfully embedded {num_docs} documents from {filepath}")
+        def submit(batch: list[dict], attempt: int) -> None:
+            texts = [doc["text"] for doc in batch]
+            pending[pool.submit(self._embed_batch, texts)] = (batch, attempt)
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            while True:
+                while len(pending) < 2 * self.concurrency:
+                    batch = next(batches, None)
+                    if batch is None:
+                        break
+
+                    hits, vectors, batch = self._from_cache(batch)
+                    if hits:
+                        yield hits, vectors
+                    if batch:
+                        submit(batch, 1)
+
+                if not pending:
+                    break
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    batch, attempt = pending.pop(future)
+
+                    # failed batches are submitted again until they run out
+                    # of attempts, a batch failing for good only loses its
+                    # own chunks.
+                    try:
+                        vectors = future.result()
+                    except Exception as e:
+                        if attempt <= self.retries:
+                            metrics.count("embed_retries")
+                            submit(batch, attempt + 1)
+                        else:
+                            metrics.count("chunks_failed", len(batch))
+                            self.failed += len(batch)
+                            print(f"[ERROR] Error embedding a batch of {len(batch)} chunks: {e}")
+                        continue
+
+                    if self.cache is not None:
+                        texts = [doc["text"] for doc in batch]
+                        self.cache.put_many(self.model_key, texts, vectors)
+
+                    yield batch, vectors
+
+    def _to_record_batch(self, docs: list[dict], vectors: list) -> pa.RecordBatch:
+        matrix = np.asarray(vectors, dtype=np.float32)
+        dimensions = matrix.shape[1]
+        compact = matrix.astype(VECTOR_TYPES[self.vector_type])
+        arrays = [
+            pa.array([doc["id"] for doc in docs], pa.string()),
+            pa.array([doc["text"] for doc in docs], pa.string()),
+            pa.FixedSizeListArray.from_arrays(compact.reshape(-1), dimensions),
+            pa.array([doc["code"] for doc in docs], pa.string()),
+            pa.array([doc["url"] for doc in docs], pa.string()),
+            pa.array([doc["urls"] for doc in docs], pa.list_(pa.string())),
+            pa.array([doc["chunk_index"] for doc in docs], pa.int32()),
+        ]
+
+        if self.full_vectors:
+            arrays.append(
+                pa.FixedSizeListArray.from_arrays(matrix.reshape(-1), dimensions)
+            )
+
+        return pa.RecordBatch.from_arrays(arrays, schema=self._schema(dimensions))
+
+    def _append(self, staging: Optional[Any], batches: list[pa.RecordBatch]) -> Any:
+        data = pa.Table.from_batches(batches)
+
+        if staging is None:
+            return self.db.create_table(self.staging, data=data)
+
+        staging.add(data)
+
+        return staging
+
+    def _staged_rows(self, staging: Any) -> pa.RecordBatchReader:
+        return staging.search().limit(None).to_batches(self.flush_rows)
+
+    def _create(self, staging: Any) -> bool:
+        try:
+            self.db.create_table(
+                self.collection,
+                data=self._staged_rows(staging),
+                schema=staging.schema,
+                mode="overwrite",
+            )
+            print(
+                f"Successfully created database with {staging.count_rows()} chunks in collection '{self.collection}'"
+            )
+        except Exception as e:
+            print(f"[ERROR] Error creating table: {e}")
+            return False
+
+        return True
+
+    def _merge(self, table: Any, staging: Optional[Any], stale: set[str]) -> bool:
+        if staging is None and not stale:
+            print(f"[INFO] Collection '{self.collection}' is up to date")
+            return True
+
+        if staging is None:
+            data, inserted = table.schema.empty_table(), 0
+        else:
+            data, inserted = self._staged_rows(staging), staging.count_rows()
+
+        # insert the new chunks and delete the stale ones in a single commit,
+        # queries see either the previous version of the table or this one.
+        merge = table.merge_insert("id").when_not_matched_insert_all()
+        if stale:
+            # the ids are hex digests, safe to inline.
+            ids = ", ".join(f"'{chunk_id}'" for chunk_id in sorted(stale))
+            merge = merge.when_not_matched_by_source_delete(f"id IN ({ids})")
+
+        try:
+            merge.execute(data)
+            print(
+                f"Successfully updated collection '{self.collection}' with {inserted} new chunks and {len(stale)} deleted chunks"
+            )
+        except Exception as e:
+            print(f"[ERROR] Error updating table: {e}")
+            return False
+
+        return True
+
+    def _index(self, changed: bool) -> None:
+        if self.collection not in self.db.table_names():
+            return
+
+        table = self.db.open_table(self.collection)
+
+        if self.index_type is not None and needs_index(
+            table, self.index_type, self.metric, self.index_threshold
+        ):
+            print(f"[INFO] Building the {self.index_type} index of collection '{self.collection}'")
 
-        if docs:
             try:
-                self.db.create_table(self.collection, data=docs, mode="overwrite")
-                print(
-                    f"Successfully created database with {len(docs)} chunks in collection '{self.collection}'"
+                build_index(
+                    table,
+                    self.index_type,
+                    self.metric,
+                    self.num_partitions,
+                    self.num_sub_vectors,
                 )
             except Exception as e:
-                print(f"[ERROR] Error creating table: {e}")
+                print(f"[ERROR] Error building index: {e}")
+
+        # the full text indexes are rebuilt to cover the rows just merged.
+        if self.fts and (changed or not has_fts_index(table)):
+            print(f"[INFO] Building the full text index of collection '{self.collection}'")
+
+            try:
+                build_fts_index(table)
+            except Exception as e:
+                print(f"[ERROR] Error building full text index: {e}")
+
+    def warm(self, pages: Iterable[tuple[str, list]]) -> None:
+        """Embed the chunks of the pages into the cache as the pages come, for
+        `run` to find their vectors there.
+
+        Like `run`, only the first chunk of each group of duplicates and the
+        chunks missing from the collection are embedded.
+        """
+        if self.cache is None:
+            raise Exception("Embedding ahead needs an embedding cache")
+
+        table = self._open_table()
+        existing = self._existing_ids(table) if table is not None else set()
+        duplicates = NearDuplicates(self.dedup_distance) if self.dedup else None
+
+        def docs() -> Iterator[dict]:
+            for doc in self._iter_chunks(pages):
+                if duplicates is not None:
+                    group = duplicates.group(doc["id"], self._dedup_text(doc))
+                    if group != doc["id"]:
+                        continue
+
+                if doc["id"] not in existing:
+                    yield doc
+
+        embedded = sum(len(batch) for batch, _ in self._embed(docs()))
+        print(f"[INFO] {embedded} chunks embedded ahead, {self.failed} failed")
+
+        # the failed chunks are embedded again by the run.
+        self.failed = 0
+
+    def run(self, pages: Optional[Pages] = None, keep_stale: bool = False) -> None:
+        """Store the chunks of the pages, the json files matching the pattern
+        or the store by default, in the collection.
+
+        The chunks of the collection missing from the pages are deleted,
+        unless `keep_stale` when some pages may have been missed.
+        """
+        table = self._open_table()
+        staging = self._open_staging()
+        existing = self._existing_ids(table) if table is not None else set()
+        staged = self._existing_ids(staging) if staging is not None else set()
+        current: set[str] = set()
+
+        if staged:
+            print(f"[INFO] Resuming with {len(staged)} chunks embedded by a previous run")
+
+        # chunks in the collection or staged by an interrupted run are skipped.
+        docs = (
+            doc
+            for doc in self._iter_docs(current, pages)
+            if doc["id"] not in existing and doc["id"] not in staged
+        )
+
+        print(f"[INFO] Embedding chunks in batches of {self.batch_size}")
+
+        buffer: list[pa.RecordBatch] = []
+        buffered = 0
+        embedded = 0
+        start = time.perf_counter()
+
+        for batch, vectors in self._embed(docs):
+            buffer.append(self._to_record_batch(batch, vectors))
+            buffered += len(batch)
+            embedded += len(batch)
+            metrics.count("chunks_embedded", len(batch))
+
+            # every append is committed, a crash only loses the buffer.
+            if buffered >= self.flush_rows:
+                staging = self._append(staging, buffer)
+                buffer, buffered = [], 0
+
+        if buffer:
+            staging = self._append(staging, buffer)
+
+        print(f"[INFO] {embedded} chunks embedded, {self.failed} failed")
+        metrics.gauge("embeddings_per_second", embedded / (time.perf_counter() - start))
+
+        if self.limiter.throttles:
+            print(f"[INFO] the api throttled {self.limiter.throttles} calls")
+
+        # chunks staged by an interrupted run may have disappeared since.
+        if staging is not None and staged - current:
+            ids = ", ".join(f"'{chunk_id}'" for chunk_id in sorted(staged - current))
+            staging.delete(f"id IN ({ids})")
+
+        stale = set() if keep_stale else existing - current
+        stored = True
+
+        if table is not None:
+            stored = self._merge(table, staging, stale)
+        elif staging is not None:
+            stored = self._create(staging)
+
+        # the staged chunks are kept for the next run to resume from, unless
+        # they made it to the collection.
+        if not stored:
+            if staging is not None:
+                print(f"[INFO] Keeping the staged chunks in '{self.staging}' for the next run")
+            return
+
+        if staging is not None:
+            self.db.drop_table(self.staging)
+
+        self._index(changed=staging is not None or bool(stale))
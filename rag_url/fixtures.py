@@ -0,0 +1,346 @@
+import re
+import time
+import random
+import hashlib
+import threading
+import numpy as np
+from types import SimpleNamespace
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-ins for the external services used by the pipeline, so each
+# stage can be benchmarked without network access.
+
+WORDS = (
+    "agent model tool query index vector chunk page token stream result "
+    "client config request response schema field value cache batch retry"
+).split()
+
+PAGE_PATH = re.compile(r"^/docs/section-(\d+)/page-(\d+)/?(index\.html)?$")
+
+# Equivalent spellings of a link, the crawler should fetch each page once.
+LINK_VARIANTS = ("", "?utm_source=nav", "#usage", "index.html")
+
+
+class SyntheticSite:
+    def __init__(
+        self,
+        pages: int = 200,
+        links_per_page: int = 8,
+        paragraphs: int = 12,
+        latency: float = 0.0,
+        seed: int = 0,
+        orphans: int = 0,
+        lastmod: str = "2025-01-01",
+    ):
+        """A generated documentation site served over http on localhost.
+
+        The last `orphans` pages are not linked by any page, they can only be
+        found through the sitemap.
+        """
+        self.pages = pages
+        self.orphans = min(orphans, pages - 1)
+        self.lastmod = lastmod
+        self.links_per_page = links_per_page
+        self.paragraphs = paragraphs
+        self.latency = latency
+        self.seed = seed
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.server: ThreadingHTTPServer | None = None
+        self.thread: threading.Thread | None = None
+
+    @property
+    def url(self) -> str:
+        if not self.server:
+            raise Exception("The synthetic site is not started")
+
+        host, port = self.server.server_address[:2]
+
+        return f"http://{host}:{port}/"
+
+    def page_path(self, index: int) -> str:
+        return f"/docs/section-{index % 10}/page-{index}/"
+
+    def paths(self) -> list[str]:
+        return ["/"] + [self.page_path(i) for i in range(self.pages)]
+
+    def robots(self) -> str:
+        return f"User-agent: *\nAllow: /\nSitemap: {self.url}sitemap.xml\n"
+
+    def sitemap(self) -> str:
+        urls = "".join(
+            f"<url><loc>{self.url.rstrip('/')}{path}</loc>"
+            f"<lastmod>{self.lastmod}</lastmod></url>"
+            for path in self.paths()
+        )
+        return (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">'
+            f"{urls}</urlset>"
+        )
+
+    def llms(self) -> str:
+        links = "\n".join(
+            f"- [Page {i}]({self.page_path(i)}index.md)"
+            for i in range(min(self.pages, 10))
+        )
+        return f"# Synthetic site\n\n## Docs\n\n{links}\n"
+
+    def _sentence(self, rnd: random.Random) -> str:
+        words = [rnd.choice(WORDS) for _ in range(rnd.randint(8, 20))]
+        return " ".join(words).capitalize() + "."
+
+    def render(self, path: str) -> str | None:
+        linked = self.pages - self.orphans
+
+        if path == "/":
+            index = -1
+            targets = list(range(min(linked, self.links_per_page * 4)))
+        else:
+            match = PAGE_PATH.match(path)
+            if not match or int(match.group(2)) >= self.pages:
+                return None
+            index = int(match.group(2))
+            if self.page_path(index).rstrip("/") != path.removesuffix(
+                "index.html"
+            ).rstrip("/"):
+                return None
+            rnd = random.Random(self.seed + index)
+            # always link the next page so every linked page is reachable.
+            targets = [(index + 1) % linked] + [
+                rnd.randrange(linked) for _ in range(self.links_per_page - 1)
+            ]
+
+        rnd = random.Random(self.seed * 7919 + index)
+        nav = '<li><a href="#top">Top</a></li>' + "".join(
+            f'<li><a href="{self.page_path(t)}{rnd.choice(LINK_VARIANTS)}">'
+            f"Page {t}</a></li>"
+            for t in targets
+        )
+        body = []
+        for p in range(self.paragraphs):
+            if p % 4 == 0:
+                body.append(f"<h2>{self._sentence(rnd)[:40]}</h2>")
+            body.append(
+                "<p>" + " ".join(self._sentence(rnd) for _ in range(4)) + "</p>"
+            )
+            if p % 5 == 4:
+                code = "\n".join(self._sentence(rnd) for _ in range(3))
+                body.append(f"<pre><code>{code}</code></pre>")
+
+        return (
+            "<!doctype html><html><head>"
+            f"<title>Page {index}</title></head><body>"
+            f"<nav><ul>{nav}</ul></nav>"
+            f"<main><article><h1>Page {index}</h1>{''.join(body)}</article></main>"
+            "<footer>Synthetic site</footer></body></html>"
+        )
+
+    def _handler(self):
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with site.lock:
+                    site.requests += 1
+
+                if site.latency:
+                    time.sleep(site.latency)
+
+                path = self.path.split("?")[0]
+                content_type = "text/html; charset=utf-8"
+
+                if path == "/robots.txt":
+                    content, content_type = site.robots(), "text/plain"
+                elif path == "/sitemap.xml":
+                    content, content_type = site.sitemap(), "application/xml"
+                elif path == "/llms.txt":
+                    content, content_type = site.llms(), "text/plain"
+                else:
+                    content = site.render(path)
+
+                if content is None:
+                    self.send_error(404)
+                    return
+
+                payload = content.encode("utf-8")
+                etag = f'"{hashlib.md5(payload).hexdigest()}"'
+
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.end_headers()
+                    return
+
+                self.send_response(200)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self) -> "SyntheticSite":
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def __enter__(self) -> "SyntheticSite":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+
+def synthetic_markdown(
+    index: int,
+    sections: int = 6,
+    seed: int = 0,
+    vocabulary: int = 0,
+    terms: str = "term",
+) -> str:
+    """A scraped page as found in the workdir, frontmatter included.
+
+    `vocabulary` adds as many made up terms to the words, so that sections
+    can be told apart by their content. Pages of sites made up with other
+    `terms` are about other topics.
+    """
+    rnd = random.Random(seed * 7919 + index)
+    vocabulary_words = WORDS + [f"{terms}{i}" for i in range(vocabulary)]
+
+    def sentence() -> str:
+        words = [rnd.choice(vocabulary_words) for _ in range(rnd.randint(8, 20))]
+        return " ".join(words).capitalize() + "."
+
+    lines = ["---", f"url: https://docs.example.com/page-{index}", "---", ""]
+    lines += [f"# Page {index}", ""]
+
+    for s in range(sections):
+        lines += [f"## Section {s} {sentence()[:30]}", ""]
+        lines += [" ".join(sentence() for _ in range(5)), ""]
+        if s % 2:
+            lines += ["```python", *(sentence() for _ in range(3)), "```", ""]
+
+    return "\n".join(lines)
+
+
+def fake_embedding(text: str, dimensions: int = 768) -> list[float]:
+    """Deterministic unit vector hashed from the words of the text, texts
+    sharing words get close vectors.
+    """
+    vector = [0.0] * dimensions
+
+    for word in re.findall(r"\w+", text.lower()):
+        digest = hashlib.md5(word.encode("utf-8")).digest()
+        index = int.from_bytes(digest[:4], "big") % dimensions
+        vector[index] += 1.0 if digest[4] & 1 else -1.0
+
+    norm = sum(value * value for value in vector) ** 0.5 or 1.0
+
+    return [value / norm for value in vector]
+
+
+def synthetic_vectors(
+    rows: int, dimensions: int = 768, clusters: int = 100, seed: int = 0
+) -> np.ndarray:
+    """Unit float32 vectors grouped around random centers, like the
+    embeddings of a corpus covering a number of topics.
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dimensions), dtype=np.float32)
+    labels = rng.integers(0, clusters, rows)
+    noise = rng.standard_normal((rows, dimensions), dtype=np.float32)
+    vectors = centers[labels] + 0.5 * noise
+
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+class FakeAPIError(Exception):
+    def __init__(self, code: int, message: str = "fake api error"):
+        super().__init__(f"{code} {message}")
+        self.code = code
+
+
+class FakeGenaiClient:
+    def __init__(
+        self,
+        latency: float = 0.0,
+        error_rate: float = 0.0,
+        seed: int = 0,
+        chunk_separator: str = "<SEPARATOR_RAG_CHUNK>",
+        stop_sequence: str = "<STOP_RAG_CHUNKS>",
+    ):
+        """Stand-in for genai.Client, answering after `latency` seconds and
+        failing with a 429 for a share `error_rate` of the calls.
+
+        Chunking splits the content on its headings and embeddings are
+        hashed from the words of the texts.
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.chunk_separator = chunk_separator
+        self.stop_sequence = stop_sequence
+        self.calls = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+        self.models = SimpleNamespace(
+            generate_content=self.generate_content,
+            embed_content=self.embed_content,
+        )
+
+    def _call(self) -> None:
+        with self.lock:
+            self.calls += 1
+            failed = self.random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        if failed:
+            raise FakeAPIError(429, "resource exhausted")
+
+    def generate_content(self, model: str, contents: str, config=None):
+        self._call()
+
+        sections: list[list[str]] = []
+        fenced = False
+
+        for line in contents.split("\n")[1:]:
+            if line.startswith("```"):
+                fenced = not fenced
+            if line.startswith("#") and not fenced or not sections:
+                sections.append([])
+            sections[-1].append(line)
+
+        chunks = ["\n".join(lines).strip() for lines in sections]
+        text = f"\n\n{self.chunk_separator}\n\n".join(c for c in chunks if c)
+
+        return SimpleNamespace(text=f"{text}\n\n{self.stop_sequence}")
+
+    def embed_content(self, model: str, contents: str | list[str], config=None):
+        self._call()
+
+        texts = [contents] if isinstance(contents, str) else contents
+        # like the model, shorter vectors are the first dimensions of the
+        # full ones, not normalized again.
+        dimensions = getattr(config, "output_dimensionality", None) or 768
+        embeddings = [
+            SimpleNamespace(values=fake_embedding(text)[:dimensions]) for text in texts
+        ]
+
+        return SimpleNamespace(embeddings=embeddings)
@@ -0,0 +1,222 @@
+import re
+import gzip
+import posixpath
+from collections import deque
+from typing import Callable, Optional
+from xml.etree import ElementTree
+from urllib.parse import urlparse, urlunparse, urljoin, parse_qsl, urlencode
+
+# Query parameters which never change the content of a page.
+TRACKING_PARAMS = {"fbclid", "gclid", "msclkid", "ref", "ref_src", "mc_cid", "mc_eid"}
+
+# Directory index files served at the same address as their directory.
+INDEX_FILES = {"index.html", "index.htm", "index.php"}
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+MARKDOWN_LINK = re.compile(r"\[[^\]]*\]\(\s*([^)\s]+)[^)]*\)")
+
+
+def normalize_url(url: str) -> Optional[str]:
+    """Canonical form of an absolute http url, None for anything else.
+
+    The scheme and host are lowercased, the default port, the fragment,
+    tracking parameters, dot segments, directory index files and the
+    trailing slash are removed and the remaining parameters are sorted.
+    """
+    try:
+        parsed = urlparse(url.strip())
+        port = parsed.port
+    except ValueError:
+        return None
+
+    scheme = parsed.scheme.lower()
+
+    if scheme not in DEFAULT_PORTS or not parsed.hostname:
+        return None
+
+    netloc = parsed.hostname.lower()
+    if port and port != DEFAULT_PORTS[scheme]:
+        netloc = f"{netloc}:{port}"
+
+    path = re.sub(r"/{2,}", "/", parsed.path or "/")
+    path = posixpath.normpath(path) if path != "/" else path
+    if posixpath.basename(path).lower() in INDEX_FILES:
+        path = posixpath.dirname(path)
+    path = path.rstrip("/")
+
+    query = urlencode(
+        sorted(
+            (key, value)
+            for key, value in parse_qsl(parsed.query, keep_blank_values=True)
+            if not key.lower().startswith("utm_")
+            and key.lower() not in TRACKING_PARAMS
+        )
+    )
+
+    return urlunparse((scheme, netloc, path, "", query, ""))
+
+
+class PrefixTrie:
+    def __init__(self, prefixes: list[str]):
+        """Match a string against many prefixes in a single walk."""
+        self.root: dict = {}
+
+        for prefix in prefixes:
+            node = self.root
+            for char in prefix:
+                node = node.setdefault(char, {})
+            node[None] = True
+
+    def match(self, value: str) -> bool:
+        node = self.root
+
+        if None in node:
+            return True
+
+        for char in value:
+            node = node.get(char)
+            if node is None:
+                return False
+            if None in node:
+                return True
+
+        return False
+
+
+class Frontier:
+    def __init__(self):
+        """Breadth first queue of the urls to crawl, each url queued once."""
+        self.queue: deque[str] = deque()
+        self.seen: set[str] = set()
+        self.lastmod: dict[str, str] = {}
+
+    def push(self, url: str, lastmod: Optional[str] = None) -> bool:
+        if lastmod:
+            self.lastmod[url] = lastmod
+
+        if url in self.seen:
+            return False
+
+        self.seen.add(url)
+        self.queue.append(url)
+
+        return True
+
+    def pop(self) -> str:
+        return self.queue.popleft()
+
+    def __len__(self) -> int:
+        return len(self.queue)
+
+
+def _xml_root(content: bytes) -> Optional[ElementTree.Element]:
+    # sitemaps may be served gzipped without a content encoding header.
+    if content[:2] == b"\x1f\x8b":
+        content = gzip.decompress(content)
+
+    try:
+        return ElementTree.fromstring(content)
+    except ElementTree.ParseError:
+        return None
+
+
+def _local_name(element: ElementTree.Element) -> str:
+    return element.tag.rsplit("}", 1)[-1]
+
+
+def _child_text(element: ElementTree.Element, name: str) -> Optional[str]:
+    for child in element:
+        if _local_name(child) == name and child.text:
+            return child.text.strip()
+
+    return None
+
+
+def parse_sitemap(content: bytes) -> tuple[dict[str, Optional[str]], list[str]]:
+    """Page urls with their lastmod, and nested sitemap urls of an index."""
+    pages: dict[str, Optional[str]] = {}
+    sitemaps: list[str] = []
+    root = _xml_root(content)
+
+    if root is None:
+        return pages, sitemaps
+
+    for element in root:
+        loc = _child_text(element, "loc")
+        if not loc:
+            continue
+        if _local_name(element) == "sitemap":
+            sitemaps.append(loc)
+        elif _local_name(element) == "url":
+            pages[loc] = _child_text(element, "lastmod")
+
+    return pages, sitemaps
+
+
+def parse_robots_sitemaps(content: str) -> list[str]:
+    return [
+        line.split(":", 1)[1].strip()
+        for line in content.splitlines()
+        if line.lower().startswith("sitemap:")
+    ]
+
+
+def parse_llms_txt(base_url: str, content: str) -> list[str]:
+    urls = []
+
+    for href in MARKDOWN_LINK.findall(content):
+        url = urljoin(base_url + "/", href)
+        # llms.txt links the markdown rendition of the pages.
+        path = urlparse(url).path
+        if path.endswith("/index.md"):
+            url = url[: url.rfind("index.md")]
+        elif path.endswith(".md"):
+            url = url[: url.rfind(".md")]
+        urls.append(url)
+
+    return urls
+
+
+def discover_seeds(
+    base_url: str,
+    get: Callable[[str], Optional[bytes]],
+    max_sitemaps: int = 50,
+) -> dict[str, Optional[str]]:
+    """Seed urls from robots.txt, sitemap.xml and llms.txt, with their lastmod.
+
+    `get` returns the body of a url or None when it can not be fetched.
+    """
+    seeds: dict[str, Optional[str]] = {}
+    parsed = urlparse(base_url)
+    root = f"{parsed.scheme}://{parsed.netloc}"
+
+    robots = get(f"{root}/robots.txt")
+    sitemaps = []
+    if robots:
+        sitemaps = parse_robots_sitemaps(robots.decode("utf-8", "replace"))
+    sitemaps = sitemaps or [f"{root}/sitemap.xml"]
+
+    # walk the sitemap indexes, bounded in case of cycles.
+    visited: set[str] = set()
+    while sitemaps and len(visited) < max_sitemaps:
+        sitemap = sitemaps.pop(0)
+        if sitemap in visited:
+            continue
+        visited.add(sitemap)
+
+        content = get(sitemap)
+        if not content:
+            continue
+
+        pages, nested = parse_sitemap(content)
+        seeds.update(pages)
+        sitemaps.extend(nested)
+
+    for llms in {f"{root}/llms.txt", f"{base_url.rstrip('/')}/llms.txt"}:
+        content = get(llms)
+        if content:
+            for url in parse_llms_txt(base_url, content.decode("utf-8", "replace")):
+                seeds.setdefault(url, None)
+
+    return seeds
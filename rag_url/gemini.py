@@ -0,0 +1,55 @@
+import os
+import math
+from typing import Any, Optional
+from google import genai
+from google.genai import types
+
+# Status codes worth retrying: rate limited, timed out or server side errors.
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+
+def make_client() -> genai.Client:
+    GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+
+    if not GEMINI_API_KEY:
+        raise Exception("GEMINI_API_KEY env var must be defined")
+
+    return genai.Client(api_key=GEMINI_API_KEY)
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+
+    return getattr(error, "code", None) in RETRYABLE_STATUS_CODES
+
+
+def embed_config(dimensions: Optional[int]) -> Optional[types.EmbedContentConfig]:
+    """Ask for vectors truncated to `dimensions`, the embedding models keep
+    most of the meaning in the first ones.
+    """
+    if dimensions is None:
+        return None
+
+    return types.EmbedContentConfig(output_dimensionality=dimensions)
+
+
+def embed_model_key(model: str, dimensions: Optional[int]) -> str:
+    # vectors of another size are other vectors for the cache, the truncated
+    # ones are cached once normalized.
+    return model if dimensions is None else f"{model}:{dimensions}:unit"
+
+
+def embedding_values(embedding: Any, dimensions: Optional[int]) -> list[float]:
+    """The vector of an embedding, scaled back to unit length when it was
+    truncated to `dimensions`: the model only normalizes the full vectors,
+    and the similarities across collections assume unit ones.
+    """
+    values = list(embedding.values)
+
+    if dimensions is None:
+        return values
+
+    norm = math.sqrt(sum(value * value for value in values))
+
+    return [value / norm for value in values] if norm else values
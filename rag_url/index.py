@@ -0,0 +1,279 @@
+import numpy as np
+from typing import Any, Optional
+from concurrent.futures import ThreadPoolExecutor
+from rag_url.options import INDEX_TYPES, VECTOR_TYPE_NAMES
+
+# Columns of the full text index, code holds the exact api names.
+FTS_COLUMNS = ("text", "code")
+
+# Storage types of the vectors, by their command line name.
+VECTOR_TYPES = {name: np.dtype(name) for name in VECTOR_TYPE_NAMES}
+
+# Candidates fetched on the compact vectors for each result re-ranked on the
+# full precision ones.
+RERANK_FACTOR = 4
+
+# Partitions lancedb lets a query always probe: it checks the minimum against
+# the default maximum, 20, before setting the maximum.
+MAX_NPROBES = 20
+
+# Columns returned by the searches, without the vectors.
+RESULT_COLUMNS = ["id", "text", "code", "url", "urls", "chunk_index"]
+
+
+def result_columns(table: Any) -> list[str]:
+    """The result columns the table has, older collections lack some."""
+    return [column for column in RESULT_COLUMNS if column in table.schema.names]
+
+
+def vector_dimensions(table: Any) -> int:
+    return table.schema.field("vector").type.list_size
+
+
+def vector_index(table: Any) -> Optional[Any]:
+    """Statistics of the index on the vector column, None without one."""
+    for index in table.list_indices():
+        if "vector" in index.columns:
+            return table.index_stats(index.name)
+
+    return None
+
+
+def build_index(
+    table: Any,
+    index_type: str = "ivf_pq",
+    metric: str = "cosine",
+    num_partitions: Optional[int] = None,
+    num_sub_vectors: Optional[int] = None,
+) -> None:
+    """Replace the vector index of the table.
+
+    Lance picks the number of partitions (about the square root of the number
+    of rows) and of PQ sub-vectors (a sixteenth of the dimensions) when they
+    are not given.
+    """
+    options = {}
+    if num_partitions:
+        options["num_partitions"] = num_partitions
+    if num_sub_vectors and index_type == "ivf_pq":
+        options["num_sub_vectors"] = num_sub_vectors
+
+    table.create_index(
+        metric=metric,
+        vector_column_name="vector",
+        index_type=INDEX_TYPES[index_type],
+        replace=True,
+        **options,
+    )
+
+
+def needs_index(
+    table: Any, index_type: str, metric: str, threshold: int, stale: float = 0.1
+) -> bool:
+    """Whether the table is large enough for an index, and has none matching
+    the settings or one missing more than `stale` of the rows.
+    """
+    rows = table.count_rows()
+
+    if rows < threshold:
+        return False
+
+    stats = vector_index(table)
+
+    if stats is None:
+        return True
+
+    return (
+        stats.index_type != INDEX_TYPES[index_type]
+        or stats.distance_type != metric
+        or stats.num_unindexed_rows > rows * stale
+    )
+
+
+def search(
+    table: Any,
+    vector: Any,
+    limit: int,
+    metric: Optional[str] = None,
+    nprobes: Optional[int] = None,
+    refine_factor: Optional[int] = None,
+) -> Any:
+    """Vector query on the table, using its index when it has one.
+
+    More probed partitions and a refine factor (re-ranking that many times
+    `limit` candidates on the full vectors) trade latency for recall. Past
+    `MAX_NPROBES`, the partitions beyond it are only probed when the first
+    ones do not hold enough rows, and lance stops at the number of
+    partitions of the index.
+    """
+    query = table.search(vector, vector_column_name="vector").limit(limit)
+
+    if metric:
+        query = query.distance_type(metric)
+    if nprobes:
+        query = query.minimum_nprobes(min(nprobes, MAX_NPROBES))
+        query = query.maximum_nprobes(nprobes)
+    if refine_factor:
+        query = query.refine_factor(refine_factor)
+
+    return query
+
+
+def rerank(
+    rows: list[dict], vector: Any, limit: int, metric: Optional[str] = None
+) -> list[dict]:
+    """The `limit` rows closest to the vector by their full precision vector,
+    with the same distances as lance (squared l2 by default).
+    """
+    if not rows:
+        return rows
+
+    matrix = np.array([row.pop("full_vector") for row in rows], dtype=np.float32)
+    query = np.asarray(vector, dtype=np.float32)
+
+    if metric == "cosine":
+        norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(query)
+        distances = 1 - matrix @ query / np.maximum(norms, 1e-12)
+    elif metric == "dot":
+        distances = 1 - matrix @ query
+    else:
+        distances = ((matrix - query) ** 2).sum(axis=1)
+
+    for row, distance in zip(rows, distances):
+        row["_distance"] = float(distance)
+
+    return [rows[i] for i in np.argsort(distances, kind="stable")[:limit]]
+
+
+def nearest(
+    table: Any,
+    vector: Any,
+    limit: int,
+    metric: Optional[str] = None,
+    nprobes: Optional[int] = None,
+    refine_factor: Optional[int] = None,
+) -> list[dict]:
+    """The rows closest to the vector. Collections storing compact vectors
+    and their full precision copy are searched on the first and re-ranked on
+    the second.
+    """
+    columns = result_columns(table)
+
+    if "full_vector" not in table.schema.names:
+        query = search(table, vector, limit, metric, nprobes, refine_factor)
+        return query.select(columns).to_list()
+
+    candidates = RERANK_FACTOR * limit
+    query = search(table, vector, candidates, metric, nprobes, refine_factor)
+
+    rows = query.select(columns + ["full_vector"]).to_list()
+
+    return rerank(rows, vector, limit, metric)
+
+
+def has_fts_index(table: Any) -> bool:
+    indexed = {
+        column
+        for index in table.list_indices()
+        if index.index_type == "FTS"
+        for column in index.columns
+    }
+
+    return all(column in indexed for column in FTS_COLUMNS)
+
+
+def build_fts_index(table: Any) -> None:
+    """Replace the BM25 full text indexes of the text and code columns."""
+    for column in FTS_COLUMNS:
+        table.create_fts_index(column, replace=True)
+
+
+def reciprocal_rank_fusion(
+    rankings: list[list[dict]],
+    limit: int,
+    k: int = 60,
+    weights: Optional[list[float]] = None,
+) -> list[dict]:
+    """Merge rankings of rows by their id, scoring a row weight / (k + rank)
+    in each ranking it appears in, the weights being 1 by default.
+    """
+    scores: dict[str, float] = {}
+    rows: dict[str, dict] = {}
+
+    for ranking, weight in zip(rankings, weights or [1.0] * len(rankings)):
+        for rank, row in enumerate(ranking, start=1):
+            scores[row["id"]] = scores.get(row["id"], 0.0) + weight / (k + rank)
+            rows.setdefault(row["id"], row)
+
+    best = sorted(scores, key=lambda row_id: scores[row_id], reverse=True)
+
+    return [rows[row_id] for row_id in best[:limit]]
+
+
+def similarities(rows: list[dict], metric: Optional[str] = None) -> list[float]:
+    """Cosine similarity of the rows to the query, from their distances
+    (squared l2 ones taken for unit vectors), comparable across collections.
+
+    Rows found by the full text search alone have no distance, their exact
+    terms count as much as the closest vector: they score as the best row.
+    """
+    scale = 1.0 if metric in ("cosine", "dot") else 0.5
+    scores = [
+        1 - scale * row["_distance"] if "_distance" in row else None for row in rows
+    ]
+    best = max((score for score in scores if score is not None), default=0.0)
+
+    return [best if score is None else score for score in scores]
+
+
+def merge_by_score(
+    rankings: list[tuple[list[dict], list[float]]], limit: int
+) -> list[dict]:
+    """The `limit` best rows of rankings scored on the same scale, with their
+    `score`, the rows of a ranking scoring the same keeping their order.
+    """
+    scored = [
+        {**row, "score": score}
+        for rows, scores in rankings
+        for row, score in zip(rows, scores)
+    ]
+
+    return sorted(scored, key=lambda row: row["score"], reverse=True)[:limit]
+
+
+def hybrid_search(
+    table: Any,
+    vector: Any,
+    text: str,
+    limit: int,
+    metric: Optional[str] = None,
+    nprobes: Optional[int] = None,
+    refine_factor: Optional[int] = None,
+    depth: Optional[int] = None,
+) -> list[dict]:
+    """Vector and full text searches run concurrently, each fetching `depth`
+    candidates, twice `limit` by default, fused with reciprocal rank fusion.
+
+    Each full text column is searched on its own: searched together, the
+    scores of the code, which most chunks lack, bury the matches in the text.
+    The vector ranking weighs as much as the full text ones together.
+    """
+    # deeper rankings reorder the head of the fused one.
+    candidates = depth or 2 * limit
+    columns = result_columns(table)
+
+    def semantic() -> list[dict]:
+        return nearest(table, vector, candidates, metric, nprobes, refine_factor)
+
+    def lexical(column: str) -> list[dict]:
+        query = table.search(text, query_type="fts", fts_columns=[column])
+        return query.select(columns).limit(candidates).to_list()
+
+    with ThreadPoolExecutor(max_workers=1 + len(FTS_COLUMNS)) as pool:
+        rankings = [pool.submit(semantic)]
+        rankings += [pool.submit(lexical, column) for column in FTS_COLUMNS]
+        weights = [float(len(FTS_COLUMNS))] + [1.0] * len(FTS_COLUMNS)
+
+        return reciprocal_rank_fusion(
+            [r.result() for r in rankings], limit, weights=weights
+        )
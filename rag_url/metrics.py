@@ -0,0 +1,248 @@
+import os
+import json
+import time
+import threading
+import tracemalloc
+from pathlib import Path
+from typing import Any, Optional
+
+# Upper bounds of the timer buckets, from 1ms to about a minute.
+BUCKETS = tuple(0.001 * 2**i for i in range(17))
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds: float) -> None:
+        index = 0
+        while index < len(BUCKETS) and seconds > BUCKETS[index]:
+            index += 1
+
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the `q` quantile."""
+        seen = 0
+
+        for bound, count in zip(BUCKETS + (float("inf"),), self.counts):
+            seen += count
+            if seen >= q * self.count:
+                return bound
+
+        return float("inf")
+
+
+class Timer:
+    def __init__(self, metrics: "Metrics", name: str):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self) -> "Timer":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.metrics.observe(self.name, time.perf_counter() - self.start)
+
+
+class NullTimer:
+    def __enter__(self) -> "NullTimer":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+class Stage:
+    def __init__(self, metrics: "Metrics", name: str):
+        self.metrics = metrics
+        self.name = name
+        self.profiler: Any = None
+
+    def __enter__(self) -> "Stage":
+        metrics = self.metrics
+        metrics.event("stage_start", stage=self.name)
+
+        if metrics.profile == self.name:
+            # only imported when profiling, the command line starts faster.
+            import cProfile
+
+            self.output = Path(f"{self.name}.prof").resolve()
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        if metrics.trace_memory == self.name:
+            tracemalloc.start()
+
+        self.start = time.perf_counter()
+
+        return self
+
+    def __exit__(self, *exc) -> None:
+        metrics = self.metrics
+        elapsed = time.perf_counter() - self.start
+
+        if self.profiler is not None:
+            import pstats
+
+            self.profiler.disable()
+            self.profiler.dump_stats(self.output)
+            print(f"[INFO] profile of stage '{self.name}' saved in {self.output}")
+            pstats.Stats(self.profiler).sort_stats("cumulative").print_stats(20)
+
+        if tracemalloc.is_tracing() and metrics.trace_memory == self.name:
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f"[INFO] stage '{self.name}' peak traced memory {peak / 2**20:.1f}MB")
+            for stat in snapshot.statistics("lineno")[:10]:
+                print(f"[INFO] {stat}")
+
+        metrics.observe(f"{self.name}_seconds", elapsed)
+        metrics.event("stage_end", stage=self.name, seconds=round(elapsed, 6))
+        metrics.export()
+
+
+class Metrics:
+    def __init__(self):
+        """Counters, gauges and timers shared by the stages.
+
+        Disabled by default, every call then returns right away.
+        """
+        self.enabled = False
+        self.path: Optional[Path] = None
+        self.profile: Optional[str] = None
+        self.trace_memory: Optional[str] = None
+        self.counters: dict[str, float] = {}
+        self.gauges: dict[str, float] = {}
+        self.timers: dict[str, Histogram] = {}
+        self.lock = threading.Lock()
+
+    def configure(
+        self,
+        path: Optional[str] = None,
+        profile: Optional[str] = None,
+        trace_memory: Optional[str] = None,
+    ) -> None:
+        """Record the metrics, exported to `path` at the end of each stage:
+        as Prometheus text when it ends in .prom, as json lines otherwise.
+
+        The stage named `profile` runs under cProfile, which only sees the
+        thread running the stage, and the one named `trace_memory` under
+        tracemalloc.
+        """
+        # stages may change the working directory.
+        self.path = Path(path).resolve() if path else None
+        self.profile = profile
+        self.trace_memory = trace_memory
+        self.enabled = bool(path or profile or trace_memory)
+
+    def count(self, name: str, value: float = 1) -> None:
+        if not self.enabled:
+            return
+
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name: str, value: float) -> None:
+        if not self.enabled:
+            return
+
+        with self.lock:
+            self.gauges[name] = value
+
+    def observe(self, name: str, seconds: float) -> None:
+        if not self.enabled:
+            return
+
+        with self.lock:
+            if name not in self.timers:
+                self.timers[name] = Histogram()
+            self.timers[name].observe(seconds)
+
+    def timer(self, name: str) -> Timer | NullTimer:
+        """Context timing its block under `name`."""
+        return Timer(self, name) if self.enabled else NULL_TIMER
+
+    def stage(self, name: str) -> Stage | NullTimer:
+        """Context timing a stage, profiling it if asked, and exporting the
+        metrics when it ends.
+        """
+        return Stage(self, name) if self.enabled else NULL_TIMER
+
+    def snapshot(self) -> dict[str, Any]:
+        with self.lock:
+            return {
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "timers": {
+                    name: {
+                        "count": h.count,
+                        "sum": round(h.sum, 6),
+                        "p50": h.quantile(0.5),
+                        "p95": h.quantile(0.95),
+                    }
+                    for name, h in self.timers.items()
+                },
+            }
+
+    def _write_jsonl(self, record: dict[str, Any]) -> None:
+        with self.lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record) + "\n")
+
+    def event(self, name: str, **fields: Any) -> None:
+        """Append an event to the json lines log, if there is one."""
+        if not self.enabled or self.path is None or self.path.suffix == ".prom":
+            return
+
+        self._write_jsonl({"time": time.time(), "event": name, **fields})
+
+    def prometheus(self) -> str:
+        """The metrics in the Prometheus text exposition format."""
+        lines = []
+
+        with self.lock:
+            for name, value in sorted(self.counters.items()):
+                lines.append(f"# TYPE rag_url_{name}_total counter")
+                lines.append(f"rag_url_{name}_total {value}")
+
+            for name, value in sorted(self.gauges.items()):
+                lines.append(f"# TYPE rag_url_{name} gauge")
+                lines.append(f"rag_url_{name} {value}")
+
+            for name, h in sorted(self.timers.items()):
+                lines.append(f"# TYPE rag_url_{name} histogram")
+                cumulative = 0
+                for bound, count in zip(BUCKETS, h.counts):
+                    cumulative += count
+                    lines.append(f'rag_url_{name}_bucket{{le="{bound:g}"}} {cumulative}')
+                lines.append(f'rag_url_{name}_bucket{{le="+Inf"}} {h.count}')
+                lines.append(f"rag_url_{name}_sum {h.sum}")
+                lines.append(f"rag_url_{name}_count {h.count}")
+
+        return "\n".join(lines) + "\n"
+
+    def export(self) -> None:
+        if not self.enabled or self.path is None:
+            return
+
+        if self.path.suffix != ".prom":
+            self._write_jsonl({"time": time.time(), "event": "metrics", **self.snapshot()})
+            return
+
+        # write aside and swap, a scraper never reads half a file.
+        tmppath = self.path.with_suffix(".tmp")
+        tmppath.write_text(self.prometheus(), encoding="utf-8")
+        os.replace(tmppath, self.path)
+
+
+# The metrics of the process, configured from the command line.
+metrics = Metrics()
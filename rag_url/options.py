@@ -0,0 +1,10 @@
+# Choices of the command line options, apart from the modules using them so
+# that parsing the command line imports nothing heavy.
+
+# Vector index types, by their command line name.
+INDEX_TYPES = {"ivf_pq": "IVF_PQ", "hnsw": "IVF_HNSW_SQ"}
+
+METRICS = ("cosine", "l2", "dot")
+
+# Storage types of the vectors, by their command line name.
+VECTOR_TYPE_NAMES = ("float32", "float16")
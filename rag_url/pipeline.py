@@ -0,0 +1,206 @@
+import time
+import queue
+import threading
+from typing import Iterator
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from rag_url.chunk import MarkdownChunker
+from rag_url.embed import ChunkEmbedder
+from rag_url.gemini import is_retryable
+from rag_url.metrics import metrics
+from rag_url.scrape import BaseUrlScraper
+
+# Put on a queue after the last page.
+DONE = None
+
+
+class WrittenPages:
+    def __init__(self, chunker: MarkdownChunker, names: list[str]):
+        """The url and chunks of the pages, read back from their json file or
+        the store each time they are iterated, one page in memory at a time.
+        """
+        self.chunker = chunker
+        self.names = names
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __iter__(self) -> Iterator[tuple[str, list]]:
+        for name in self.names:
+            page = self.chunker.read_chunks(name)
+            if page is not None:
+                yield page
+
+
+class BuildPipeline:
+    def __init__(
+        self,
+        scraper: BaseUrlScraper,
+        chunker: MarkdownChunker,
+        embedder: ChunkEmbedder,
+        queue_size: int = 64,
+        write: bool = True,
+    ):
+        """Scrape, chunk and embed a site in one run, each page going to the
+        next stage as soon as the previous one is done with it.
+
+        The stages run in their own threads, connected by queues of at most
+        `queue_size` pages, a stage waits when the next one falls behind.
+        The vectors are embedded ahead into the embedder cache, and stored
+        once every page is chunked, reading the chunks back from their json
+        files or the store. Without `write`, no markdown or json file is
+        written, and the chunks of every page are kept in memory until then.
+        """
+        if embedder.cache is None:
+            raise Exception("The build needs an embedding cache")
+
+        self.scraper = scraper
+        self.chunker = chunker
+        self.embedder = embedder
+        self.write = write
+        self.scraped: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.chunked: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.names: list[str] = []
+        self.pages: list[tuple[str, list]] = []
+        self.errors: list[Exception] = []
+
+        scraper.sink = self._put_scraped
+        scraper.write = write
+
+    def _put_scraped(self, filename: str, markdown: str) -> None:
+        # blocks the crawl while the chunking falls behind.
+        self.scraped.put((filename, markdown))
+
+    def _scrape(self) -> None:
+        try:
+            with metrics.stage("scrape"):
+                self.scraper.run()
+        except Exception as e:
+            self.errors.append(e)
+        finally:
+            self.scraped.put(DONE)
+
+    def _chunk_page(self, filename: str, markdown: str) -> tuple[str, list]:
+        name = filename.removesuffix(".md")
+
+        return self.chunker.chunk_markdown(name, markdown, write=self.write)
+
+    def _chunk_page_again(self, filename: str, markdown: str) -> tuple[str, list]:
+        # a retry waits out the backoff of the api before calling it again.
+        self.chunker.limiter.pause()
+
+        return self._chunk_page(filename, markdown)
+
+    def _chunk(self) -> None:
+        concurrency = self.chunker.concurrency
+        attempts: dict[str, int] = {}
+        pending: dict[Future, tuple[str, str]] = {}
+        finished = False
+
+        def submit(filename: str, markdown: str) -> None:
+            attempts[filename] = attempts.get(filename, 0) + 1
+            chunk = (
+                self._chunk_page_again if attempts[filename] > 1 else self._chunk_page
+            )
+            future = pool.submit(chunk, filename, markdown)
+            pending[future] = (filename, markdown)
+
+        try:
+            with metrics.stage("chunk"), ThreadPoolExecutor(concurrency) as pool:
+                while not finished or pending:
+                    # wait for pages only when nothing is being chunked.
+                    while not finished and len(pending) < 2 * concurrency:
+                        try:
+                            item = self.scraped.get(block=not pending)
+                        except queue.Empty:
+                            break
+
+                        if item is DONE:
+                            finished = True
+                        else:
+                            submit(*item)
+
+                    if not pending:
+                        continue
+
+                    done, _ = wait(pending, timeout=0.05, return_when=FIRST_COMPLETED)
+
+                    for future in done:
+                        filename, markdown = pending.pop(future)
+                        name = filename.removesuffix(".md")
+
+                        try:
+                            page = future.result()
+                        except Exception as e:
+                            retries = self.chunker.retries
+                            if is_retryable(e) and attempts[filename] <= retries:
+                                metrics.count("chunk_retries")
+                                submit(filename, markdown)
+                                continue
+
+                            metrics.count("chunk_failures")
+                            print(f"[ERROR] unable to chunk {filename}: {e}")
+
+                            # the page keeps the chunks of the previous run.
+                            page = self.chunker.read_chunks(name)
+                            if page is None:
+                                continue
+
+                        # blocks the chunking while the embedding falls behind.
+                        self.chunked.put((name, page))
+        except Exception as e:
+            self.errors.append(e)
+        finally:
+            self.chunked.put(DONE)
+
+    def _chunked_pages(self) -> Iterator[tuple[str, list]]:
+        while (item := self.chunked.get()) is not DONE:
+            name, page = item
+            # written pages are read back to be stored.
+            if self.write:
+                self.names.append(name)
+            else:
+                self.pages.append(page)
+            yield page
+
+    def run(self) -> None:
+        start = time.perf_counter()
+        threads = [
+            threading.Thread(target=self._scrape, daemon=True),
+            threading.Thread(target=self._chunk, daemon=True),
+        ]
+
+        for thread in threads:
+            thread.start()
+
+        with metrics.stage("embed"):
+            self.embedder.warm(self._chunked_pages())
+
+        for thread in threads:
+            thread.join()
+
+        # storing partial results would delete the rows of the pages missed.
+        if self.errors:
+            raise self.errors[0]
+
+        pages = WrittenPages(self.chunker, self.names) if self.write else self.pages
+
+        if not len(pages):
+            raise Exception("No page was built, the collection is left as it is")
+
+        # the rows of the pages the crawl failed on are not deleted.
+        if self.scraper.failed:
+            print(
+                f"[INFO] {self.scraper.failed} pages failed to scrape, keeping the"
+                f" chunks missing from this build"
+            )
+
+        if self.write:
+            self.chunker.remove_orphans()
+
+        with metrics.stage("store"):
+            self.embedder.run(pages, keep_stale=self.scraper.failed > 0)
+
+        print(
+            f"[INFO] {len(pages)} pages built in"
+            f" {time.perf_counter() - start:.1f}s"
+        )
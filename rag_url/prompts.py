@@ -1,3 +1,7 @@
+# Bump when the chunking prompts change, cached chunks are keyed on it.
+CHUNKING_PROMPT_VERSION = "1"
+
+
 def CHUNKING_SYSTEM_PROMP(CHUNK_SEPARATOR: str, STOP_SEQUENCE: str):
     return f"""
 # RAG Chunking System Prompt
@@ -0,0 +1,129 @@
+import time
+import random
+import threading
+from typing import Iterator
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int = 1):
+        """Allow `rate` acquisitions per second, with up to `burst` at once."""
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _reserve(self) -> float:
+        # take a token (possibly going into debt) and return the time to wait.
+        with self.lock:
+            now = time.monotonic()
+            elapsed = now - self.updated
+            self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+            self.updated = now
+            self.tokens -= 1
+
+            if self.tokens >= 0:
+                return 0.0
+
+            return -self.tokens / self.rate
+
+    def acquire(self) -> None:
+        # a non positive rate means no limit.
+        if self.rate <= 0:
+            return
+
+        wait = self._reserve()
+
+        if wait > 0:
+            time.sleep(wait)
+
+
+class HostRateLimiter:
+    def __init__(self, rate: float, burst: int = 1):
+        """One token bucket per host, created on first use."""
+        self.rate = rate
+        self.burst = burst
+        self.buckets: dict[str, TokenBucket] = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, url: str) -> None:
+        host = urlparse(url).netloc.lower()
+
+        with self.lock:
+            bucket = self.buckets.get(host)
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.burst)
+                self.buckets[host] = bucket
+
+        bucket.acquire()
+
+
+class AdaptiveLimiter:
+    def __init__(
+        self, concurrency: int, min_delay: float = 1.0, max_delay: float = 60.0
+    ):
+        """Concurrency limit which halves when throttled and grows back on success.
+
+        A throttled call also pauses every caller for an exponentially growing
+        delay, reset by the next success.
+        """
+        self.max_concurrency = max(1, concurrency)
+        self.limit = float(self.max_concurrency)
+        self.in_flight = 0
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.delay = min_delay
+        self.resume_at = 0.0
+        self.throttles = 0
+        self.condition = threading.Condition()
+
+    def acquire(self) -> None:
+        with self.condition:
+            while True:
+                wait = self.resume_at - time.monotonic()
+
+                if wait <= 0 and self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return
+
+                self.condition.wait(timeout=wait if wait > 0 else None)
+
+    def release(self) -> None:
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def pause(self) -> None:
+        """Wait for the end of the pause of a throttled call, if any."""
+        with self.condition:
+            while (wait := self.resume_at - time.monotonic()) > 0:
+                self.condition.wait(timeout=wait)
+
+    def succeed(self) -> None:
+        with self.condition:
+            self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            self.delay = self.min_delay
+            self.condition.notify_all()
+
+    def throttle(self) -> None:
+        with self.condition:
+            now = time.monotonic()
+            self.throttles += 1
+
+            # the calls sent before the pause fail together, count them once.
+            if now < self.resume_at:
+                return
+
+            self.limit = max(1.0, self.limit / 2)
+            self.resume_at = now + self.delay * random.uniform(0.5, 1.0)
+            self.delay = min(self.max_delay, self.delay * 2)
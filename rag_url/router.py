@@ -0,0 +1,147 @@
+import time
+import threading
+import numpy as np
+from typing import Any, Callable
+from concurrent.futures import ThreadPoolExecutor
+from rag_url.index import vector_dimensions
+
+# Rows read in a collection to summarize it.
+SAMPLE_ROWS = 4096
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def sample_vectors(table: Any, rows: int = SAMPLE_ROWS) -> np.ndarray:
+    """About `rows` vectors of the table, evenly spread over it, in full
+    precision when the table keeps them.
+    """
+    column = "full_vector" if "full_vector" in table.schema.names else "vector"
+    dimensions = vector_dimensions(table)
+    step = max(1, -(-table.count_rows() // rows))
+    parts = [np.zeros((0, dimensions), np.float32)]
+    offset = 0
+
+    batches = table.search().select([column]).limit(None).to_batches(8192)
+
+    for batch in batches:
+        values = batch.column(column).flatten().to_numpy(zero_copy_only=False)
+        values = values.reshape(-1, dimensions)
+        # every step-th row of the table, wherever the batches start.
+        parts.append(values[(-offset) % step :: step].astype(np.float32))
+        offset += len(values)
+
+    return np.concatenate(parts)
+
+
+def summarize(
+    vectors: np.ndarray, centroids: int = 8, iterations: int = 10, seed: int = 0
+) -> np.ndarray:
+    """Unit centroids of the vectors found by spherical k-means, a collection
+    covering several topics gets one for each of them.
+    """
+    vectors = _normalize(vectors)
+
+    if len(vectors) <= centroids:
+        return vectors
+
+    rng = np.random.default_rng(seed)
+    means = vectors[rng.choice(len(vectors), centroids, replace=False)]
+
+    for _ in range(iterations):
+        assigned = np.argmax(vectors @ means.T, axis=1)
+        for i in range(centroids):
+            members = vectors[assigned == i]
+            # a centroid left without vectors keeps its place.
+            if len(members):
+                means[i] = members.sum(axis=0)
+        means = _normalize(means)
+
+    return means
+
+
+class CollectionRouter:
+    def __init__(
+        self,
+        fanout: int = 4,
+        centroids: int = 8,
+        sample_rows: int = SAMPLE_ROWS,
+        refresh: float = 60.0,
+    ):
+        """Picks the `fanout` collections of a db whose content is the
+        closest to a query, the others are not searched.
+
+        Each collection is summarized by `centroids` unit vectors computed on
+        `sample_rows` of its vectors, and scored by the best cosine
+        similarity of the query to them. The summaries are kept in memory
+        and computed again when the table version changes, checked at most
+        every `refresh` seconds so that routing does not open every table.
+        """
+        if fanout < 1:
+            raise Exception("The router needs to search at least one collection")
+
+        self.fanout = fanout
+        self.centroids = centroids
+        self.sample_rows = sample_rows
+        self.refresh = refresh
+        # collection -> (table version, centroids, time checked)
+        self.summaries: dict[str, tuple[int, np.ndarray, float]] = {}
+        self.lock = threading.Lock()
+
+    def summary(self, db: Any, name: str) -> np.ndarray:
+        """The centroids of the collection, of its vector dimensions."""
+        with self.lock:
+            cached = self.summaries.get(name)
+
+        if cached is not None and time.monotonic() - cached[2] < self.refresh:
+            return cached[1]
+
+        table = db.open_table(name)
+
+        if cached is not None and cached[0] == table.version:
+            centroids = cached[1]
+        else:
+            vectors = sample_vectors(table, self.sample_rows)
+            centroids = summarize(vectors, self.centroids)
+
+        with self.lock:
+            self.summaries[name] = (table.version, centroids, time.monotonic())
+
+        return centroids
+
+    def warm(self, db: Any, names: list[str]) -> None:
+        """Summarize the collections ahead of the first query."""
+        with ThreadPoolExecutor(max_workers=min(len(names), 8) or 1) as pool:
+            list(pool.map(lambda name: self.summary(db, name), names))
+
+    def scores(
+        self, db: Any, names: list[str], embed: Callable[[int], Any]
+    ) -> dict[str, float]:
+        """Similarity of the query to each collection, the query being
+        embedded by `embed` once for each vector dimensions.
+        """
+        summaries = {name: self.summary(db, name) for name in names}
+        queries = {
+            dimensions: _normalize(np.asarray(embed(dimensions), dtype=np.float32))
+            for dimensions in {summary.shape[1] for summary in summaries.values()}
+        }
+
+        # an empty collection has nothing to find.
+        return {
+            name: float((summary @ queries[summary.shape[1]]).max())
+            if len(summary)
+            else -1.0
+            for name, summary in summaries.items()
+        }
+
+    def route(self, db: Any, names: list[str], embed: Callable[[int], Any]) -> list[str]:
+        """The collections worth searching for the query, best first."""
+        if len(names) <= self.fanout:
+            return names
+
+        scores = self.scores(db, names, embed)
+
+        return sorted(names, key=lambda name: scores[name], reverse=True)[: self.fanout]
@@ -1,11 +1,122 @@
+import os
 import re
 import time
+import json
+import hashlib
+import threading
+import multiprocessing
 import requests
 import trafilatura
-from typing import Any
+from typing import Callable, TypedDict, Optional
 from pathlib import Path
-from bs4 import BeautifulSoup, Tag
-from urllib.parse import urlparse, urljoin
+from lxml.html import HtmlElement
+from trafilatura.utils import load_html
+from urllib.parse import urlparse, urljoin, urlunparse
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from concurrent.futures.process import BrokenProcessPool
+from rag_url.metrics import metrics
+from rag_url.ratelimit import HostRateLimiter
+from rag_url.frontier import Frontier, PrefixTrie, discover_seeds, normalize_url
+from rag_url.store import STORE_FILENAME
+
+
+class ScrapedPage(TypedDict):
+    url: str
+    links: list[str]
+    markdown: Optional[str]
+    error: Optional[str]
+    timings: dict[str, float]
+
+
+class ManifestEntry(TypedDict):
+    url: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+    hash: str
+    filename: str
+    links: list[str]
+    lastmod: Optional[str]
+
+
+class CrawlManifest:
+    filename = "manifest.jsonl"
+
+    def __init__(self, path: Path):
+        """The pages produced by the previous crawl, one json line per page."""
+        self.path = path
+
+    def load(self) -> dict[str, ManifestEntry]:
+        entries: dict[str, ManifestEntry] = {}
+
+        if not self.path.exists():
+            return entries
+
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    entry.setdefault("lastmod", None)
+                    entries[entry["url"]] = entry
+
+        return entries
+
+    def save(self, entries: dict[str, ManifestEntry]) -> None:
+        # write aside and swap so an interrupted run keeps the old manifest.
+        tmppath = self.path.with_suffix(".tmp")
+
+        with open(tmppath, "w", encoding="utf-8") as f:
+            for url in sorted(entries):
+                f.write(json.dumps(entries[url]) + "\n")
+
+        os.replace(tmppath, self.path)
+
+
+class PageTimer:
+    stages = ("fetch", "parse", "links", "extract", "write")
+
+    def __init__(self, verbose: bool = False):
+        """Per page time spent in each scraping stage, in seconds."""
+        self.verbose = verbose
+        self.pages: dict[str, dict[str, float]] = {}
+        self.totals = dict.fromkeys(self.stages, 0.0)
+        self.count = 0
+        # time spent on each page, all its stages together.
+        self.latencies: list[float] = []
+        self.lock = threading.Lock()
+
+    def add(self, url: str, timings: dict[str, float]) -> None:
+        for name, seconds in timings.items():
+            metrics.observe(f"scrape_{name}_seconds", seconds)
+
+        with self.lock:
+            self.pages.setdefault(url, {}).update(timings)
+
+    def done(self, url: str) -> None:
+        with self.lock:
+            timings = self.pages.pop(url, {})
+            self.count += 1
+            self.latencies.append(sum(timings.values()))
+            for name, seconds in timings.items():
+                self.totals[name] += seconds
+
+        if self.verbose:
+            print(f"[TIME] {url} {self._format(timings)}")
+
+    def _format(self, timings: dict[str, float]) -> str:
+        return " ".join(
+            f"{name}={timings[name] * 1000:.1f}ms"
+            for name in self.stages
+            if name in timings
+        )
+
+    def summary(self) -> str:
+        return f"{self.count} pages, total {self._format(self.totals)}"
 
 
 class BaseUrlScraper:
@@ -13,25 +124,95 @@ class BaseUrlScraper:
         self,
         workdir: str,
         base_url: str,
-        delay: float = 0.1,
+        rate: float = 10.0,
         excluded_paths: list[str] | None = None,
+        concurrency: int = 8,
+        burst: int = 1,
+        parse_workers: int | None = None,
+        timeout: float = 30.0,
+        full: bool = False,
+        timings: bool = False,
+        seed: bool = True,
+        sink: Optional[Callable[[str, str], None]] = None,
+        write: bool = True,
     ):
-        self.base_url = base_url.rstrip("/")
+        """Scrape the pages under base_url as markdown files in workdir.
+
+        `sink` is called with the file name and the markdown of every page
+        of the site, changed or not, as soon as it is available. Without
+        `write` the pages are only given to the sink. `failed` counts the
+        pages of the last run which could not be scraped, and `timer` has
+        the time spent on its pages.
+
+        The pages are parsed in `parse_workers` processes started with
+        spawn, which import the main module again: a script running the
+        scraper needs an `if __name__ == "__main__":` guard. Without one the
+        workers die, and the pages are parsed in this process instead.
+        """
+        base = normalize_url(base_url)
+
+        if base is None:
+            raise Exception(f"Invalid base url {base_url}")
+
+        self.base_url = base
+        self.netloc = urlparse(base).netloc
         self.workdir = workdir
-        self.delay = delay
+        self.rate = rate
+        self.burst = burst
+        self.concurrency = concurrency
+        self.parse_workers = parse_workers
+        self.timeout = timeout
+        self.full = full
+        self.timings = timings
+        self.seed = seed
+        self.sink = sink
+        self.write = write
         self.excluded_paths = [url.rstrip("/") for url in excluded_paths or []]
+        self.excluded = PrefixTrie(self.excluded_paths)
+        self.failed = 0
+        self.timer = PageTimer(timings)
+
+    def __getstate__(self) -> dict:
+        # the parse workers get a copy of the scraper, the sink stays here.
+        state = self.__dict__.copy()
+        state["sink"] = None
+        state["timer"] = None
+
+        return state
 
     def _is_valid_url(self, url: str) -> bool:
-        parsed_base = urlparse(self.base_url)
-        parsed_url = urlparse(url.rstrip("/"))
+        """Whether a normalized url belongs to the crawled site."""
+        parsed_url = urlparse(url)
 
-        if parsed_url.fragment:
+        if not parsed_url.netloc == self.netloc:
             return False
 
-        if not parsed_base.netloc == parsed_url.netloc:
-            return False
+        return not self.excluded.match(parsed_url.path)
+
+    def _seed_url(self, url: str) -> Optional[str]:
+        """A url found in the sitemap or llms.txt, normalized and written with
+        the scheme and host of the base url, None when it is not under its
+        path.
+        """
+        normalized = normalize_url(url)
+
+        if normalized is None:
+            return None
 
-        return not any([parsed_url.path.startswith(e) for e in self.excluded_paths])
+        parsed = urlparse(normalized)
+        base = urlparse(self.base_url)
+
+        # the http and www variants of the site are the same pages.
+        if parsed.netloc.removeprefix("www.") != base.netloc.removeprefix("www."):
+            return None
+
+        # whole path segments, /docs does not hold /docs-old.
+        if parsed.path != base.path and not parsed.path.startswith(f"{base.path}/"):
+            return None
+
+        seed = urlunparse(parsed._replace(scheme=base.scheme, netloc=base.netloc))
+
+        return seed if self._is_valid_url(seed) else None
 
     def _url_to_filename(self, url):
         """Convert URL to a safe filepath"""
@@ -47,26 +228,28 @@ class BaseUrlScraper:
 
         return f"{filename}.md"
 
-    def _extract_urls(self, url: str, soup: BeautifulSoup) -> list[str]:
+    def _extract_urls(self, url: str, tree: HtmlElement) -> list[str]:
         urls = set()
 
-        for link in soup.find_all("a", href=True):
-            if isinstance(link, Tag):
-                href = link.get("href")
-                if isinstance(href, str):
-                    urls.add(urljoin(url, href))
+        for link in tree.iter("a"):
+            href = link.get("href")
+            if href:
+                normalized = normalize_url(urljoin(url, href))
+                if normalized:
+                    urls.add(normalized)
 
-        return list(urls)
+        # sorted so the crawl order does not depend on set ordering.
+        return sorted(urls)
 
-    def _clean_markup(self, soup: BeautifulSoup) -> str:
+    def _clean_markup(self, tree: HtmlElement) -> HtmlElement:
         # No need the links for a rag system.
-        for link in soup.find_all("a"):
-            if isinstance(link, Tag):
-                link.unwrap()
+        for link in list(tree.iter("a")):
+            if link.getparent() is not None:
+                link.drop_tag()
 
-        return str(soup)
+        return tree
 
-    def _to_markdown(self, url: str, content: Any) -> str:
+    def _to_markdown(self, url: str, content: HtmlElement) -> str:
         markdown = trafilatura.extract(
             content,
             output_format="markdown",
@@ -80,64 +263,350 @@ class BaseUrlScraper:
 
         return "\n".join(["---", f"url: {url}", "---", "", markdown])
 
+    def _is_gone(self, error: Exception) -> bool:
+        response = getattr(error, "response", None)
+        return response is not None and response.status_code in (404, 410)
+
+    def _process_page(self, url: str, content: bytes) -> ScrapedPage:
+        """Parse a fetched page, runs in the parse worker processes."""
+        timings: dict[str, float] = {}
+        start = time.perf_counter()
+
+        def lap(name: str) -> None:
+            nonlocal start
+            now = time.perf_counter()
+            timings[name] = now - start
+            start = now
+
+        # parse once with the same loader trafilatura uses, the tree is then
+        # shared by the link extraction and the markdown conversion.
+        tree = load_html(content)
+        lap("parse")
+
+        if tree is None:
+            return ScrapedPage(
+                url=url,
+                links=[],
+                markdown=None,
+                error="Unable to parse page content as html.",
+                timings=timings,
+            )
+
+        # extract all urls so they are queued even when the conversion fails.
+        links = self._extract_urls(url, tree)
+        lap("links")
+
+        try:
+            # drop the links and convert the tree to markdown.
+            markdown = self._to_markdown(url, self._clean_markup(tree))
+            error = None
+        except Exception as e:
+            markdown = None
+            error = str(e)
+
+        lap("extract")
+
+        return ScrapedPage(
+            url=url, links=links, markdown=markdown, error=error, timings=timings
+        )
+
     def _empty_workdir(self, workpath: Path):
         for file in workpath.iterdir():
-            if file.is_file():
+            # the chunk store, and its wal files, may be open by the build.
+            if file.is_file() and not file.name.startswith(STORE_FILENAME):
                 file.unlink()
 
+    def _write_if_changed(self, filepath: Path, content: str) -> bool:
+        # leave unchanged files untouched so their mtime stays meaningful.
+        if filepath.exists() and filepath.read_text(encoding="utf-8") == content:
+            return False
+
+        with open(filepath, "w", encoding="utf-8") as f:
+            f.write(content)
+
+        return True
+
     def run(self) -> None:
-        found_urls = set()
         workpath = Path(self.workdir)
-        queue = [self.base_url]
-
-        session = requests.Session()
-        session.headers.update({"User-Agent": "rag-url/1.0"})
 
         if not workpath.exists():
             raise Exception(f"Workdir {workpath} does not exist")
 
-        self._empty_workdir(workpath)
+        manifest = CrawlManifest(workpath / CrawlManifest.filename)
+        self.failed = 0
+        self.timer = PageTimer(self.timings)
 
-        while queue:
-            current_url = queue.pop().rstrip("/")
+        if self.full:
+            self._empty_workdir(workpath)
 
-            if current_url in found_urls:
-                continue
+        previous = manifest.load()
+        entries: dict[str, ManifestEntry] = {}
 
-            if not self._is_valid_url(current_url):
-                continue
+        # one session per fetch thread, all of them sharing the host limiter.
+        local = threading.local()
+        limiter = HostRateLimiter(self.rate, self.burst)
+        timer = self.timer
+
+        def session() -> requests.Session:
+            if not hasattr(local, "session"):
+                local.session = requests.Session()
+                local.session.headers.update({"User-Agent": "rag-url/1.0"})
 
-            print(current_url)
+            return local.session
 
-            found_urls.add(current_url)
+        def fetch(url: str) -> requests.Response:
+            # revalidate the pages we already have on disk.
+            headers = {}
+            entry = previous.get(url)
+            if entry and (workpath / entry["filename"]).exists():
+                if entry["etag"]:
+                    headers["If-None-Match"] = entry["etag"]
+                if entry["last_modified"]:
+                    headers["If-Modified-Since"] = entry["last_modified"]
 
+            limiter.acquire(url)
+
+            start = time.perf_counter()
             try:
-                # get the page content.
-                response = session.get(current_url)
-                response.raise_for_status()
+                response = session().get(url, headers=headers, timeout=self.timeout)
+            finally:
+                timer.add(url, {"fetch": time.perf_counter() - start})
+
+            response.raise_for_status()
 
-                # parse with beautiful soup.
-                soup = BeautifulSoup(response.content, "html.parser")
+            metrics.count("pages_fetched")
+            metrics.count("bytes_fetched", len(response.content))
 
-                # extract all urls and queue unknown ones.
-                for url in self._extract_urls(current_url, soup):
-                    if not url in found_urls:
-                        queue.append(url)
+            return response
 
-                # get a cleaned markup.
-                markup = self._clean_markup(soup)
+        def get(url: str) -> Optional[bytes]:
+            # best effort fetch of the seeding files.
+            limiter.acquire(url)
+            try:
+                response = session().get(url, timeout=self.timeout)
+            except requests.RequestException:
+                return None
+
+            return response.content if response.ok else None
+
+        # fetching happens in threads, parsing and conversion in processes so
+        # the cpu bound work never stalls the in-flight requests.
+        fetch_pool = ThreadPoolExecutor(max_workers=self.concurrency)
+        parse_pool = ProcessPoolExecutor(
+            max_workers=self.parse_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
 
-                # convert the markup to markdown.
-                markdown = self._to_markdown(current_url, markup)
+        frontier = Frontier()
+        pending: dict[Future, tuple[str, str]] = {}
+        fetched: dict[str, ManifestEntry] = {}
+        # content of the pages being parsed, parsed again if the pool breaks.
+        parsing: dict[str, bytes] = {}
+        unchanged: list[str] = []
+        broken = False
+
+        def parse(url: str, content: bytes) -> None:
+            nonlocal broken
+
+            if not broken:
+                try:
+                    future = parse_pool.submit(self._process_page, url, content)
+                except BrokenProcessPool:
+                    broken = True
+
+            if broken:
+                future = fetch_pool.submit(self._process_page, url, content)
+
+            parsing[url] = content
+            pending[future] = ("parse", url)
+
+        def enqueue(url: str, lastmod: Optional[str] = None) -> None:
+            normalized = normalize_url(url)
+
+            if normalized and self._is_valid_url(normalized):
+                frontier.push(normalized, lastmod)
+
+        def keep(url: str, entry: ManifestEntry) -> None:
+            # keep the file of the page and crawl its known links.
+            entries[url] = entry
+            for link in entry["links"]:
+                enqueue(link)
+
+            filepath = workpath / entry["filename"]
+            if self.sink is not None and filepath.exists():
+                self.sink(entry["filename"], filepath.read_text(encoding="utf-8"))
+
+        def schedule() -> None:
+            # only hand the fetch pool what it can start soon, the rest of the
+            # crawl stays in the breadth first frontier.
+            fetching = sum(stage == "fetch" for stage, _ in pending.values())
+
+            while frontier and fetching < self.concurrency * 2:
+                url = frontier.pop()
+                entry = previous.get(url)
+                lastmod = frontier.lastmod.get(url)
+
+                # the sitemap says the page did not change since last time.
+                if (
+                    entry is not None
+                    and lastmod
+                    and entry["lastmod"] == lastmod
+                    and (workpath / entry["filename"]).exists()
+                ):
+                    unchanged.append(url)
+                    keep(url, entry)
+                    continue
+
+                print(url)
+
+                pending[fetch_pool.submit(fetch, url)] = ("fetch", url)
+                fetching += 1
+
+        try:
+            with fetch_pool, parse_pool:
+                enqueue(self.base_url)
+
+                if self.seed:
+                    seeds = discover_seeds(self.base_url, get)
+                    for url in sorted(seeds):
+                        seed = self._seed_url(url)
+                        if seed is not None:
+                            enqueue(seed, seeds[url])
+
+                schedule()
+
+                while pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+                    for future in done:
+                        stage, current_url = pending.pop(future)
+                        entry = previous.get(current_url)
+
+                        try:
+                            result = future.result()
+                        except BrokenProcessPool:
+                            if not broken:
+                                print(
+                                    "[ERROR] The parse workers died, parsing the pages"
+                                    " in this process. Is the script missing an"
+                                    ' `if __name__ == "__main__":` guard?'
+                                )
+                                broken = True
+                            parse(current_url, parsing.pop(current_url))
+                            continue
+                        except Exception as e:
+                            parsing.pop(current_url, None)
+                            print(f"[ERROR] error scraping url {current_url}: {e}")
+                            metrics.count("scrape_errors")
+                            self.failed += 1
+                            timer.done(current_url)
+                            # only a page reported gone is removed on error.
+                            if entry and not self._is_gone(e):
+                                keep(current_url, entry)
+                            continue
+
+                        if stage == "fetch":
+                            etag = result.headers.get("ETag")
+                            last_modified = result.headers.get("Last-Modified")
+                            lastmod = frontier.lastmod.get(current_url)
+                            digest = hashlib.sha256(result.content).hexdigest()
+
+                            if entry is not None and (
+                                result.status_code == 304
+                                or (
+                                    entry["hash"] == digest
+                                    and (workpath / entry["filename"]).exists()
+                                )
+                            ):
+                                unchanged.append(current_url)
+                                timer.done(current_url)
+                                keep(
+                                    current_url,
+                                    ManifestEntry(
+                                        url=current_url,
+                                        etag=etag or entry["etag"],
+                                        last_modified=last_modified
+                                        or entry["last_modified"],
+                                        hash=entry["hash"],
+                                        filename=entry["filename"],
+                                        links=entry["links"],
+                                        lastmod=lastmod or entry["lastmod"],
+                                    ),
+                                )
+                                continue
+
+                            fetched[current_url] = ManifestEntry(
+                                url=current_url,
+                                etag=etag,
+                                last_modified=last_modified,
+                                hash=digest,
+                                filename=self._url_to_filename(current_url),
+                                links=[],
+                                lastmod=lastmod,
+                            )
+
+                            # hand the fetched content to the parse workers.
+                            parse(current_url, result.content)
+                            continue
+
+                        parsing.pop(current_url)
+                        new_entry = fetched.pop(current_url)
+                        timer.add(current_url, result["timings"])
+
+                        # queue unknown urls.
+                        for url in result["links"]:
+                            enqueue(url)
+
+                        if result["markdown"] is None:
+                            error = result["error"]
+                            print(f"[ERROR] error scraping url {current_url}: {error}")
+                            metrics.count("scrape_errors")
+                            self.failed += 1
+                            timer.done(current_url)
+                            # the page keeps its previous file, as on a fetch error.
+                            if entry:
+                                keep(current_url, entry)
+                            continue
+
+                        new_entry["links"] = result["links"]
+                        entries[current_url] = new_entry
+
+                        # finally write the file.
+                        start = time.perf_counter()
+                        if self.write and self._write_if_changed(
+                            workpath / new_entry["filename"], result["markdown"]
+                        ):
+                            metrics.count("pages_written")
+                        timer.add(current_url, {"write": time.perf_counter() - start})
+                        timer.done(current_url)
+
+                        if self.sink is not None:
+                            self.sink(new_entry["filename"], result["markdown"])
+
+                    schedule()
+        except BaseException:
+            # an interrupted crawl forgets nothing about the pages not reached.
+            manifest.save({**previous, **entries})
+            raise
+
+        # remove the files of the pages which no longer exist.
+        filenames = {entry["filename"] for entry in entries.values()}
+
+        for url, entry in previous.items():
+            if url in entries or entry["filename"] in filenames:
+                continue
+            (workpath / entry["filename"]).unlink(missing_ok=True)
+            print(f"[INFO] removed {entry['filename']} ({url} no longer exists)")
 
-                # get a filename from the url.
-                filename = self._url_to_filename(current_url)
+        manifest.save(entries)
 
-                # finally write the file.
-                with open(workpath / filename, "w", encoding="utf-8") as f:
-                    f.write(markdown)
+        metrics.gauge("pages_scraped", len(entries))
+        metrics.gauge("pages_unchanged", len(unchanged))
 
-            except Exception as e:
-                print(f"[ERROR] error scraping url {current_url}: {e}")
+        print(
+            f"[INFO] {len(entries)} pages scraped, {len(unchanged)} unchanged"
+            f" since the previous run"
+        )
 
-            time.sleep(self.delay)
+        if self.timings:
+            print(f"[TIME] {timer.summary()}")
@@ -0,0 +1,220 @@
+import time
+import asyncio
+import lancedb
+import uvicorn
+from typing import Any, AsyncIterator, Callable, Optional
+from starlette.applications import Starlette
+from starlette.exceptions import HTTPException
+from starlette.requests import Request
+from starlette.responses import (
+    JSONResponse,
+    PlainTextResponse,
+    StreamingResponse,
+)
+from starlette.routing import Route
+from starlette.types import Receive, Scope, Send
+from rag_url.agent import RagAgent
+from rag_url.cache import EmbeddingCache
+from rag_url.gemini import make_client
+from rag_url.metrics import metrics
+
+# Results a search request may ask for.
+MAX_LIMIT = 100
+
+# Ends an answer which failed once streamed, its status being sent already.
+ANSWER_ERROR = "[ERROR] The answer could not be completed"
+
+
+def server_timing(**durations: float) -> str:
+    return ", ".join(f"{name};dur={1000 * d:.1f}" for name, d in durations.items())
+
+
+class SlotResponse(StreamingResponse):
+    def __init__(self, content: Any, release: Callable[[], None], **kwargs: Any):
+        """Streamed response giving its request slot back once it is over,
+        sent in full or not, even when its body was never iterated.
+        """
+        super().__init__(content, **kwargs)
+        self.release = release
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.release()
+
+
+class KnowledgeServer:
+    def __init__(
+        self,
+        dbfile: str,
+        collections: Optional[list[str]] = None,
+        max_concurrency: int = 16,
+        queue_timeout: float = 10.0,
+        cache: Optional[EmbeddingCache] = None,
+        client: Any = None,
+        model: Any = "gemini-2.0-flash",
+        **search_options: Any,
+    ):
+        """HTTP access to the collections of a db, all of them by default.
+
+        The agents, the embedding cache and the Gemini client are created once
+        and shared by the requests, at most `max_concurrency` of them being
+        served at a time. The others wait up to `queue_timeout` seconds
+        before being turned down with a 503.
+        """
+        db = lancedb.connect(dbfile)
+        names = collections or [
+            name for name in db.table_names() if not name.endswith("__staging")
+        ]
+
+        if not names:
+            raise Exception(f"No collection to serve in {dbfile}")
+
+        client = client or make_client()
+        self.agents = {
+            name: RagAgent(
+                dbfile,
+                name,
+                cache=cache,
+                client=client,
+                model=model,
+                **search_options,
+            )
+            for name in names
+        }
+        self.slots = asyncio.Semaphore(max_concurrency)
+        self.queue_timeout = queue_timeout
+        self.app = Starlette(
+            routes=[
+                Route("/health", self.health),
+                Route("/metrics", self.export_metrics),
+                Route("/search", self.search),
+                Route("/ask", self.ask, methods=["GET", "POST"]),
+            ]
+        )
+
+    async def _acquire(self) -> float:
+        """Take a request slot, and return the time waited for it."""
+        start = time.perf_counter()
+
+        try:
+            await asyncio.wait_for(self.slots.acquire(), self.queue_timeout)
+        except TimeoutError:
+            metrics.count("requests_rejected")
+            raise HTTPException(503, "Too many requests in flight")
+
+        return time.perf_counter() - start
+
+    async def _params(self, request: Request) -> tuple[RagAgent, str, dict]:
+        params: dict[str, Any] = dict(request.query_params)
+
+        if request.method == "POST":
+            try:
+                body = await request.json()
+            except Exception:
+                raise HTTPException(400, "The body is not valid json")
+
+            if not isinstance(body, dict):
+                raise HTTPException(400, "The body must be a json object")
+            params.update(body)
+
+        question = params.get("q", "")
+        if not isinstance(question, str) or not question.strip():
+            raise HTTPException(400, "Missing query parameter 'q'")
+
+        name = params.get("collection")
+        if name is None and len(self.agents) == 1:
+            name = next(iter(self.agents))
+        if name is None:
+            names = ", ".join(self.agents)
+            raise HTTPException(
+                400, f"Missing parameter 'collection', one of: {names}"
+            )
+        if name not in self.agents:
+            raise HTTPException(404, f"Unknown collection '{name}'")
+
+        return self.agents[name], question.strip(), params
+
+    def _limit(self, params: dict, default: int) -> int:
+        try:
+            limit = int(params.get("k", default))
+        except (TypeError, ValueError):
+            raise HTTPException(400, "Parameter 'k' must be an integer")
+
+        if limit < 1:
+            raise HTTPException(400, "Parameter 'k' must be at least 1")
+        if limit > MAX_LIMIT:
+            raise HTTPException(400, f"Parameter 'k' must be at most {MAX_LIMIT}")
+
+        return limit
+
+    async def health(self, request: Request) -> JSONResponse:
+        return JSONResponse({"status": "ok", "collections": list(self.agents)})
+
+    async def export_metrics(self, request: Request) -> PlainTextResponse:
+        if not metrics.enabled:
+            raise HTTPException(404, "Metrics are disabled")
+
+        return PlainTextResponse(
+            metrics.prometheus(), media_type="text/plain; version=0.0.4"
+        )
+
+    async def search(self, request: Request) -> JSONResponse:
+        agent, query, params = await self._params(request)
+        limit = self._limit(params, agent.top_k)
+        queued = await self._acquire()
+        metrics.observe("queue_seconds", queued)
+
+        try:
+            start = time.perf_counter()
+            results = await asyncio.to_thread(agent.search, query, limit)
+            elapsed = time.perf_counter() - start
+        finally:
+            self.slots.release()
+
+        return JSONResponse(
+            {"collection": agent.collection, "query": query, "results": results},
+            headers={"Server-Timing": server_timing(queue=queued, search=elapsed)},
+        )
+
+    def _answer_failed(self, question: str, error: Exception) -> None:
+        metrics.count("answers_failed")
+        print(f"[ERROR] Error answering '{question}': {error}")
+
+    async def ask(self, request: Request) -> StreamingResponse:
+        agent, question, _ = await self._params(request)
+        queued = await self._acquire()
+        metrics.observe("queue_seconds", queued)
+        stream = agent.stream_answer(question)
+
+        # an answer failing before its first words still gets a status.
+        try:
+            first = await anext(stream, "")
+        except Exception as e:
+            self.slots.release()
+            self._answer_failed(question, e)
+            raise HTTPException(500, "Unable to answer the question")
+        except BaseException:
+            self.slots.release()
+            raise
+
+        async def answer() -> AsyncIterator[str]:
+            yield first
+            try:
+                async for delta in stream:
+                    yield delta
+            except Exception as e:
+                self._answer_failed(question, e)
+                yield f"\n\n{ANSWER_ERROR}\n"
+
+        # the slot is held until the answer is streamed or the client gone.
+        return SlotResponse(
+            answer(),
+            self.slots.release,
+            media_type="text/plain; charset=utf-8",
+            headers={"Server-Timing": server_timing(queue=queued)},
+        )
+
+    def run(self, host: str = "127.0.0.1", port: int = 8000) -> None:
+        uvicorn.run(self.app, host=host, port=port)
@@ -0,0 +1,160 @@
+import re
+from typing import TypedDict
+
+HEADING = re.compile(r"^(#{1,6})\s+(.+?)\s*#*\s*$")
+FENCE = re.compile(r"^\s*(```|~~~)")
+
+
+class Section(TypedDict):
+    headings: list[str]
+    body: str
+
+
+def estimate_tokens(text: str) -> int:
+    # about four characters per token for english prose and code.
+    return (len(text) + 3) // 4
+
+
+def heading_title(heading: str) -> str:
+    return heading.lstrip("#").strip()
+
+
+class MarkdownSplitter:
+    def __init__(self, max_tokens: int = 4000):
+        """Deterministic split of a markdown page on its heading hierarchy,
+        never inside a fenced code block, packed to `max_tokens` per part.
+        """
+        self.max_tokens = max_tokens
+
+    def sections(self, markdown: str) -> list[Section]:
+        """The page cut at every heading, each section knowing its ancestors."""
+        sections: list[Section] = []
+        stack: list[tuple[int, str]] = []
+        lines: list[str] = []
+        fenced = False
+
+        def flush() -> None:
+            body = "\n".join(lines).strip()
+            if body or stack:
+                sections.append(
+                    Section(headings=[heading for _, heading in stack], body=body)
+                )
+            lines.clear()
+
+        for line in markdown.split("\n"):
+            if FENCE.match(line):
+                fenced = not fenced
+
+            match = None if fenced else HEADING.match(line)
+
+            if not match:
+                lines.append(line)
+                continue
+
+            flush()
+
+            level = len(match.group(1))
+            while stack and stack[-1][0] >= level:
+                stack.pop()
+            stack.append((level, line.strip()))
+
+        flush()
+
+        return sections
+
+    def blocks(self, body: str) -> list[str]:
+        """Paragraphs and fenced code blocks of a section body."""
+        blocks: list[str] = []
+        lines: list[str] = []
+        fenced = False
+
+        for line in body.split("\n"):
+            if FENCE.match(line):
+                fenced = not fenced
+
+            if not fenced and not line.strip():
+                if lines:
+                    blocks.append("\n".join(lines))
+                    lines = []
+                continue
+
+            lines.append(line)
+
+        if lines:
+            blocks.append("\n".join(lines))
+
+        return blocks
+
+    def render(self, section: Section) -> str:
+        return "\n\n".join([*section["headings"][-1:], section["body"]]).strip()
+
+    def _split_section(self, section: Section) -> list[str]:
+        # repeat the enclosing headings on every part so each one has context.
+        context = "\n\n".join(section["headings"])
+        budget = self.max_tokens - estimate_tokens(context)
+        parts: list[str] = []
+        current: list[str] = []
+        size = 0
+
+        for block in self.blocks(section["body"]):
+            tokens = estimate_tokens(block)
+
+            if current and size + tokens > budget:
+                parts.append("\n\n".join([context, *current]).strip())
+                current, size = [], 0
+
+            # an oversized block, usually code, stays whole.
+            current.append(block)
+            size += tokens
+
+        if current:
+            parts.append("\n\n".join([context, *current]).strip())
+
+        return parts
+
+    def split(self, markdown: str) -> list[str]:
+        """Consecutive sections packed in parts of at most `max_tokens`."""
+        if estimate_tokens(markdown) <= self.max_tokens:
+            return [markdown]
+
+        parts: list[str] = []
+        current: list[str] = []
+        size = 0
+
+        for section in self.sections(markdown):
+            text = self.render(section)
+            tokens = estimate_tokens(text)
+
+            if current and size + tokens > self.max_tokens:
+                parts.append("\n\n".join(current))
+                current, size = [], 0
+
+            if tokens > self.max_tokens:
+                parts.extend(self._split_section(section))
+                continue
+
+            # a part starting deep in the page gets the enclosing headings.
+            if not current and len(section["headings"]) > 1:
+                current.extend(section["headings"][:-1])
+                size += estimate_tokens("\n\n".join(current))
+
+            current.append(text)
+            size += tokens
+
+        if current:
+            parts.append("\n\n".join(current))
+
+        return parts
+
+    def is_well_structured(
+        self, sections: list[Section], min_sections: int = 2
+    ) -> bool:
+        """Whether the sections can be used as chunks as they are: enough of
+        them, each under a heading and within the token budget.
+        """
+        contentful = [s for s in sections if s["body"]]
+
+        return len(contentful) >= min_sections and all(
+            s["headings"] and estimate_tokens(s["body"]) <= self.max_tokens
+            for s in contentful
+        )
@@ -0,0 +1,148 @@
+import json
+import sqlite3
+import threading
+from pathlib import Path
+from itertools import groupby
+from typing import Any, Iterator, Optional
+
+# Name of the chunk store in a workdir.
+STORE_FILENAME = "chunks.sqlite"
+
+
+def _chunk(title: Any, content: Any, code: Any) -> dict[str, Any]:
+    return {"title": title, "content": content, "code": code}
+
+
+class ChunkStore:
+    def __init__(self, path: str | Path):
+        """The chunks of every page in a single sqlite file, instead of one
+        json file per page.
+
+        A page is written in a single transaction: its url, content hash and
+        prompt version once, then each of its chunks with its index. The
+        workers of a process share the connection, other processes wait for
+        the lock of the file.
+        """
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # a commit per page, durable against a crash of the process.
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS pages"
+            " (name TEXT PRIMARY KEY, url TEXT NOT NULL, hash TEXT NOT NULL,"
+            " prompt_version TEXT)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS chunks"
+            " (name TEXT NOT NULL, chunk_index INTEGER NOT NULL, title TEXT,"
+            " content TEXT, code TEXT, PRIMARY KEY (name, chunk_index))"
+        )
+        self.conn.commit()
+
+    def get(self, name: str) -> Optional[dict[str, Any]]:
+        """The page as it would be in its json file: url, hash and chunks."""
+        with self.lock:
+            page = self.conn.execute(
+                "SELECT url, hash FROM pages WHERE name = ?", (name,)
+            ).fetchone()
+
+            if page is None:
+                return None
+
+            rows = self.conn.execute(
+                "SELECT title, content, code FROM chunks WHERE name = ?"
+                " ORDER BY chunk_index",
+                (name,),
+            ).fetchall()
+
+        return {"url": page[0], "hash": page[1], "chunks": [_chunk(*row) for row in rows]}
+
+    def put(
+        self,
+        name: str,
+        url: str,
+        digest: str,
+        chunks: list[Any],
+        prompt_version: Optional[str] = None,
+    ) -> None:
+        """Replace the chunks of a page, readers see either all the previous
+        ones or all the new ones.
+        """
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM chunks WHERE name = ?", (name,))
+            self.conn.execute(
+                "INSERT OR REPLACE INTO pages (name, url, hash, prompt_version)"
+                " VALUES (?, ?, ?, ?)",
+                (name, url, digest, prompt_version),
+            )
+            self.conn.executemany(
+                "INSERT INTO chunks (name, chunk_index, title, content, code)"
+                " VALUES (?, ?, ?, ?, ?)",
+                [
+                    (name, i, chunk.get("title"), chunk.get("content"), chunk.get("code"))
+                    for i, chunk in enumerate(chunks)
+                ],
+            )
+
+    def delete(self, name: str) -> None:
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM chunks WHERE name = ?", (name,))
+            self.conn.execute("DELETE FROM pages WHERE name = ?", (name,))
+
+    def names(self) -> list[str]:
+        with self.lock:
+            return [row[0] for row in self.conn.execute("SELECT name FROM pages")]
+
+    def pages(self) -> Iterator[tuple[str, str, list[dict[str, Any]]]]:
+        """The name, url and chunks of every page, one page in memory at a
+        time.
+        """
+        # a connection of its own, reading a snapshot while the workers write.
+        conn = sqlite3.connect(self.path, timeout=30)
+
+        try:
+            rows = conn.execute(
+                "SELECT p.name, p.url, c.chunk_index, c.title, c.content, c.code"
+                " FROM pages p LEFT JOIN chunks c ON c.name = p.name"
+                " ORDER BY p.name, c.chunk_index"
+            )
+
+            for (name, url), group in groupby(rows, key=lambda row: row[:2]):
+                # a page without chunks still has a row, without index.
+                chunks = [_chunk(*row[3:]) for row in group if row[2] is not None]
+                yield name, url, chunks
+        finally:
+            conn.close()
+
+    def close(self) -> None:
+        with self.lock:
+            self.conn.close()
+
+
+def import_json(store: ChunkStore, workdir: str | Path) -> int:
+    """Copy the chunks of the per page json files of workdir into the store,
+    and return the number of pages copied.
+
+    The json files do not record the prompt version, it is left unknown: the
+    hash, which covers it, still tells whether a page needs chunking again.
+    Files written before the hash was recorded get an empty one, matching no
+    page, so the chunker checks them again.
+    """
+    copied = 0
+
+    for filepath in sorted(Path(workdir).glob("*.json")):
+        try:
+            data = json.loads(filepath.read_text(encoding="utf-8"))
+            url, chunks = data["url"], data["chunks"]
+            digest = data.get("hash") or ""
+        except Exception as e:
+            print(f"[INFO] Skipping {filepath}: {e}")
+            continue
+
+        store.put(filepath.stem, url, digest, chunks)
+        copied += 1
+
+    return copied
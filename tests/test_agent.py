@@ -0,0 +1,63 @@
+import asyncio
+import contextlib
+import lancedb
+import pytest
+from pydantic_ai.models.test import TestModel
+from rag_url.agent import RagAgent
+from rag_url.cache import AnswerCache
+from rag_url.chunk import MarkdownChunker
+from rag_url.embed import ChunkEmbedder
+from rag_url.fixtures import FakeGenaiClient, synthetic_markdown
+
+
+@pytest.fixture
+def dbfile(tmp_path):
+    for i in range(3):
+        (tmp_path / f"page-{i}.md").write_text(synthetic_markdown(i), encoding="utf-8")
+
+    MarkdownChunker(str(tmp_path), local=True).run()
+
+    with contextlib.chdir(tmp_path):
+        for name in ["first", "second"]:
+            ChunkEmbedder(
+                "lancedb", "*.json", collection=name, client=FakeGenaiClient()
+            ).run()
+
+    return str(tmp_path / "lancedb")
+
+
+def test_cached_answer_opens_the_tables_once(dbfile):
+    agent = RagAgent(
+        dbfile, client=FakeGenaiClient(), model=TestModel(), answers=AnswerCache()
+    )
+    opened = []
+    open_table = agent.db.open_table
+    agent.db.open_table = lambda name: opened.append(name) or open_table(name)
+
+    answer = asyncio.run(agent.answer("page"))
+
+    assert asyncio.run(agent.answer("page")) == answer
+    assert sorted(opened) == ["first", "second"]
+
+
+def test_cached_answer_is_dropped_with_a_new_version(dbfile):
+    agent = RagAgent(
+        dbfile, client=FakeGenaiClient(), model=TestModel(), answers=AnswerCache()
+    )
+    asyncio.run(agent.answer("page"))
+
+    assert agent._cached_answer("page")[2] is not None
+
+    # the collection is updated by another process.
+    table = lancedb.connect(dbfile).open_table("first")
+    table.delete("chunk_index > 0")
+
+    assert agent._cached_answer("page")[2] is None
+
+
+def test_answer_versions_do_not_collide():
+    answers = AnswerCache()
+    answers.put("first,second", (2, 1), [1.0, 0.0], "answer", "page")
+
+    assert answers.find("first,second", (2, 1), "page") == "answer"
+    assert answers.find("first,second", (1, 2), "page") is None
@@ -0,0 +1,74 @@
+import contextlib
+import lancedb
+import pytest
+from pathlib import Path
+from rag_url.cache import ChunkCache, EmbeddingCache
+from rag_url.chunk import MarkdownChunker
+from rag_url.embed import ChunkEmbedder
+from rag_url.fixtures import FakeGenaiClient, SyntheticSite
+from rag_url.pipeline import BuildPipeline
+from rag_url.scrape import BaseUrlScraper
+from rag_url.store import STORE_FILENAME, ChunkStore
+
+
+def build(
+    tmp_path: Path, url: str, full: bool = False, fresh: bool = False
+) -> ChunkStore:
+    workdir = tmp_path / "pages"
+    workdir.mkdir(exist_ok=True)
+    store = ChunkStore(workdir / STORE_FILENAME)
+    chunker = MarkdownChunker(
+        str(workdir),
+        client=FakeGenaiClient(),
+        cache=ChunkCache(tmp_path / "cache" / "chunks.sqlite"),
+        store=store,
+    )
+    embedder = ChunkEmbedder(
+        str(tmp_path / "lancedb"),
+        None,
+        client=FakeGenaiClient(),
+        full=full,
+        cache=EmbeddingCache(tmp_path / "cache" / "embeddings.sqlite"),
+    )
+
+    with contextlib.chdir(tmp_path):
+        BuildPipeline(
+            BaseUrlScraper(str(workdir), url, rate=0, full=full or fresh),
+            chunker,
+            embedder,
+        ).run()
+
+    chunker.cache.close()
+    embedder.cache.close()
+
+    return store
+
+
+def test_full_build_keeps_the_store(tmp_path):
+    with SyntheticSite(pages=12) as site:
+        store = build(tmp_path, site.url, full=False)
+        names = store.names()
+        store.close()
+        build(tmp_path, site.url, full=True).close()
+
+    assert names
+    assert (tmp_path / "pages" / STORE_FILENAME).exists()
+    # the pages stored by the full build are found by a new connection.
+    assert ChunkStore(tmp_path / "pages" / STORE_FILENAME).names() == names
+
+
+def test_build_without_pages_keeps_the_collection(tmp_path):
+    with SyntheticSite(pages=12) as site:
+        url = site.url
+        build(tmp_path, url).close()
+
+    rows = lancedb.connect(tmp_path / "lancedb").open_table("collection").count_rows()
+
+    # the site is down, and the crawl starts from an empty workdir.
+    with pytest.raises(Exception, match="No page was built"):
+        build(tmp_path, url, fresh=True)
+
+    table = lancedb.connect(tmp_path / "lancedb").open_table("collection")
+
+    assert rows
+    assert table.count_rows() == rows
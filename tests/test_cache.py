@@ -0,0 +1,44 @@
+import time
+from rag_url.cache import AnswerCache
+
+
+def test_close_question_gets_the_cached_answer():
+    answers = AnswerCache(threshold=0.95)
+    answers.put("docs", (1,), [1.0, 0.0, 0.0], "answer", "how to install?")
+
+    assert answers.get("docs", (1,), [0.99, 0.05, 0.0]) == "answer"
+    assert answers.get("docs", (1,), [0.0, 1.0, 0.0]) is None
+    assert answers.get("other", (1,), [1.0, 0.0, 0.0]) is None
+
+
+def test_same_question_is_found_without_its_vector():
+    answers = AnswerCache()
+    answers.put("docs", (1,), [1.0, 0.0], "answer", "how to install?")
+
+    assert answers.find("docs", (1,), "how to install?") == "answer"
+    assert answers.find("docs", (1,), "how to run?") is None
+
+
+def test_new_version_drops_the_answers_of_its_collection():
+    answers = AnswerCache()
+    answers.put("docs", (1, 1), [1.0, 0.0], "answer", "question")
+    answers.put("blog", (1,), [1.0, 0.0], "other answer", "question")
+
+    assert answers.find("docs", (1, 2), "question") is None
+    assert answers.find("docs", (1, 1), "question") is None
+    assert answers.find("blog", (1,), "question") == "other answer"
+
+
+def test_expired_and_least_recently_used_answers_are_dropped():
+    answers = AnswerCache(ttl=0.05, max_items=2)
+    answers.put("docs", (1,), [1.0, 0.0], "first", "first")
+    answers.put("docs", (1,), [0.0, 1.0], "second", "second")
+    answers.find("docs", (1,), "first")
+    answers.put("docs", (1,), [1.0, 1.0], "third", "third")
+
+    assert answers.find("docs", (1,), "second") is None
+    assert answers.find("docs", (1,), "first") == "first"
+
+    time.sleep(0.1)
+
+    assert answers.find("docs", (1,), "third") is None
@@ -0,0 +1,48 @@
+import time
+from pathlib import Path
+from rag_url.chunk import MarkdownChunker
+from rag_url.fixtures import FakeAPIError, FakeGenaiClient, synthetic_markdown
+
+
+class FailingClient(FakeGenaiClient):
+    def __init__(self, code: int, failures: int):
+        """Fails its first `failures` calls with the status `code`."""
+        super().__init__()
+        self.code = code
+        self.failures = failures
+
+    def generate_content(self, model, contents, config=None):
+        with self.lock:
+            failed = self.calls < self.failures
+
+        if failed:
+            self._call()
+            raise FakeAPIError(self.code)
+
+        return super().generate_content(model, contents, config)
+
+
+def chunker(workdir: Path, client: FakeGenaiClient) -> MarkdownChunker:
+    (workdir / "page-0.md").write_text(synthetic_markdown(0), encoding="utf-8")
+    chunker = MarkdownChunker(str(workdir), client=client, retries=3)
+    chunker.limiter.min_delay = chunker.limiter.delay = 0.2
+
+    return chunker
+
+
+def test_non_retryable_error_is_not_retried(tmp_path):
+    client = FailingClient(400, failures=10)
+
+    assert chunker(tmp_path, client).run() == (1, 0)
+    assert client.calls == 1
+
+
+def test_retry_waits_out_the_backoff(tmp_path):
+    client = FailingClient(429, failures=1)
+
+    start = time.perf_counter()
+    assert chunker(tmp_path, client).run() == (1, 1)
+
+    assert client.calls == 2
+    # the throttle paused the calls for at least half the delay.
+    assert time.perf_counter() - start >= 0.1
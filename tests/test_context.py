@@ -0,0 +1,41 @@
+from rag_url.context import ContextAssembler, Passage, format_passage
+from rag_url.split import estimate_tokens
+
+
+def passage(rank: int, words: int, code: str | None = None) -> Passage:
+    return Passage(
+        url=f"https://host/{rank}",
+        urls=[f"https://host/{rank}"],
+        text=" ".join(["word"] * words),
+        code=code,
+        rank=rank,
+    )
+
+
+def tokens(passages: list[Passage]) -> int:
+    return sum(estimate_tokens(format_passage(p)) for p in passages)
+
+
+def test_pack_stops_at_the_limit():
+    passages = [passage(rank, 10) for rank in range(5)]
+
+    assert ContextAssembler()._pack(passages, 2, 10000) == passages[:2]
+
+
+def test_pack_skips_what_does_not_fit_for_smaller_passages():
+    passages = [passage(0, 20), passage(1, 200), passage(2, 20)]
+    budget = tokens([passages[0], passages[2]])
+    packed = ContextAssembler()._pack(passages, 3, budget)
+
+    assert [p["rank"] for p in packed] == [0, 2]
+    assert tokens(packed) <= budget
+
+
+def test_pack_cuts_the_best_passage_over_the_budget():
+    best = passage(0, 500, code="print('example')")
+    packed = ContextAssembler()._pack([best, passage(1, 5)], 2, 50)
+
+    assert len(packed) == 1
+    assert packed[0]["code"] is None
+    assert best["text"].startswith(packed[0]["text"])
+    assert tokens(packed) <= 50
@@ -0,0 +1,34 @@
+from rag_url.dedup import NearDuplicates
+
+TEXT = " ".join(f"word{i}" for i in range(200))
+
+
+def test_equal_texts_once_normalized_are_grouped():
+    duplicates = NearDuplicates()
+
+    assert duplicates.group("a", "Hello, World!") == "a"
+    assert duplicates.group("b", "hello   world") == "a"
+    assert duplicates.group("c", "hello there") == "c"
+
+
+def test_near_duplicates_are_grouped_with_the_first_text():
+    duplicates = NearDuplicates(max_distance=3)
+
+    assert duplicates.group("a", TEXT) == "a"
+    assert duplicates.group("b", TEXT + " word200") == "a"
+    assert duplicates.group("c", " ".join(f"other{i}" for i in range(200))) == "c"
+
+
+def test_short_texts_are_only_grouped_when_equal():
+    duplicates = NearDuplicates(max_distance=3, min_shingles=20)
+
+    assert duplicates.group("a", "install the package with pip") == "a"
+    assert duplicates.group("b", "install the package with uv") == "b"
+
+
+def test_zero_distance_only_groups_equal_texts():
+    duplicates = NearDuplicates(max_distance=0)
+
+    assert duplicates.group("a", TEXT) == "a"
+    assert duplicates.group("b", TEXT + " word200") == "b"
+    assert duplicates.group("c", TEXT.upper()) == "a"
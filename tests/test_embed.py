@@ -0,0 +1,24 @@
+import contextlib
+import lancedb
+import numpy as np
+from rag_url.chunk import MarkdownChunker
+from rag_url.embed import ChunkEmbedder
+from rag_url.fixtures import FakeGenaiClient, synthetic_markdown
+
+
+def test_truncated_vectors_are_stored_normalized(tmp_path):
+    for i in range(3):
+        (tmp_path / f"page-{i}.md").write_text(synthetic_markdown(i), encoding="utf-8")
+
+    MarkdownChunker(str(tmp_path), local=True).run()
+
+    with contextlib.chdir(tmp_path):
+        ChunkEmbedder(
+            "lancedb", "*.json", client=FakeGenaiClient(), dimensions=64
+        ).run()
+
+    table = lancedb.connect(tmp_path / "lancedb").open_table("collection")
+    vectors = np.array(table.to_arrow()["vector"].to_pylist())
+
+    assert vectors.shape[1] == 64
+    assert np.allclose(np.linalg.norm(vectors, axis=1), 1.0)
@@ -0,0 +1,38 @@
+from rag_url.frontier import PrefixTrie, normalize_url
+
+
+def test_normalize_url_canonical_form():
+    assert (
+        normalize_url("HTTPS://Docs.Example.com:443/a//b/./c/../index.html#top")
+        == "https://docs.example.com/a/b"
+    )
+    assert normalize_url("http://host:8080/a/") == "http://host:8080/a"
+    assert normalize_url("https://host/") == "https://host"
+
+
+def test_normalize_url_sorts_the_query_without_tracking_params():
+    assert (
+        normalize_url("https://host/a?b=2&utm_source=x&a=1&fbclid=y&empty=")
+        == "https://host/a?a=1&b=2&empty="
+    )
+
+
+def test_normalize_url_rejects_anything_but_absolute_http_urls():
+    assert normalize_url("mailto:someone@host") is None
+    assert normalize_url("/relative/path") is None
+    assert normalize_url("ftp://host/file") is None
+    assert normalize_url("https://host:port/") is None
+
+
+def test_prefix_trie_matches_any_prefix():
+    trie = PrefixTrie(["https://host/docs/old", "https://host/blog"])
+
+    assert trie.match("https://host/docs/old/page")
+    assert trie.match("https://host/blog")
+    assert not trie.match("https://host/docs/new")
+    assert not trie.match("https://host/bl")
+
+
+def test_prefix_trie_empty_prefix_matches_everything():
+    assert PrefixTrie([""]).match("anything")
+    assert not PrefixTrie([]).match("anything")
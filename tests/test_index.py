@@ -0,0 +1,30 @@
+from rag_url.index import reciprocal_rank_fusion
+
+
+def rows(*ids: str) -> list[dict]:
+    return [{"id": row_id} for row_id in ids]
+
+
+def ids(rows: list[dict]) -> list[str]:
+    return [row["id"] for row in rows]
+
+
+def test_rows_found_by_both_rankings_come_first():
+    fused = reciprocal_rank_fusion([rows("a", "b", "c"), rows("c", "d")], limit=4)
+
+    assert ids(fused) == ["c", "a", "b", "d"]
+
+
+def test_fusion_keeps_the_first_row_found_and_the_limit():
+    first = [{"id": "a", "text": "vector"}]
+    second = [{"id": "a", "text": "fts"}, {"id": "b"}]
+    fused = reciprocal_rank_fusion([first, second], limit=1)
+
+    assert fused == [{"id": "a", "text": "vector"}]
+
+
+def test_weights_favour_a_ranking():
+    rankings = [rows("a", "b"), rows("b", "a")]
+
+    assert ids(reciprocal_rank_fusion(rankings, 2, weights=[1.0, 2.0])) == ["b", "a"]
+    assert ids(reciprocal_rank_fusion(rankings, 2, weights=[2.0, 1.0])) == ["a", "b"]
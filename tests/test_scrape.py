@@ -0,0 +1,63 @@
+import os
+import multiprocessing
+from pathlib import Path
+from rag_url.fixtures import SyntheticSite
+from rag_url.scrape import BaseUrlScraper
+
+
+class DyingWorkerScraper(BaseUrlScraper):
+    def _process_page(self, url, content):
+        # the parse workers die, as they do without a __main__ guard.
+        if multiprocessing.parent_process() is not None:
+            os._exit(1)
+
+        return super()._process_page(url, content)
+
+
+class UnparsableScraper(BaseUrlScraper):
+    def _to_markdown(self, url, content):
+        raise Exception("Unable to parse page content as markdown.")
+
+
+def test_parse_error_keeps_the_previous_page(tmp_path):
+    with SyntheticSite(pages=6) as site:
+        BaseUrlScraper(str(tmp_path), site.url, rate=0).run()
+        pages = sorted(path.name for path in Path(tmp_path).glob("*.md"))
+
+        # the pages changed, but none of them can be converted this time.
+        site.seed += 1
+        site.lastmod = "2025-02-01"
+        UnparsableScraper(str(tmp_path), site.url, rate=0).run()
+
+    assert pages
+    assert sorted(path.name for path in Path(tmp_path).glob("*.md")) == pages
+
+
+def test_dead_parse_workers_fall_back_to_this_process(tmp_path):
+    with SyntheticSite(pages=6) as site:
+        (tmp_path / "expected").mkdir()
+        (tmp_path / "actual").mkdir()
+        BaseUrlScraper(str(tmp_path / "expected"), site.url, rate=0).run()
+        scraper = DyingWorkerScraper(str(tmp_path / "actual"), site.url, rate=0)
+        scraper.run()
+
+    expected = sorted(path.name for path in (tmp_path / "expected").glob("*.md"))
+
+    assert expected
+    assert sorted(path.name for path in (tmp_path / "actual").glob("*.md")) == expected
+    assert scraper.failed == 0
+
+
+def test_seed_url_keeps_the_pages_under_the_base_path(tmp_path):
+    scraper = BaseUrlScraper(
+        str(tmp_path), "https://host/docs", excluded_paths=["/docs/old"]
+    )
+
+    assert scraper._seed_url("https://host/docs") == "https://host/docs"
+    assert scraper._seed_url("https://host/docs/a/") == "https://host/docs/a"
+    assert scraper._seed_url("http://host/docs/a") == "https://host/docs/a"
+    assert scraper._seed_url("https://www.host/docs/a") == "https://host/docs/a"
+    assert scraper._seed_url("https://host/docs-old/a") is None
+    assert scraper._seed_url("https://host/docs/old/a") is None
+    assert scraper._seed_url("https://other/docs/a") is None
+    assert scraper._seed_url("mailto:someone@host") is None
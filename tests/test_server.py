@@ -0,0 +1,100 @@
+import asyncio
+import contextlib
+import pytest
+from pydantic_ai.models.test import TestModel
+from starlette.testclient import TestClient
+from rag_url.chunk import MarkdownChunker
+from rag_url.embed import ChunkEmbedder
+from rag_url.fixtures import FakeGenaiClient, synthetic_markdown
+from rag_url.server import ANSWER_ERROR, MAX_LIMIT, KnowledgeServer
+
+
+@pytest.fixture(scope="module")
+def dbfile(tmp_path_factory):
+    workdir = tmp_path_factory.mktemp("pages")
+
+    for i in range(5):
+        (workdir / f"page-{i}.md").write_text(synthetic_markdown(i), encoding="utf-8")
+
+    MarkdownChunker(str(workdir), local=True).run()
+
+    with contextlib.chdir(workdir):
+        ChunkEmbedder("lancedb", "*.json", client=FakeGenaiClient()).run()
+
+    return str(workdir / "lancedb")
+
+
+def make_server(dbfile: str) -> KnowledgeServer:
+    return KnowledgeServer(
+        dbfile, max_concurrency=1, client=FakeGenaiClient(), model=TestModel()
+    )
+
+
+def failing_answer(*deltas: str):
+    async def stream_answer(question):
+        for delta in deltas:
+            yield delta
+        raise Exception("model unavailable")
+
+    return stream_answer
+
+
+def test_search_limit_is_capped(dbfile):
+    client = TestClient(make_server(dbfile).app)
+
+    for limit, status in [(MAX_LIMIT, 200), (MAX_LIMIT + 1, 400)]:
+        response = client.get("/search", params={"q": "page", "k": limit})
+        assert response.status_code == status
+
+
+def test_answer_failing_before_any_output_is_a_500(dbfile):
+    server = make_server(dbfile)
+    agent = next(iter(server.agents.values()))
+    agent.stream_answer = failing_answer()
+    client = TestClient(server.app)
+
+    assert client.get("/ask", params={"q": "page"}).status_code == 500
+    # the single slot was given back.
+    assert client.get("/search", params={"q": "page"}).status_code == 200
+
+
+def test_answer_failing_midway_ends_with_an_error(dbfile):
+    server = make_server(dbfile)
+    agent = next(iter(server.agents.values()))
+    agent.stream_answer = failing_answer("The answer")
+    response = TestClient(server.app).get("/ask", params={"q": "page"})
+
+    assert response.status_code == 200
+    assert response.text.startswith("The answer")
+    assert response.text.strip().endswith(ANSWER_ERROR)
+    assert server.slots._value == 1
+
+
+def test_client_gone_before_the_body_gives_the_slot_back(dbfile):
+    server = make_server(dbfile)
+    messages = []
+
+    async def receive():
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": "/ask",
+        "raw_path": b"/ask",
+        "root_path": "",
+        "query_string": b"q=page",
+        "headers": [],
+        "server": ("testserver", 80),
+        "client": ("testclient", 50000),
+    }
+
+    asyncio.run(server.app(scope, receive, send))
+
+    assert server.slots._value == 1
@@ -0,0 +1,65 @@
+from rag_url.split import MarkdownSplitter, estimate_tokens
+
+PAGE = """# Title
+
+Intro.
+
+## Install
+
+```bash
+# not a heading
+pip install package
+```
+
+### From source
+
+Clone it.
+
+## Usage
+
+Run it.
+"""
+
+
+def test_sections_know_their_headings_and_skip_code_blocks():
+    sections = MarkdownSplitter().sections(PAGE)
+
+    assert [section["headings"] for section in sections] == [
+        ["# Title"],
+        ["# Title", "## Install"],
+        ["# Title", "## Install", "### From source"],
+        ["# Title", "## Usage"],
+    ]
+    assert "# not a heading" in sections[1]["body"]
+
+
+def test_small_page_is_a_single_part():
+    assert MarkdownSplitter(max_tokens=4000).split(PAGE) == [PAGE]
+
+
+def test_parts_stay_within_the_budget_with_their_headings():
+    body = "\n\n".join(f"Paragraph {i} " + "text " * 20 for i in range(20))
+    page = f"# Title\n\n## Section\n\n{body}\n\n## Other\n\nShort."
+    splitter = MarkdownSplitter(max_tokens=100)
+    parts = splitter.split(page)
+
+    assert len(parts) > 1
+    assert all(estimate_tokens(part) <= splitter.max_tokens for part in parts)
+    assert all(part.startswith("# Title") for part in parts)
+    # no paragraph is lost or cut.
+    for i in range(20):
+        assert sum(f"Paragraph {i} " in part for part in parts) == 1
+
+
+def test_oversized_code_block_stays_whole():
+    code = "```python\n" + "x = 1\n" * 200 + "```"
+    parts = MarkdownSplitter(max_tokens=100).split(f"# Title\n\n{code}")
+
+    assert any(code in part for part in parts)
+
+
+def test_is_well_structured():
+    splitter = MarkdownSplitter(max_tokens=4000)
+
+    assert splitter.is_well_structured(splitter.sections(PAGE))
+    assert not splitter.is_well_structured(splitter.sections("Just text."))